@@ -0,0 +1,171 @@
+"""
+Microbenchmarks: the bot's hand-written ABI codec against web3 contract objects.
+
+    python bench_abi.py [--n 20000]
+
+Encoding, decoding and transaction building are timed offline. The eth_call rows
+time whole calls against replay.py's stand-in node on localhost, with no added
+latency and no coalescing window, so what remains is the client-side cost of
+each path plus a local HTTP round trip. Every pair is checked to give the same
+answer before it is timed.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def fn_abi(name, inputs, outputs=(), mutability="view"):
+    return {
+        "name": name,
+        "type": "function",
+        "stateMutability": mutability,
+        "inputs": [{"name": f"a{i}", "type": t} for i, t in enumerate(inputs)],
+        "outputs": [{"name": "", "type": t} for t in outputs],
+    }
+
+
+# the web3 side of each comparison: contract objects built from these ABIs
+ROUTER_ABI = [fn_abi("getAmountsOut", ["uint256", "address[]"], ["uint256[]"])]
+WRAPPER_ABI = [
+    fn_abi(
+        "swapExactETHForTokensSupportingFeeOnTransferTokens",
+        ["uint256", "address[]", "address", "uint256"],
+        mutability="payable",
+    ),
+    fn_abi(
+        "swapExactTokensForETHSupportingFeeOnTransferTokens",
+        ["uint256", "uint256", "address[]", "address", "uint256"],
+        mutability="nonpayable",
+    ),
+]
+ERC20_ABI = [
+    fn_abi("decimals", [], ["uint8"]),
+    fn_abi("symbol", [], ["string"]),
+    fn_abi("balanceOf", ["address"], ["uint256"]),
+]
+
+
+def per_call_us(fn, n):
+    fn()
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def normalize(value):
+    if isinstance(value, dict):
+        return normalize(value["data"])  # built transactions: compare the call data
+    if isinstance(value, bytes):
+        return "0x" + value.hex()
+    if isinstance(value, str):
+        return value.lower()
+    return list(value) if isinstance(value, tuple) else value
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=20000, help="iterations per offline case")
+    ap.add_argument("--calls", type=int, default=500, help="iterations per eth_call case")
+    args = ap.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    from replay import start_stand_ins
+
+    start_stand_ins()
+    os.environ["RPC_COALESCE_MS"] = "0"
+    os.chdir(tempfile.mkdtemp(prefix="bench-abi-"))
+    import bot
+
+    w3 = bot.w3
+    router = w3.eth.contract(address=bot.PANCAKE_ROUTER, abi=ROUTER_ABI)
+    wrapper = w3.eth.contract(address=bot.WRAPPER_ADDRESS, abi=WRAPPER_ABI)
+    token = w3.to_checksum_address("0x" + "66" * 20)
+    wallet = w3.eth.account.from_key("0x" + "77" * 32).address
+    path = [bot.WBNB, bot.BUSD, token]
+    amount = 10**18
+    deadline = int(time.time()) + 600
+    amounts_raw = "0x" + w3.codec.encode(["uint256[]"], [[amount, 3 * amount, 5 * amount]]).hex()
+    symbol_raw = "0x" + w3.codec.encode(["string"], ["CAKE"]).hex()
+    tx_base = {"from": wallet, "gas": 600000, "gasPrice": 5 * 10**9, "nonce": 7, "chainId": 56}
+
+    def web3_buy_tx():
+        return wrapper.functions.swapExactETHForTokensSupportingFeeOnTransferTokens(
+            0, path, wallet, deadline
+        ).build_transaction({**tx_base, "value": amount})
+
+    def fast_buy_tx():
+        data = bot.encode_swap_eth_for_tokens(0, path, wallet, deadline)
+        return {**tx_base, "to": bot.WRAPPER_ADDRESS, "value": amount, "data": data}
+
+    offline = [
+        (
+            "getAmountsOut calldata",
+            lambda: router.encode_abi("getAmountsOut", args=[amount, path]),
+            lambda: bot.encode_get_amounts_out(amount, path),
+        ),
+        (
+            "swap ETH->tokens calldata",
+            lambda: wrapper.encode_abi(
+                "swapExactETHForTokensSupportingFeeOnTransferTokens", args=[0, path, wallet, deadline]
+            ),
+            lambda: bot.encode_swap_eth_for_tokens(0, path, wallet, deadline),
+        ),
+        (
+            "swap tokens->ETH calldata",
+            lambda: wrapper.encode_abi(
+                "swapExactTokensForETHSupportingFeeOnTransferTokens", args=[amount, 0, path[::-1], wallet, deadline]
+            ),
+            lambda: bot.encode_swap_tokens_for_eth(amount, 0, path[::-1], wallet, deadline),
+        ),
+        (
+            "uint256[] result",
+            lambda: w3.codec.decode(["uint256[]"], bytes.fromhex(amounts_raw[2:]))[0],
+            lambda: bot.decode_uint_array(amounts_raw),
+        ),
+        (
+            "string result",
+            lambda: w3.codec.decode(["string"], bytes.fromhex(symbol_raw[2:]))[0],
+            lambda: bot.decode_string(symbol_raw),
+        ),
+        ("buy tx", web3_buy_tx, fast_buy_tx),
+    ]
+    calls = [
+        (
+            "eth_call getAmountsOut",
+            lambda: router.functions.getAmountsOut(amount, path).call(),
+            lambda: bot.get_amounts_out(amount, path),
+        ),
+        (
+            "eth_call decimals",
+            lambda: w3.eth.contract(address=token, abi=ERC20_ABI).functions.decimals().call(),
+            lambda: bot.call_decimals(token),
+        ),
+        (
+            "eth_call symbol",
+            lambda: w3.eth.contract(address=token, abi=ERC20_ABI).functions.symbol().call(),
+            lambda: bot.call_symbol(token),
+        ),
+        (
+            "eth_call balanceOf",
+            lambda: w3.eth.contract(address=token, abi=ERC20_ABI).functions.balanceOf(wallet).call(),
+            lambda: bot.call_balance_of(token, wallet),
+        ),
+    ]
+
+    print(f"{'case':<28} {'web3 us':>10} {'fast us':>10} {'speedup':>8}")
+    for cases, n in ((offline, args.n), (calls, args.calls)):
+        for name, slow, fast in cases:
+            a, b = normalize(slow()), normalize(fast())
+            if a != b:
+                raise Exception(f"{name}: results differ: {a!r} != {b!r}")
+            slow_us, fast_us = per_call_us(slow, n), per_call_us(fast, n)
+            print(f"{name:<28} {slow_us:>10.1f} {fast_us:>10.1f} {slow_us / fast_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
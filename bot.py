@@ -1,11 +1,31 @@
 # bsc_trading_bot_wrapper.py
 import os
 import re
+import sys
 import json
 import time
+import math
+import hashlib
+import mmap
+import heapq
+import bisect
+import threading
+import zlib
+import glob
+import multiprocessing
+from contextlib import contextmanager
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from dotenv import load_dotenv
 from web3 import Web3
+from web3.providers import JSONBaseProvider
+
+try:
+    import fcntl  # sharded mode file locks (POSIX only)
+except ImportError:
+    fcntl = None
 
 # =========================================================
 #  ADVANCED MULTI-USER BSC TRADING BOT (Wrapper fee integration)
@@ -31,7 +51,126 @@ if not TELEGRAM_TOKEN:
 if not WRAPPER_ADDRESS or WRAPPER_ADDRESS == "0x0000000000000000000000000000000000000000":
     raise Exception("WRAPPER_ADDRESS must be set to the deployed contract address in .env")
 
-TG_BASE_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")  # replay.py points this at a stand-in
+TG_BASE_URL = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}"
+BSCSCAN_URL = os.getenv("BSCSCAN_URL", "https://bscscan.com")
+
+# ---------- Tracing and profiling ----------
+# While an admin's /trace window is open, every update is traced: a tree of spans
+# around its route handler, web3 and raw JSON-RPC calls, broadcasts and Telegram
+# / bscscan HTTP, appended to a Chrome trace event file (chrome://tracing,
+# Perfetto). Outside the window a span is one thread-local lookup, and each
+# process re-reads the (shared, in sharded mode) window once a second. /profile
+# samples every thread's stack for a few seconds and returns folded stacks for
+# flamegraph.pl or speedscope.
+TRACE_MAX_SEC = int(os.getenv("TRACE_MAX_SEC", "600"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SEC = int(os.getenv("PROFILE_MAX_SEC", "60"))
+trace_local = threading.local()
+TRACE_REFRESH_SEC = float(os.getenv("TRACE_REFRESH_SEC", "1"))
+trace_window = {}  # "until", "file"; a Manager dict in sharded mode so every worker traces
+trace_seen = {"until": 0, "file": None, "checked": 0}  # this process's copy of trace_window
+trace_lock = threading.Lock()
+profile_lock = threading.Lock()
+
+
+@contextmanager
+def span(name, cat="code", **args):
+    events = getattr(trace_local, "events", None)
+    if events is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        events.append(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": int(started * 1e6),
+                "dur": int((time.time() - started) * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+        )
+
+
+@contextmanager
+def trace_update(name, **args):
+    """Root span of one update; a no-op unless a trace window is open."""
+    now = time.time()
+    if now - trace_seen["checked"] >= TRACE_REFRESH_SEC:
+        window = trace_window.copy()  # one round trip on a Manager dict
+        trace_seen.update({"until": window.get("until", 0), "file": window.get("file"), "checked": now})
+    if getattr(trace_local, "events", None) is not None or now >= trace_seen["until"]:
+        yield
+        return
+    path = trace_seen["file"]
+    trace_local.events = []
+    try:
+        with span(name, "update", **args):
+            yield
+    finally:
+        events, trace_local.events = trace_local.events, None
+        write_trace(path, events)
+
+
+def write_trace(path, events):
+    """Appends events in the JSON array format, whose closing bracket is optional."""
+    if not path or not events:
+        return
+    with trace_lock, file_lock(path):
+        with open(path, "a") as f:
+            if f.tell() == 0:
+                f.write("[\n")
+            for ev in events:
+                f.write(json.dumps(ev) + ",\n")
+
+
+def sample_stacks(seconds, interval):
+    """Samples every other thread's stack; returns {folded stack: samples}."""
+    me = threading.get_ident()
+    counts = {}
+    end = time.time() + seconds
+    while time.time() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(tid, str(tid)))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return counts
+
+
+def run_profile(chat_id, seconds):
+    try:
+        counts = sample_stacks(seconds, PROFILE_INTERVAL_MS / 1000)
+        path = f"profile-{int(time.time())}.folded"
+        with open(path, "w") as f:
+            for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+                f.write(f"{stack} {n}\n")
+        send_document(chat_id, path, f"{sum(counts.values())} samples over {seconds}s (pid {os.getpid()})")
+    finally:
+        profile_lock.release()
+
+
+def finish_trace(chat_id, path, until):
+    time.sleep(max(until - time.time(), 0) + 1)
+    if trace_window.get("file") == path and os.path.exists(path):
+        send_document(chat_id, path, "Trace window closed")
+    elif not os.path.exists(path):
+        send_message(chat_id, "Trace window closed, no updates were traced.")
+
 
 # ---------- RPC Failover ----------
 RPC_LIST = [
@@ -44,22 +183,399 @@ RPC_LIST = [
 RPC_LIST = [r for r in RPC_LIST if r]
 
 
+ACTIVE_RPC_URL = None
+
+# ---------- Coalescing JSON-RPC provider ----------
+# web3 calls made within RPC_COALESCE_MS of each other leave as one JSON-RPC batch
+# over a pooled keep-alive session, and every caller gets its own response back.
+# Calls a node refuses as part of a batch are retried on their own.
+RPC_COALESCE_MS = float(os.getenv("RPC_COALESCE_MS", "2"))
+RPC_COALESCE_MAX = int(os.getenv("RPC_COALESCE_MAX", "50"))  # calls per coalesced batch
+RPC_POOL_SIZE = int(os.getenv("RPC_POOL_SIZE", "32"))
+RPC_TIMEOUT = 8
+
+rpc_stats_lock = threading.Lock()
+rpc_stats = {"calls": 0, "http_requests": 0, "http_ms": 0.0, "coalesced": 0, "split_retries": 0}
+
+
+def make_rpc_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=RPC_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def post_rpc(session, url, payload, timeout):
+    """POSTs one JSON-RPC request or batch and counts it in rpc_stats."""
+    started = time.perf_counter()
+    try:
+        return session.post(url, json=payload, timeout=timeout).json()
+    finally:
+        with rpc_stats_lock:
+            rpc_stats["http_requests"] += 1
+            rpc_stats["http_ms"] += (time.perf_counter() - started) * 1000
+
+
+def _is_batch_rejection(error):
+    """Errors about the batch itself (size, rate, format), as opposed to the call failing."""
+    if not isinstance(error, dict):
+        return True
+    # -32600 invalid request (batch not accepted), -32005 request limit exceeded
+    return error.get("code") in (-32600, -32005) or "batch" in str(error.get("message", "")).lower()
+
+
+class CoalescingHTTPProvider(JSONBaseProvider):
+    def __init__(self, endpoint_uri, window_ms=RPC_COALESCE_MS, max_batch=RPC_COALESCE_MAX, timeout=RPC_TIMEOUT):
+        super().__init__()
+        self.endpoint_uri = endpoint_uri
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.session = make_rpc_session()
+        self.cond = threading.Condition()
+        self.queue = []
+        self.closed = False
+        self.sender = ThreadPoolExecutor(max_workers=RPC_POOL_SIZE)
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def close(self):
+        """Stops the collector thread and the sender pool; calls already queued are dropped."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.sender.shutdown(wait=False)
+        self.session.close()
+
+    def __str__(self):
+        return f"Coalescing RPC connection {self.endpoint_uri}"
+
+    def make_request(self, method, params):
+        item = {"method": method, "params": params, "done": threading.Event(), "response": None}
+        with rpc_stats_lock:
+            rpc_stats["calls"] += 1
+        with span(method, "rpc"):
+            with self.cond:
+                self.queue.append(item)
+                self.cond.notify()
+            if not item["done"].wait(self.timeout * 2):
+                raise TimeoutError(f"{method} timed out")
+        if isinstance(item["response"], Exception):
+            raise item["response"]
+        return item["response"]
+
+    def _collect(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            time.sleep(self.window)
+            with self.cond:
+                batch, self.queue = self.queue, []
+            for i in range(0, len(batch), self.max_batch):
+                self.sender.submit(self._send, batch[i : i + self.max_batch])
+
+    def _deliver(self, item, response):
+        item["response"] = response
+        item["done"].set()
+
+    def _send(self, items):
+        payload = [
+            {"jsonrpc": "2.0", "id": i, "method": item["method"], "params": item["params"]}
+            for i, item in enumerate(items)
+        ]
+        try:
+            resp = post_rpc(self.session, self.endpoint_uri, payload if len(items) > 1 else payload[0], self.timeout)
+        except Exception as e:
+            if len(items) == 1:
+                self._deliver(items[0], e)
+                return
+            resp = None
+        if len(items) == 1:
+            self._deliver(items[0], resp)
+            return
+
+        retry = items
+        if isinstance(resp, list):
+            by_id = {r.get("id"): r for r in resp}
+            retry = []
+            for i, item in enumerate(items):
+                r = by_id.get(i)
+                if r is None or ("error" in r and _is_batch_rejection(r["error"])):
+                    retry.append(item)
+                else:
+                    self._deliver(item, r)
+        with rpc_stats_lock:
+            rpc_stats["coalesced"] += len(items) - len(retry)
+            rpc_stats["split_retries"] += len(retry)
+        for item in retry:
+            self.sender.submit(self._send, [item])
+
+
+def rpc_stats_line():
+    with rpc_stats_lock:
+        st = dict(rpc_stats)
+    avg = st["http_ms"] / st["http_requests"] if st["http_requests"] else 0
+    return (
+        f"{st['calls']} web3 calls, {st['http_requests']} HTTP requests (avg {avg:.0f} ms), "
+        f"{st['coalesced']} coalesced, {st['split_retries']} split retries"
+    )
+
+
 def get_web3():
+    global ACTIVE_RPC_URL
     last_err = None
     for url in RPC_LIST:
+        provider = CoalescingHTTPProvider(url)
         try:
-            w3_local = Web3(Web3.HTTPProvider(url, request_kwargs={"timeout": 8}))
+            w3_local = Web3(provider)
             if w3_local.is_connected():
                 print("Using RPC:", url)
+                ACTIVE_RPC_URL = url
                 return w3_local
         except Exception as e:
             last_err = e
             print("RPC failed:", url, e)
+        provider.close()
     raise Exception(f"No working BSC RPC. Last error: {last_err}")
 
 
 w3 = get_web3()
 
+# ---------- Raw JSON-RPC helpers ----------
+# Used by the background indexers, which work on plain hex log/receipt dicts
+# and send many requests per cycle.
+rpc_session = make_rpc_session()
+
+
+def rpc_call(method, params):
+    payload = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+    with span(method, "rpc"):
+        resp = post_rpc(rpc_session, ACTIVE_RPC_URL, payload, 30)
+    if "error" in resp:
+        raise Exception(f"{method} failed: {resp['error'].get('message', resp['error'])}")
+    return resp.get("result")
+
+
+def rpc_batch(calls):
+    """
+    Sends [(method, params), ...] as one JSON-RPC batch.
+    Returns the response objects in call order ({"result": ...} or {"error": ...}).
+    """
+    if not calls:
+        return []
+    payload = [
+        {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+        for i, (method, params) in enumerate(calls)
+    ]
+    with span("batch", "rpc", calls=len(calls)):
+        resp = post_rpc(rpc_session, ACTIVE_RPC_URL, payload, 30)
+    if isinstance(resp, dict):
+        # whole batch rejected (some nodes refuse batches or cap their size)
+        return [{"error": resp.get("error", resp)} for _ in calls]
+    by_id = {item.get("id"): item for item in resp}
+    return [by_id.get(i, {"error": {"message": "missing response"}}) for i in range(len(calls))]
+
+
+RPC_BATCH_SIZE = int(os.getenv("RPC_BATCH_SIZE", "100"))  # many public nodes cap batch length
+
+
+def rpc_batch_chunked(calls, size=RPC_BATCH_SIZE):
+    out = []
+    for i in range(0, len(calls), size):
+        out.extend(rpc_batch(calls[i : i + size]))
+    return out
+
+
+LOG_CHUNK_BLOCKS = int(os.getenv("LOG_CHUNK_BLOCKS", "5000"))
+
+
+def scan_logs(address, topics, from_block, to_block, on_logs, chunk=LOG_CHUNK_BLOCKS):
+    """
+    Walks [from_block, to_block] in eth_getLogs chunks, calling on_logs(logs, chunk_end)
+    after each one so callers can checkpoint. Chunks are halved when the node
+    refuses a range (too many results / range too large) and grown back afterwards.
+    """
+    start = from_block
+    size = chunk
+    while start <= to_block:
+        end = min(start + size - 1, to_block)
+        flt = {"fromBlock": hex(start), "toBlock": hex(end), "topics": topics}
+        if address:
+            flt["address"] = address
+        try:
+            logs = rpc_call("eth_getLogs", [flt])
+        except Exception as e:
+            if size > 1:
+                size = max(size // 2, 1)
+                continue
+            raise e
+        on_logs(logs or [], end)
+        start = end + 1
+        if size < chunk:
+            size = min(size * 2, chunk)
+
+
+def topic_to_address(topic):
+    return Web3.to_checksum_address("0x" + topic[-40:])
+
+
+def address_to_topic(address):
+    return "0x" + "0" * 24 + address[2:].lower()
+
+
+# ---------- Transaction broadcast ----------
+# Every signed transaction goes to all broadcast endpoints at once (the failover
+# RPCs plus optional private relays). The first endpoint to accept wins; the
+# inclusion tracker then times broadcast -> receipt for every endpoint that
+# accepted the transaction, so endpoints can be ranked.
+def _env_list(name):
+    return [x.strip() for x in os.getenv(name, "").split(",") if x.strip()]
+
+
+BROADCAST_RPCS = list(dict.fromkeys(_env_list("BROADCAST_RPCS") or RPC_LIST))
+PRIVATE_RELAY_RPCS = _env_list("PRIVATE_RELAY_RPCS")
+BROADCAST_ENDPOINTS = BROADCAST_RPCS + [r for r in PRIVATE_RELAY_RPCS if r not in BROADCAST_RPCS]
+BROADCAST_TIMEOUT_SEC = float(os.getenv("BROADCAST_TIMEOUT_SEC", "10"))
+BROADCAST_TRACK_SEC = float(os.getenv("BROADCAST_TRACK_SEC", "1"))
+BROADCAST_TRACK_MAX_SEC = 600
+ALREADY_KNOWN_ERRORS = ("already known", "known transaction", "already exists", "alreadyknown")
+
+broadcast_pool = ThreadPoolExecutor(max_workers=max(len(BROADCAST_ENDPOINTS) * 2, 4))
+broadcast_lock = threading.Lock()
+endpoint_stats = {
+    url: {"sent": 0, "accepted": 0, "errors": 0, "first": 0, "accept_ms": 0.0, "landed": 0, "land_ms": 0.0}
+    for url in BROADCAST_ENDPOINTS
+}
+broadcast_pending = {}  # tx hash -> {"sent_at", "first", "accepted": set of endpoints}
+
+
+def _is_accepted(resp):
+    if "result" in resp and resp["result"]:
+        return True
+    msg = str(resp.get("error", {}).get("message", "")).lower()
+    return any(k in msg for k in ALREADY_KNOWN_ERRORS)
+
+
+def _send_to_endpoint(url, raws, offset):
+    started = time.perf_counter()
+    payload = [
+        {"jsonrpc": "2.0", "id": i, "method": "eth_sendRawTransaction", "params": [raw]}
+        for i, raw in enumerate(raws)
+    ]
+    try:
+        resp = post_rpc(rpc_session, url, payload, BROADCAST_TIMEOUT_SEC)
+        if isinstance(resp, dict):
+            resps = [resp] * len(raws)
+        else:
+            by_id = {item.get("id"): item for item in resp}
+            resps = [by_id.get(i, {"error": {"message": "missing response"}}) for i in range(len(raws))]
+    except Exception as e:
+        resps = [{"error": {"message": str(e)}}] * len(raws)
+    return url, offset, resps, (time.perf_counter() - started) * 1000
+
+
+def broadcast_raw_txs(raws):
+    """
+    Sends signed transactions to every broadcast endpoint in parallel.
+    Returns the hash per transaction (None if no endpoint accepted it) as soon as
+    each has an acceptor; slower endpoints finish in the background.
+    """
+    raws = [raw if isinstance(raw, str) else Web3.to_hex(raw) for raw in raws]
+    hashes = [Web3.to_hex(Web3.keccak(hexstr=raw)) for raw in raws]
+    sent_at = time.time()
+    accepted = [False] * len(raws)
+    errors = [None] * len(raws)
+    done = threading.Event()
+    chunks = [(off, raws[off : off + RPC_BATCH_SIZE]) for off in range(0, len(raws), RPC_BATCH_SIZE)]
+    remaining = [len(BROADCAST_ENDPOINTS) * len(chunks)]
+
+    def on_result(fut):
+        url, offset, resps, ms = fut.result()
+        with broadcast_lock:
+            st = endpoint_stats[url]
+            for i, resp in enumerate(resps, start=offset):
+                st["sent"] += 1
+                if not _is_accepted(resp):
+                    st["errors"] += 1
+                    errors[i] = errors[i] or resp.get("error")
+                    continue
+                st["accepted"] += 1
+                st["accept_ms"] += ms
+                if not accepted[i]:
+                    accepted[i] = True
+                    st["first"] += 1
+                    broadcast_pending[hashes[i]] = {"sent_at": sent_at, "first": url, "accepted": set()}
+                entry = broadcast_pending.get(hashes[i])
+                if entry is not None:
+                    entry["accepted"].add(url)
+            remaining[0] -= 1
+            if all(accepted) or remaining[0] == 0:
+                done.set()
+
+    with span("broadcast", "rpc", txs=len(raws)):
+        for url in BROADCAST_ENDPOINTS:
+            for offset, chunk in chunks:
+                broadcast_pool.submit(_send_to_endpoint, url, chunk, offset).add_done_callback(on_result)
+        done.wait(BROADCAST_TIMEOUT_SEC + 1)
+
+    with broadcast_lock:
+        result = [h if ok else None for h, ok in zip(hashes, accepted)]
+    for h, err in zip(result, errors):
+        if h is None:
+            print("Broadcast rejected by all endpoints:", err)
+    return result
+
+
+def broadcast_raw_tx(raw):
+    tx_hash = broadcast_raw_txs([raw])[0]
+    if tx_hash is None:
+        raise Exception("Transaction rejected by all broadcast endpoints")
+    return tx_hash
+
+
+def track_inclusions():
+    with broadcast_lock:
+        items = list(broadcast_pending.items())
+    if not items:
+        return
+    resps = rpc_batch_chunked([("eth_getTransactionReceipt", [h]) for h, _ in items])
+    now = time.time()
+    with broadcast_lock:
+        for (h, entry), resp in zip(items, resps):
+            if resp.get("result"):
+                for url in entry["accepted"]:
+                    st = endpoint_stats[url]
+                    st["landed"] += 1
+                    st["land_ms"] += (now - entry["sent_at"]) * 1000
+                broadcast_pending.pop(h, None)
+            elif now - entry["sent_at"] > BROADCAST_TRACK_MAX_SEC:
+                broadcast_pending.pop(h, None)
+
+
+def inclusion_worker():
+    while True:
+        try:
+            track_inclusions()
+        except Exception as e:
+            print("Inclusion tracker error:", e)
+        time.sleep(BROADCAST_TRACK_SEC)
+
+
+def endpoint_ranking():
+    """Endpoints ordered by average broadcast -> inclusion time of the transactions they accepted."""
+    rows = []
+    with broadcast_lock:
+        for url, st in endpoint_stats.items():
+            land = st["land_ms"] / st["landed"] if st["landed"] else None
+            accept = st["accept_ms"] / st["accepted"] if st["accepted"] else None
+            rows.append((url, st["first"], st["landed"], land, accept, st["errors"]))
+    rows.sort(key=lambda r: (r[3] is None, r[3] or 0, -r[1]))
+    return rows
+
+
 # PancakeSwap V2 Router + WBNB + BUSD (mainnet addresses)
 PANCAKE_ROUTER = Web3.to_checksum_address("0x10ED43C718714eb63d5aA57B78B54704E256024E")
 WBNB = Web3.to_checksum_address("0xBB4CdB9CBd36B01bD1cBaEBF2De08d9173bc095c")
@@ -67,149 +583,228 @@ BUSD = Web3.to_checksum_address("0xe9e7cea3dedca5984780bafc599bd69add087d56")
 USDT = Web3.to_checksum_address("0x55d398326f99059fF77548524699939b09a8Cb00")
 USDC = Web3.to_checksum_address("0x8AC76a51cc950d9822D68b83fE1Ad97b32Cd580d")
 
-# Router ABI (used only for price quoting)
-ROUTER_ABI = [
-    {
-        "inputs": [
-            {"internalType": "uint256", "name": "amountIn", "type": "uint256"},
-            {"internalType": "address[]", "name": "path", "type": "address[]"},
-        ],
-        "name": "getAmountsOut",
-        "outputs": [{"internalType": "uint256[]", "name": "amounts", "type": "uint256[]"}],
-        "stateMutability": "view",
-        "type": "function",
-    }
-]
+print("Connected to BSC")
 
-router = w3.eth.contract(address=PANCAKE_ROUTER, abi=ROUTER_ABI)
+WRAPPER_ADDRESS = Web3.to_checksum_address(WRAPPER_ADDRESS)
 
-print("Connected to BSC & router ready")
+# ---------- Fast ABI codec ----------
+# The few calls the bot makes all the time, encoded and decoded by hand: call
+# data is the selector followed by 32-byte words (dynamic address[] arguments go
+# after the head, which holds their offset), and results are sliced out of the
+# returned hex. eth_calls go straight to the provider, so they still coalesce
+# but skip contract objects, ABI lookups and web3's result formatters.
+# bench_abi.py measures both paths; the web3 side of the comparison lives there.
+def abi_selector(signature):
+    return Web3.to_hex(Web3.keccak(text=signature))[:10]
 
-# ---------- Wrapper ABI (minimal) ----------
-WRAPPER_ADDRESS = Web3.to_checksum_address(WRAPPER_ADDRESS)
-WRAPPER_ABI = [
-    {
-        "inputs": [
-            {"internalType": "uint256", "name": "amountOutMin", "type": "uint256"},
-            {"internalType": "address[]", "name": "path", "type": "address[]"},
-            {"internalType": "address", "name": "to", "type": "address"},
-            {"internalType": "uint256", "name": "deadline", "type": "uint256"},
-        ],
-        "name": "swapExactETHForTokensSupportingFeeOnTransferTokens",
-        "outputs": [],
-        "stateMutability": "payable",
-        "type": "function",
-    },
-    {
-        "inputs": [
-            {"internalType": "uint256", "name": "amountIn", "type": "uint256"},
-            {"internalType": "uint256", "name": "amountOutMin", "type": "uint256"},
-            {"internalType": "address[]", "name": "path", "type": "address[]"},
-            {"internalType": "address", "name": "to", "type": "address"},
-            {"internalType": "uint256", "name": "deadline", "type": "uint256"},
-        ],
-        "name": "swapExactTokensForETHSupportingFeeOnTransferTokens",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function",
-    },
-    {
-        "inputs": [
-            {"internalType": "uint256", "name": "amountIn", "type": "uint256"},
-            {"internalType": "uint256", "name": "amountOutMin", "type": "uint256"},
-            {"internalType": "address[]", "name": "path", "type": "address[]"},
-            {"internalType": "address", "name": "to", "type": "address"},
-            {"internalType": "uint256", "name": "deadline", "type": "uint256"},
-        ],
-        "name": "swapExactTokensForTokensSupportingFeeOnTransferTokens",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function",
-    },
-]
 
-wrapper = w3.eth.contract(address=WRAPPER_ADDRESS, abi=WRAPPER_ABI)
-
-# ---------- Updated ERC20 ABI (includes optional fee getters) ----------
-ERC20_ABI = [
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "decimals",
-        "outputs": [{"name": "", "type": "uint8"}],
-        "type": "function",
-    },
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "symbol",
-        "outputs": [{"name": "", "type": "string"}],
-        "type": "function",
-    },
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "totalSupply",
-        "outputs": [{"name": "", "type": "uint256"}],
-        "type": "function",
-    },
-    {
-        "constant": True,
-        "inputs": [{"name": "owner", "type": "address"}],
-        "name": "balanceOf",
-        "outputs": [{"name": "balance", "type": "uint256"}],
-        "type": "function",
-    },
-    {
-        "constant": True,
-        "inputs": [
-            {"name": "owner", "type": "address"},
-            {"name": "spender", "type": "address"},
-        ],
-        "name": "allowance",
-        "outputs": [{"name": "remaining", "type": "uint256"}],
-        "type": "function",
-    },
-    {
-        "constant": False,
-        "inputs": [
-            {"name": "spender", "type": "address"},
-            {"name": "value", "type": "uint256"},
-        ],
-        "name": "approve",
-        "outputs": [{"name": "success", "type": "bool"}],
-        "type": "function",
-    },
-    # fee-related getters (optional)
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "feeBasisPoints",
-        "outputs": [{"name": "", "type": "uint256"}],
-        "type": "function",
-    },
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "feeReceiver",
-        "outputs": [{"name": "", "type": "address"}],
-        "type": "function",
-    },
-    {
-        "constant": True,
-        "inputs": [{"name": "account", "type": "address"}],
-        "name": "isExcludedFromFee",
-        "outputs": [{"name": "", "type": "bool"}],
-        "type": "function",
-    },
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "feePercentTimes100",
-        "outputs": [{"name": "", "type": "uint256"}],
-        "type": "function",
-    },
-]
+GET_AMOUNTS_OUT_SELECTOR = abi_selector("getAmountsOut(uint256,address[])")
+GET_RESERVES_SELECTOR = abi_selector("getReserves()")
+DECIMALS_SELECTOR = abi_selector("decimals()")
+SYMBOL_SELECTOR = abi_selector("symbol()")
+TOTAL_SUPPLY_SELECTOR = abi_selector("totalSupply()")
+BALANCE_OF_SELECTOR = abi_selector("balanceOf(address)")
+ALLOWANCE_SELECTOR = abi_selector("allowance(address,address)")
+APPROVE_SELECTOR = abi_selector("approve(address,uint256)")
+SWAP_ETH_FOR_TOKENS_SELECTOR = abi_selector(
+    "swapExactETHForTokensSupportingFeeOnTransferTokens(uint256,address[],address,uint256)"
+)
+SWAP_TOKENS_FOR_ETH_SELECTOR = abi_selector(
+    "swapExactTokensForETHSupportingFeeOnTransferTokens(uint256,uint256,address[],address,uint256)"
+)
+# optional fee getters some tokens (and the wrapper) expose
+FEE_BASIS_POINTS_SELECTOR = abi_selector("feeBasisPoints()")
+FEE_PERCENT_TIMES100_SELECTOR = abi_selector("feePercentTimes100()")
+FEE_RECEIVER_SELECTOR = abi_selector("feeReceiver()")
+
+
+def abi_uint(value):
+    if not 0 <= value < 2**256:
+        raise Exception(f"uint256 out of range: {value}")
+    return format(value, "064x")
+
+
+def abi_address(address):
+    return "0" * 24 + address[2:].lower()
+
+
+def abi_address_array(addresses):
+    return abi_uint(len(addresses)) + "".join("0" * 24 + a[2:].lower() for a in addresses)
+
+
+def encode_get_amounts_out(amount_in, path):
+    return GET_AMOUNTS_OUT_SELECTOR + abi_uint(amount_in) + abi_uint(2 * 32) + abi_address_array(path)
+
+
+def encode_balance_of(owner):
+    return BALANCE_OF_SELECTOR + abi_address(owner)
+
+
+def encode_allowance(owner, spender=WRAPPER_ADDRESS):
+    return ALLOWANCE_SELECTOR + abi_address(owner) + abi_address(spender)
+
+
+def encode_approve(spender, amount):
+    return APPROVE_SELECTOR + abi_address(spender) + abi_uint(amount)
+
+
+def encode_swap_eth_for_tokens(amount_out_min, path, to, deadline):
+    return (
+        SWAP_ETH_FOR_TOKENS_SELECTOR
+        + abi_uint(amount_out_min)
+        + abi_uint(4 * 32)
+        + abi_address(to)
+        + abi_uint(deadline)
+        + abi_address_array(path)
+    )
+
+
+def encode_swap_tokens_for_eth(amount_in, amount_out_min, path, to, deadline):
+    return (
+        SWAP_TOKENS_FOR_ETH_SELECTOR
+        + abi_uint(amount_in)
+        + abi_uint(amount_out_min)
+        + abi_uint(5 * 32)
+        + abi_address(to)
+        + abi_uint(deadline)
+        + abi_address_array(path)
+    )
+
+
+def _result_body(raw, words):
+    """The hex after 0x, checked to hold at least `words` words. Empty data means no contract answered."""
+    if not raw or len(raw) < 2 + 64 * words:
+        raise Exception("Call returned no data (not a contract, or it reverted)")
+    return raw[2:]
+
+
+def decode_uint(raw):
+    return int(_result_body(raw, 1)[:64], 16)
+
+
+def decode_uint_array(raw):
+    body = _result_body(raw, 2)
+    start = int(body[:64], 16) * 2
+    count = int(body[start : start + 64], 16)
+    start += 64
+    if len(body) < start + 64 * count:
+        raise Exception("Call returned a truncated array")
+    return [int(body[i : i + 64], 16) for i in range(start, start + 64 * count, 64)]
+
+
+def decode_address(raw):
+    return Web3.to_checksum_address("0x" + _result_body(raw, 1)[24:64])
+
+
+def decode_string(raw):
+    body = _result_body(raw, 1)
+    if len(body) == 64:
+        # pre-standard tokens return symbol() as bytes32
+        return bytes.fromhex(body).rstrip(b"\0").decode("utf-8", "replace")
+    start = int(body[:64], 16) * 2
+    length = int(body[start : start + 64], 16)
+    return bytes.fromhex(body[start + 64 : start + 64 + 2 * length]).decode("utf-8", "replace")
+
+
+def decode_reserves(raw):
+    """(reserve0, reserve1) from a getReserves() result, or None when the pair did not answer."""
+    if not raw or len(raw) < 130:
+        return None
+    return int(raw[2:66], 16), int(raw[66:130], 16)
+
+
+def eth_call(to, data, block="latest"):
+    resp = w3.provider.make_request("eth_call", [{"to": to, "data": data}, block])
+    if "error" in resp:
+        raise Exception(f"eth_call failed: {resp['error'].get('message', resp['error'])}")
+    return resp.get("result")
+
+
+def get_amounts_out(amount_in, path):
+    return decode_uint_array(eth_call(PANCAKE_ROUTER, encode_get_amounts_out(amount_in, path)))
+
+
+def call_decimals(token_address):
+    return decode_uint(eth_call(token_address, DECIMALS_SELECTOR))
+
+
+def call_symbol(token_address):
+    return decode_string(eth_call(token_address, SYMBOL_SELECTOR))
+
+
+def call_total_supply(token_address):
+    return decode_uint(eth_call(token_address, TOTAL_SUPPLY_SELECTOR))
+
+
+def call_balance_of(token_address, owner):
+    return decode_uint(eth_call(token_address, encode_balance_of(owner)))
+
+
+def call_allowance(token_address, owner, spender=WRAPPER_ADDRESS):
+    return decode_uint(eth_call(token_address, encode_allowance(owner, spender)))
+
+
+def call_token_fee(token_address):
+    """
+    (fee in basis points, fee receiver) from a token's optional fee getters, all
+    three asked in one batch; (None, None) when it exposes neither fee getter.
+    """
+    selectors = (FEE_BASIS_POINTS_SELECTOR, FEE_PERCENT_TIMES100_SELECTOR, FEE_RECEIVER_SELECTOR)
+    resps = rpc_batch([("eth_call", [{"to": token_address, "data": sel}, "latest"]) for sel in selectors])
+
+    def value(resp, decode):
+        try:
+            return decode(resp.get("result"))
+        except Exception:
+            return None
+
+    fee_bp = value(resps[0], decode_uint)
+    if fee_bp is None:
+        fee_bp = value(resps[1], decode_uint)
+    if fee_bp is None:
+        return None, None
+    return fee_bp, value(resps[2], decode_address)
+
+
+# ---------- Shard ownership ----------
+# In sharded mode (SHARD_WORKERS > 0) one intake process routes each update to
+# a worker process chosen by hashing the user id. A worker owns its users'
+# conversation state, signers and file writes; files shared between workers
+# are merged or appended under an exclusive file lock.
+SHARD = {"role": "single", "index": 0, "count": 0}
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+shard_queues = []  # one update queue per worker, so workers can reach each other
+shared_store = None  # multiprocessing.Manager dicts shared by all processes in sharded mode
+
+
+def shard_of(user_id, count):
+    return zlib.crc32(str(user_id).encode()) % count
+
+
+def owns_user(user_id):
+    return SHARD["role"] != "worker" or shard_of(user_id, SHARD["count"]) == SHARD["index"]
+
+
+def shard_path(path):
+    """Per-shard variant of a data file (fills.json -> fills.2of4.json) for files only one worker writes."""
+    if SHARD["role"] != "worker":
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{SHARD['index']}of{SHARD['count']}{ext}"
+
+
+@contextmanager
+def file_lock(path):
+    if fcntl is None or SHARD["count"] == 0:
+        yield
+        return
+    with open(path + ".lock", "a") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
 
 # ---------- User storage ----------
 USERS_FILE = "users.json"
@@ -225,18 +820,173 @@ def load_users():
         return {}
 
 
+users_lock = threading.RLock()
+
+
 def save_users(users_dict):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users_dict, f, indent=2)
+    with users_lock:
+        if SHARD["role"] != "worker":
+            with open(USERS_FILE, "w") as f:
+                json.dump(users_dict, f, indent=2)
+            return
+        # sharded: rewrite only the users this worker owns, pick up everyone else's latest
+        with file_lock(USERS_FILE):
+            merged = {uid: p for uid, p in load_users().items() if not owns_user(uid)}
+            for uid, p in merged.items():
+                users_dict[uid] = p
+            merged.update({uid: p for uid, p in users_dict.items() if owns_user(uid)})
+            tmp = USERS_FILE + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(merged, f, indent=2)
+            os.replace(tmp, USERS_FILE)
+
+
+users = {}  # filled by load_state()
+
+# ---------- Conversation state ----------
+# Every step has a TTL so abandoned flows expire, the store is bounded with LRU
+# eviction, and with STATE_PERSIST_DIR set it survives restarts.
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))
+STATE_PERSIST_DIR = os.getenv("STATE_PERSIST_DIR")  # unset: conversation state is memory-only
+MAX_QUOTE_AGE_BLOCKS = int(os.getenv("MAX_QUOTE_AGE_BLOCKS", "20"))
+DEFAULT_STATE_TTL = 900
+STATE_TTLS = {
+    "await_pk": 300,
+    "await_buy_token": 900,
+    "await_sell_token": 900,
+    "await_buy_proceed": 900,
+    "await_sell_proceed": 900,
+    "await_buy_amount": 900,
+    "await_sell_amount": 900,
+    # pending trades, keyed by type
+    "buy": 300,
+    "sell": 300,
+}
+
+
+class ConversationStore:
+    """
+    Per-user state with a TTL per step, LRU eviction beyond max_entries and
+    optional JSON persistence. Dict-like for the handlers (get / [] = / pop / in);
+    values are replaced, not mutated, so TTL and persistence follow each step.
+    """
+
+    def __init__(self, name, max_entries=STATE_MAX_ENTRIES):
+        self.name = name
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # user id -> (expires_at, value)
+        self.dirty = False
+        self.expired = 0
+        self.evicted = 0
+
+    def _path(self):
+        return shard_path(os.path.join(STATE_PERSIST_DIR, f"{self.name}.json"))
+
+    def _ttl(self, value):
+        return STATE_TTLS.get(value.get("step") or value.get("type"), DEFAULT_STATE_TTL)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return default
+            if item[0] < time.time():
+                del self.entries[key]
+                self.expired += 1
+                self.dirty = True
+                return default
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self._ttl(value), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+            self.dirty = True
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                return default
+            self.dirty = True
+            return item[1] if item[0] >= time.time() else default
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            stale = [k for k, (expires, _) in self.entries.items() if expires < now]
+            for k in stale:
+                del self.entries[k]
+            if stale:
+                self.expired += len(stale)
+                self.dirty = True
+
+    def load(self):
+        if not STATE_PERSIST_DIR or not os.path.exists(self._path()):
+            return
+        try:
+            with open(self._path(), "r") as f:
+                saved = json.load(f)
+        except Exception as e:
+            print(f"State file {self.name} unreadable:", e)
+            return
+        with self.lock:
+            self.entries.clear()
+            for key, (expires, value) in saved.items():
+                self.entries[int(key)] = (expires, value)
+        self.sweep()
+
+    def flush(self):
+        if not STATE_PERSIST_DIR or not self.dirty:
+            return
+        with self.lock:
+            data = json.dumps({str(k): [exp, v] for k, (exp, v) in self.entries.items()})
+            self.dirty = False
+        os.makedirs(STATE_PERSIST_DIR, exist_ok=True)
+        path = self._path()
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+user_states = ConversationStore("user_states")
+pending_trades = ConversationStore("pending_trades")
+
+
+def state_worker():
+    ticks = 0
+    while True:
+        time.sleep(1)
+        ticks += 1
+        try:
+            if ticks % 30 == 0:
+                user_states.sweep()
+                pending_trades.sweep()
+            user_states.flush()
+            pending_trades.flush()
+        except Exception as e:
+            print("State flush error:", e)
 
 
-users = load_users()
+def quote_age_blocks(trade):
+    """Blocks since the pending trade was quoted (None for trades without a quote block)."""
+    if "quote_block" not in trade:
+        return None
+    return head_block() - trade["quote_block"]
 
-# in-memory state
-user_states = {}
-pending_trades = {}
 
 # ---------- helpers for user profile ----------
+account_cache = {}  # private key -> LocalAccount, key derivation is not free
+
+
 def ensure_profile(user_id):
     uid = str(user_id)
     if uid not in users:
@@ -249,14 +999,49 @@ def ensure_profile(user_id):
     return profile
 
 
-def get_user_account(user_id):
+def _account(pk):
+    acct = account_cache.get(pk)
+    if acct is None:
+        acct = w3.eth.account.from_key(pk)
+        account_cache[pk] = acct
+    return acct
+
+
+def get_user_account(user_id, address=None):
+    """(account, key) of the user's primary wallet, or of the user's wallet at address."""
     uid = str(user_id)
     if uid not in users:
         return None, None
+    if address is not None:
+        for acct, pk in user_wallets(user_id):
+            if acct.address.lower() == address.lower():
+                return acct, pk
+        return None, None
+    pk = ensure_profile(user_id)["private_key"]
+    return _account(pk), pk
+
+
+def user_wallets(user_id):
+    """[(account, key)] of every wallet of the user, primary first."""
     profile = ensure_profile(user_id)
-    pk = profile["private_key"]
-    acct = w3.eth.account.from_key(pk)
-    return acct, pk
+    if not profile:
+        return []
+    keys = [profile["private_key"]] + [w["private_key"] for w in profile.get("wallets", [])]
+    return [(_account(pk), pk) for pk in keys]
+
+
+def active_wallets(user_id):
+    """The wallets trades run on; the primary wallet alone unless the user picked a set."""
+    wallets = user_wallets(user_id)
+    chosen = {a.lower() for a in ensure_profile(user_id).get("active_wallets", [])} if wallets else set()
+    active = [(acct, pk) for acct, pk in wallets if acct.address.lower() in chosen]
+    return active or wallets[:1]
+
+
+def trades_on_primary(user_id):
+    """True when the primary wallet is the only active one, so a trade can take the single-wallet path."""
+    active = active_wallets(user_id)
+    return len(active) == 1 and active[0][0].address == get_user_account(user_id)[0].address
 
 
 def get_user_settings(user_id):
@@ -276,7 +1061,23 @@ def get_user_positions(user_id):
 # ---------- Telegram helpers ----------
 def send_request(method, payload):
     try:
-        r = requests.post(f"{TG_BASE_URL}/{method}", json=payload, timeout=30)
+        with span(method, "telegram"):
+            r = requests.post(f"{TG_BASE_URL}/{method}", json=payload, timeout=30)
+        return r.json()
+    except Exception as e:
+        print("Telegram error:", e)
+        return None
+
+
+def send_document(chat_id, path, caption=""):
+    try:
+        with open(path, "rb") as f:
+            r = requests.post(
+                f"{TG_BASE_URL}/sendDocument",
+                data={"chat_id": chat_id, "caption": caption},
+                files={"document": (os.path.basename(path), f)},
+                timeout=60,
+            )
         return r.json()
     except Exception as e:
         print("Telegram error:", e)
@@ -313,6 +1114,10 @@ def get_main_menu(has_wallet: bool):
                 {"text": "📊 Portfolio", "callback_data": "portfolio"},
                 {"text": "⚙ Settings", "callback_data": "settings"},
             ],
+            [
+                {"text": "📜 History", "callback_data": "history"},
+                {"text": "💰 PnL", "callback_data": "pnl"},
+            ],
             [
                 {"text": "❓ Help", "callback_data": "help"},
                 {"text": "🔐 Disconnect", "callback_data": "disconnect"},
@@ -326,18 +1131,23 @@ def get_main_menu(has_wallet: bool):
 
 
 # ---------- Web3 helpers ----------
-def get_token_contract(token_address: str):
-    return w3.eth.contract(
-        address=Web3.to_checksum_address(token_address),
-        abi=ERC20_ABI,
-    )
+token_meta_cache = {}  # token -> {"symbol", "decimals"}; both are immutable on-chain
+
+
+def get_token_meta(token_address: str):
+    token_address = Web3.to_checksum_address(token_address)
+    meta = token_meta_cache.get(token_address)
+    if meta is None:
+        meta = {"symbol": call_symbol(token_address), "decimals": call_decimals(token_address)}
+        token_meta_cache[token_address] = meta
+    return meta
 
 
 def get_bnb_price_usd():
     try:
         one_bnb = w3.to_wei(1, "ether")
         path = [WBNB, BUSD]
-        amounts = router.functions.getAmountsOut(one_bnb, path).call()
+        amounts = get_amounts_out(one_bnb, path)
         return amounts[-1] / (10**18)
     except Exception as e:
         print("BNB price error:", e)
@@ -364,8 +1174,9 @@ def format_number(value, decimals=4):
 
 def get_holders_count_from_bscscan(token_address: str):
     try:
-        url = f"https://bscscan.com/token/{token_address}"
-        resp = requests.get(url, timeout=15)
+        url = f"{BSCSCAN_URL}/token/{token_address}"
+        with span("bscscan holders", "http"):
+            resp = requests.get(url, timeout=15)
         if resp.status_code != 200:
             return "Unknown"
         m = re.search(r"Holders:\s*([\d,]+)", resp.text)
@@ -376,35 +1187,339 @@ def get_holders_count_from_bscscan(token_address: str):
     return "Unknown"
 
 
+# ---------- Pair index (factory PairCreated logs) ----------
+# Local index of every PancakeSwap V2 pair, so route discovery does not have to
+# probe getAmountsOut to learn whether a pair exists.
+#   pairs.log  append-only 60-byte records (token0, token1, pair) in scan order
+#   pairs.idx  sorted 60-byte records (token, other token, pair), two per pair,
+#              binary-searched through mmap; rebuilt from the log on compaction
+#   pairs.meta.json  checkpoint (last scanned block, record counts)
+PANCAKE_FACTORY = Web3.to_checksum_address("0xcA143Ce32Fe78f1f7019d7d551a6402fC5350c73")
+PANCAKE_FACTORY_START_BLOCK = 6809737
+PAIR_CREATED_TOPIC = Web3.to_hex(Web3.keccak(text="PairCreated(address,address,address,uint256)"))
+
+PAIR_INDEX_LOG = os.getenv("PAIR_INDEX_LOG", "pairs.log")
+PAIR_INDEX_IDX = os.getenv("PAIR_INDEX_IDX", "pairs.idx")
+PAIR_INDEX_META = os.getenv("PAIR_INDEX_META", "pairs.meta.json")
+PAIR_INDEX_POLL_SEC = float(os.getenv("PAIR_INDEX_POLL_SEC", "3"))
+PAIR_INDEX_MAX_LAG = int(os.getenv("PAIR_INDEX_MAX_LAG", "20"))  # blocks behind head still counted as synced
+PAIR_INDEX_COMPACT_MIN = 50_000
+PAIR_RECORD_SIZE = 60
+
+pair_index_lock = threading.Lock()
+pair_index_state = {
+    "last_block": PANCAKE_FACTORY_START_BLOCK - 1,
+    "records": 0,
+    "indexed_records": 0,
+    "head": 0,
+    "synced_at": 0.0,
+}
+pair_index_tail = {}  # token bytes -> {other token bytes: pair bytes}, records newer than pairs.idx
+pair_index_mmap = None
+
+
+def _save_pair_meta():
+    meta = {k: pair_index_state[k] for k in ("last_block", "records", "indexed_records", "head", "synced_at")}
+    tmp = PAIR_INDEX_META + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, PAIR_INDEX_META)
+
+
+def _open_pair_idx():
+    if not os.path.exists(PAIR_INDEX_IDX) or os.path.getsize(PAIR_INDEX_IDX) == 0:
+        return None
+    with open(PAIR_INDEX_IDX, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _add_to_tail(rec):
+    t0, t1, pair = rec[:20], rec[20:40], rec[40:60]
+    pair_index_tail.setdefault(t0, {})[t1] = pair
+    pair_index_tail.setdefault(t1, {})[t0] = pair
+
+
+def load_pair_index(readonly=False):
+    """readonly: worker processes only read the index the intake process writes."""
+    global pair_index_mmap
+    meta = {}
+    if os.path.exists(PAIR_INDEX_META):
+        try:
+            with open(PAIR_INDEX_META, "r") as f:
+                meta = json.load(f)
+        except Exception:
+            meta = {}
+    records = meta.get("records", 0)
+    indexed = meta.get("indexed_records", 0)
+    log_size = os.path.getsize(PAIR_INDEX_LOG) if os.path.exists(PAIR_INDEX_LOG) else 0
+
+    if readonly:
+        records = min(records, log_size // PAIR_RECORD_SIZE)
+    elif log_size < records * PAIR_RECORD_SIZE:
+        # log lost records the checkpoint promised: start over
+        print("Pair index inconsistent, rebuilding from scratch")
+        meta, records, indexed = {}, 0, 0
+        for path in (PAIR_INDEX_LOG, PAIR_INDEX_IDX):
+            if os.path.exists(path):
+                os.remove(path)
+    elif log_size > records * PAIR_RECORD_SIZE:
+        # records appended after the last checkpoint are rescanned, drop them
+        with open(PAIR_INDEX_LOG, "r+b") as f:
+            f.truncate(records * PAIR_RECORD_SIZE)
+
+    new_map = _open_pair_idx()
+    if indexed and new_map is None:
+        indexed = 0  # idx is derived from the log, rebuild it on next compaction
+
+    data = b""
+    if records > indexed:
+        with open(PAIR_INDEX_LOG, "rb") as f:
+            f.seek(indexed * PAIR_RECORD_SIZE)
+            data = f.read((records - indexed) * PAIR_RECORD_SIZE)
+    with pair_index_lock:
+        old_map, pair_index_mmap = pair_index_mmap, new_map
+        pair_index_tail.clear()
+        for off in range(0, len(data), PAIR_RECORD_SIZE):
+            _add_to_tail(data[off : off + PAIR_RECORD_SIZE])
+    if old_map is not None:
+        old_map.close()
+
+    pair_index_state["last_block"] = meta.get("last_block", PANCAKE_FACTORY_START_BLOCK - 1)
+    pair_index_state["records"] = records
+    pair_index_state["indexed_records"] = indexed
+    print(f"Pair index loaded: {records} pairs up to block {pair_index_state['last_block']}")
+
+
+def _idx_lookup(key):
+    mm = pair_index_mmap
+    if mm is None:
+        return {}
+    n = len(mm) // PAIR_RECORD_SIZE
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        off = mid * PAIR_RECORD_SIZE
+        if mm[off : off + 20] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    found = {}
+    while lo < n:
+        off = lo * PAIR_RECORD_SIZE
+        if mm[off : off + 20] != key:
+            break
+        found[mm[off + 20 : off + 40]] = mm[off + 40 : off + 60]
+        lo += 1
+    return found
+
+
+def _lookup_pairs_raw(token_address):
+    key = bytes.fromhex(token_address[2:])
+    with pair_index_lock:
+        found = _idx_lookup(key)
+        found.update(pair_index_tail.get(key, {}))
+    return found
+
+
+def find_pairs(token_address: str):
+    """All indexed pairs of a token as {other_token: pair_address}."""
+    found = _lookup_pairs_raw(Web3.to_checksum_address(token_address))
+    return {
+        Web3.to_checksum_address("0x" + other.hex()): Web3.to_checksum_address("0x" + pair.hex())
+        for other, pair in found.items()
+    }
+
+
+def get_pair_address(token_a: str, token_b: str):
+    """Pair address from the local index, or None if the index has no such pair."""
+    pair = _lookup_pairs_raw(Web3.to_checksum_address(token_a)).get(bytes.fromhex(token_b[2:]))
+    if pair is None:
+        return None
+    return Web3.to_checksum_address("0x" + pair.hex())
+
+
+def pair_index_ready():
+    """True when the index is close enough to head that a missing pair really is missing."""
+    st = pair_index_state
+    if st["head"] == 0 or time.time() - st["synced_at"] > 60:
+        return False
+    return st["last_block"] >= st["head"] - PAIR_INDEX_MAX_LAG
+
+
+def _compact_pair_index():
+    global pair_index_mmap
+    with pair_index_lock:
+        tail_items = sorted(
+            (key, other, pair) for key, others in pair_index_tail.items() for other, pair in others.items()
+        )
+        old = pair_index_mmap
+
+    def old_records():
+        if old is None:
+            return
+        for off in range(0, len(old), PAIR_RECORD_SIZE):
+            yield old[off : off + 20], old[off + 20 : off + 40], old[off + 40 : off + 60]
+
+    tmp = PAIR_INDEX_IDX + ".tmp"
+    with open(tmp, "wb") as f:
+        for key, other, pair in heapq.merge(old_records(), tail_items):
+            f.write(key + other + pair)
+    os.replace(tmp, PAIR_INDEX_IDX)
+    new_map = _open_pair_idx()
+    with pair_index_lock:
+        pair_index_mmap = new_map
+        pair_index_tail.clear()
+        pair_index_state["indexed_records"] = pair_index_state["records"]
+    _save_pair_meta()
+    if old is not None:
+        old.close()
+
+
+def _append_pair_logs(logs, end_block):
+    recs = []
+    for log in logs:
+        topics = log.get("topics", [])
+        if len(topics) < 3 or topics[0] != PAIR_CREATED_TOPIC:
+            continue
+        data = log["data"][2:]
+        recs.append(
+            bytes.fromhex(topics[1][-40:]) + bytes.fromhex(topics[2][-40:]) + bytes.fromhex(data[24:64])
+        )
+    if recs:
+        with open(PAIR_INDEX_LOG, "ab") as f:
+            f.write(b"".join(recs))
+            f.flush()
+            os.fsync(f.fileno())
+        with pair_index_lock:
+            for rec in recs:
+                _add_to_tail(rec)
+    pair_index_state["records"] += len(recs)
+    pair_index_state["last_block"] = end_block
+    _save_pair_meta()
+
+    pending = pair_index_state["records"] - pair_index_state["indexed_records"]
+    if pending >= max(PAIR_INDEX_COMPACT_MIN, pair_index_state["indexed_records"] // 4):
+        _compact_pair_index()
+
+
+def sync_pair_index():
+    head = w3.eth.block_number
+    pair_index_state["head"] = head
+    start = pair_index_state["last_block"] + 1
+    if start <= head:
+        scan_logs(PANCAKE_FACTORY, [PAIR_CREATED_TOPIC], start, head, _append_pair_logs)
+    pair_index_state["synced_at"] = time.time()
+    _save_pair_meta()
+
+
+def follow_pair_index():
+    """Sharded workers: pick up what the intake process appended or compacted since the last look."""
+    with open(PAIR_INDEX_META, "r") as f:
+        meta = json.load(f)
+    if meta["indexed_records"] != pair_index_state["indexed_records"]:
+        load_pair_index(readonly=True)
+    elif meta["records"] > pair_index_state["records"]:
+        with open(PAIR_INDEX_LOG, "rb") as f:
+            f.seek(pair_index_state["records"] * PAIR_RECORD_SIZE)
+            data = f.read((meta["records"] - pair_index_state["records"]) * PAIR_RECORD_SIZE)
+        with pair_index_lock:
+            for off in range(0, len(data) - PAIR_RECORD_SIZE + 1, PAIR_RECORD_SIZE):
+                _add_to_tail(data[off : off + PAIR_RECORD_SIZE])
+        pair_index_state["records"] += len(data) // PAIR_RECORD_SIZE
+    for k in ("last_block", "head", "synced_at"):
+        pair_index_state[k] = meta.get(k, pair_index_state[k])
+
+
+def pair_index_worker():
+    while True:
+        try:
+            if SHARD["role"] == "worker":
+                follow_pair_index()
+            else:
+                sync_pair_index()
+        except Exception as e:
+            print("Pair index sync error:", e)
+        time.sleep(PAIR_INDEX_POLL_SEC)
+
+
+HUB_TOKENS = [BUSD, USDT, USDC]
+HUB_SYMBOLS = {WBNB: "WBNB", BUSD: "BUSD", USDT: "USDT", USDC: "USDC"}
+
+
+def find_buy_path_indexed(token: str):
+    """
+    Same preference order as the getAmountsOut probes: direct WBNB pair, then
+    stable hops, passing over routes whose pairs hold no liquidity. When none is
+    liquid the first existing route is returned, so callers can say it is dead.
+    """
+    pairs = _lookup_pairs_raw(token)
+    candidates = []
+    if bytes.fromhex(WBNB[2:]) in pairs:
+        candidates.append([WBNB, token])
+    for hub in HUB_TOKENS:
+        if bytes.fromhex(hub[2:]) in pairs and get_pair_address(WBNB, hub):
+            candidates.append([WBNB, hub, token])
+    if len(candidates) > 1:
+        # one batch for every candidate hop; path_hops then reads the reserves cache
+        hop_pairs = {resolve_pair(a, b) for path in candidates for a, b in zip(path, path[1:])}
+        fetch_reserves([p for p in hop_pairs if p])
+        for path in candidates:
+            if path_hops(path):
+                return path
+    return candidates[0] if candidates else None
+
+
+def route_line(info):
+    """Overview line describing the route / pair status of a token."""
+    route = info.get("route")
+    if route:
+        hops = " → ".join(HUB_SYMBOLS.get(a, info["symbol"]) for a in route)
+        if info.get("price_usd") is None:
+            return f"\nRoute: {hops}\n⚠ Pair exists but is not tradable (no liquidity or paused)"
+        return f"\nRoute: {hops}"
+    if pair_index_ready():
+        return "\n⚠ No PancakeSwap V2 pair for this token yet"
+    return ""
+
+
 def get_path_for_buy(token_address: str):
     token = Web3.to_checksum_address(token_address)
     if token == WBNB:
         raise Exception("Cannot buy WBNB with BNB")
 
+    # Local pair index first: no chain calls just to learn whether a pair exists
+    path = find_buy_path_indexed(token)
+    if path:
+        return path
+    if pair_index_ready():
+        raise Exception("No PancakeSwap V2 pair for this token")
+
+    # Index still syncing: fall back to probing the router
+
     # Try direct path
     try:
-        router.functions.getAmountsOut(w3.to_wei(1, "ether"), [WBNB, token]).call()
+        get_amounts_out(w3.to_wei(1, "ether"), [WBNB, token])
         return [WBNB, token]
     except:
         pass
 
     # Try via BUSD
     try:
-        router.functions.getAmountsOut(w3.to_wei(1, "ether"), [WBNB, BUSD, token]).call()
+        get_amounts_out(w3.to_wei(1, "ether"), [WBNB, BUSD, token])
         return [WBNB, BUSD, token]
     except:
         pass
 
     # Try via USDT
     try:
-        router.functions.getAmountsOut(w3.to_wei(1, "ether"), [WBNB, USDT, token]).call()
+        get_amounts_out(w3.to_wei(1, "ether"), [WBNB, USDT, token])
         return [WBNB, USDT, token]
     except:
         pass
 
     # Try via USDC
     try:
-        router.functions.getAmountsOut(w3.to_wei(1, "ether"), [WBNB, USDC, token]).call()
+        get_amounts_out(w3.to_wei(1, "ether"), [WBNB, USDC, token])
         return [WBNB, USDC, token]
     except:
         pass
@@ -412,52 +1527,241 @@ def get_path_for_buy(token_address: str):
     raise Exception("No valid path found for this token")
 
 
-def get_token_info(token_address: str):
-    token_address = Web3.to_checksum_address(token_address)
-    token = get_token_contract(token_address)
-
-    symbol = token.functions.symbol().call()
-    decimals = token.functions.decimals().call()
-    total_supply_raw = token.functions.totalSupply().call()
-    total_supply = total_supply_raw / (10**decimals)
-
-    price_usd = None
-    tokens_per_bnb = None
-    mc_usd = None
+# ---------- Lookup coalescing ----------
+# A shilled CA gets pasted by many users within seconds. Identical lookups for the
+# same token at the same block share one computation; callers that arrive while
+# it runs wait for it, callers that arrive later in the block get the result.
+HEAD_BLOCK_TTL = float(os.getenv("HEAD_BLOCK_TTL", "0.5"))
+FLIGHT_RESULTS_MAX = 512
+head_block_cache = {"block": None, "at": 0.0}
+head_block_lock = threading.Lock()
+flight_lock = threading.Lock()
+flights = {}  # (name, token, block) -> {"event", "result", "error"}
+flight_results = OrderedDict()  # (name, token, block) -> flight, completed
+flight_stats = {}  # name -> {"calls", "computed", "absorbed"}
+
+
+def head_block():
+    """Latest block number, refreshed at most every HEAD_BLOCK_TTL seconds."""
+    with head_block_lock:
+        if head_block_cache["block"] is None or time.time() - head_block_cache["at"] > HEAD_BLOCK_TTL:
+            head_block_cache["block"] = w3.eth.block_number
+            head_block_cache["at"] = time.time()
+        return head_block_cache["block"]
+
+
+def single_flight(name, token_address, compute):
+    """Run compute() once per (name, token, block); concurrent duplicates share its result or error."""
+    key = (name, token_address.lower(), head_block())
+    with flight_lock:
+        stats = flight_stats.setdefault(name, {"calls": 0, "computed": 0, "absorbed": 0})
+        stats["calls"] += 1
+        flight = flight_results.get(key) or flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = {"event": threading.Event(), "result": None, "error": None}
+            flights[key] = flight
+            stats["computed"] += 1
+        else:
+            stats["absorbed"] += 1
 
-    try:
-        one_bnb = w3.to_wei(1, "ether")
-        path = get_path_for_buy(token_address)
-        amt_out = router.functions.getAmountsOut(one_bnb, path).call()[-1]
-        tokens_per_bnb = amt_out / (10**decimals)
-        bnb_price = get_bnb_price_usd()
-        if bnb_price is not None and tokens_per_bnb > 0:
-            price_usd = bnb_price / tokens_per_bnb
-            mc_usd = price_usd * total_supply
-    except Exception as e:
-        print("Token price calc error:", e)
+    if leader:
+        try:
+            with span(name, "lookup"):
+                flight["result"] = compute()
+        except Exception as e:
+            flight["error"] = e
+        with flight_lock:
+            flights.pop(key, None)
+            if flight["error"] is None:
+                flight_results[key] = flight
+                while len(flight_results) > FLIGHT_RESULTS_MAX:
+                    flight_results.popitem(last=False)
+        flight["event"].set()
+    else:
+        flight["event"].wait()
+
+    if flight["error"] is not None:
+        raise flight["error"]
+    return flight["result"]
+
+
+# ---------- Balance snapshots ----------
+# Balances for many wallets at once: BNB through batched eth_getBalance, tokens
+# through Multicall3 balanceOf, cached for the block they were read at. The
+# snapshot worker keeps every user's BNB and position tokens current, so the
+# wallet, preset and portfolio screens normally read from memory.
+MULTICALL3 = Web3.to_checksum_address("0xcA11bde05977b3631167028862bE2a173976CA11")
+AGGREGATE3_SELECTOR = abi_selector("aggregate3((address,bool,bytes)[])")
+MULTICALL_CHUNK = int(os.getenv("MULTICALL_CHUNK", "500"))  # balanceOf calls per eth_call
+BALANCE_SNAPSHOT_SEC = float(os.getenv("BALANCE_SNAPSHOT_SEC", "3"))  # 0 disables the background snapshot
+balance_lock = threading.Lock()
+balance_snapshot = {"block": -1, "bnb": {}, "tokens": {}}  # keys lowercase: wallet / (wallet, token)
+balance_stats = {"snapshots": 0, "requests": 0, "hits": 0, "misses": 0}
+
+
+def _balance_of_multicalls(pairs):
+    """One aggregate3 eth_call per MULTICALL_CHUNK (wallet, token) pairs; failures come back as 0."""
+    calls = []
+    for i in range(0, len(pairs), MULTICALL_CHUNK):
+        chunk = [
+            (Web3.to_checksum_address(token), True, bytes.fromhex(encode_balance_of(wallet)[2:]))
+            for wallet, token in pairs[i : i + MULTICALL_CHUNK]
+        ]
+        data = AGGREGATE3_SELECTOR + w3.codec.encode(["(address,bool,bytes)[]"], [chunk]).hex()
+        calls.append(("eth_call", [{"to": MULTICALL3, "data": data}, "latest"]))
+    return calls
 
-    holders = get_holders_count_from_bscscan(token_address)
+
+def fetch_balances(wallets=(), pairs=()):
+    """
+    BNB balances for wallets and token balances for (wallet, token) pairs at the
+    current block, as ({wallet: wei}, {(wallet, token): raw}) with lowercase keys.
+    Only what the block's snapshot does not hold yet is fetched.
+    """
+    block = head_block()
+    bnb, tokens = {}, {}
+    with balance_lock:
+        if block > balance_snapshot["block"]:
+            balance_snapshot.update({"block": block, "bnb": {}, "tokens": {}})
+        for w in wallets:
+            if w.lower() in balance_snapshot["bnb"]:
+                bnb[w.lower()] = balance_snapshot["bnb"][w.lower()]
+        for w, t in pairs:
+            key = (w.lower(), t.lower())
+            if key in balance_snapshot["tokens"]:
+                tokens[key] = balance_snapshot["tokens"][key]
+    missing_wallets = list(dict.fromkeys(w for w in wallets if w.lower() not in bnb))
+    missing_pairs = list(dict.fromkeys((w, t) for w, t in pairs if (w.lower(), t.lower()) not in tokens))
+    if not missing_wallets and not missing_pairs:
+        balance_stats["hits"] += 1
+        return bnb, tokens
+
+    balance_stats["misses"] += 1
+    calls = [("eth_getBalance", [w, "latest"]) for w in missing_wallets] + _balance_of_multicalls(missing_pairs)
+    balance_stats["requests"] += -(-len(calls) // RPC_BATCH_SIZE)
+    resps = rpc_batch_chunked(calls)
+    for w, resp in zip(missing_wallets, resps):
+        if resp.get("result"):
+            bnb[w.lower()] = int(resp["result"], 16)
+    offset = len(missing_wallets)
+    for n, resp in enumerate(resps[offset:]):
+        if not resp.get("result"):
+            continue
+        results = w3.codec.decode(["(bool,bytes)[]"], bytes.fromhex(resp["result"][2:]))[0]
+        for (w, t), (ok, ret) in zip(missing_pairs[n * MULTICALL_CHUNK :], results):
+            tokens[(w.lower(), t.lower())] = int.from_bytes(ret[:32], "big") if ok and len(ret) >= 32 else 0
+
+    with balance_lock:
+        if balance_snapshot["block"] == block:
+            balance_snapshot["bnb"].update(bnb)
+            balance_snapshot["tokens"].update(tokens)
+    return bnb, tokens
+
+
+def get_bnb_balance(wallet):
+    """BNB balance in wei from the current block's snapshot."""
+    return fetch_balances([wallet])[0].get(wallet.lower(), 0)
+
+
+def get_token_balance(wallet, token_address):
+    """Raw token balance from the current block's snapshot."""
+    return fetch_balances(pairs=[(wallet, token_address)])[1].get((wallet.lower(), token_address.lower()), 0)
+
+
+def user_balances(user_id, wallets=None):
+    """
+    (BNB wei, {token: raw balance}) summed over the user's wallets (all of them
+    unless given) for every token they hold a position in, read in one batch.
+    """
+    addresses = [acct.address for acct, _ in (wallets or user_wallets(user_id))]
+    tokens = list(get_user_positions(user_id))
+    bnb, raw = fetch_balances(addresses, [(w, t) for w in addresses for t in tokens])
+    return (
+        sum(bnb.get(w.lower(), 0) for w in addresses),
+        {t: sum(raw.get((w.lower(), t.lower()), 0) for w in addresses) for t in tokens},
+    )
+
+
+def active_token_balance(user_id, token_address):
+    """Raw balance of one token summed over the user's active wallets."""
+    pairs = [(acct.address, token_address) for acct, _ in active_wallets(user_id)]
+    raw = fetch_balances(pairs=pairs)[1]
+    return sum(raw.get((w.lower(), token_address.lower()), 0) for w, _ in pairs)
+
+
+def snapshot_all_balances():
+    wallets, pairs = [], []
+    with users_lock:
+        for uid, profile in users.items():
+            if not owns_user(uid) or not profile.get("address"):
+                continue
+            addresses = [profile["address"]] + [w["address"] for w in profile.get("wallets", [])]
+            wallets.extend(addresses)
+            pairs.extend((w, t) for w in addresses for t in profile.get("positions", {}))
+    if wallets:
+        fetch_balances(wallets, pairs)
+        balance_stats["snapshots"] += 1
+
+
+def balance_worker():
+    last_block = None
+    while True:
+        try:
+            block = head_block()
+            if block != last_block:
+                snapshot_all_balances()
+                last_block = block
+        except Exception as e:
+            print("Balance snapshot error:", e)
+        time.sleep(BALANCE_SNAPSHOT_SEC)
+
+
+def get_token_info(token_address: str):
+    return single_flight("token_info", token_address, lambda: _get_token_info(token_address))
+
+
+def basic_risk_check(token_address: str):
+    """Computes a fresh risk score (level, roundtrip loss) for the token at the head block."""
+    return single_flight("risk_check", token_address, lambda: _basic_risk_check(token_address))
+
+
+def _get_token_info(token_address: str):
+    token_address = Web3.to_checksum_address(token_address)
+    meta = get_token_meta(token_address)
+    symbol = meta["symbol"]
+    decimals = meta["decimals"]
+    total_supply_raw = call_total_supply(token_address)
+    total_supply = total_supply_raw / (10**decimals)
+
+    price_usd = None
+    tokens_per_bnb = None
+    mc_usd = None
+    route = None
+
+    try:
+        one_bnb = w3.to_wei(1, "ether")
+        path = get_path_for_buy(token_address)
+        route = path
+        amt_out = get_amounts_out(one_bnb, path)[-1]
+        tokens_per_bnb = amt_out / (10**decimals)
+        bnb_price = get_bnb_price_usd()
+        if bnb_price is not None and tokens_per_bnb > 0:
+            price_usd = bnb_price / tokens_per_bnb
+            mc_usd = price_usd * total_supply
+    except Exception as e:
+        print("Token price calc error:", e)
+
+    watch_token_candles(token_address, route, decimals)
+    holders = get_holders_count_from_bscscan(token_address)
 
     # try to read fee info if token exposes it
     fee_percent = 0.0
     fee_receiver = None
     try:
-        fee_bp = None
-        try:
-            fee_bp = token.functions.feeBasisPoints().call()
-        except Exception:
-            try:
-                fee_bp = token.functions.feePercentTimes100().call()
-            except Exception:
-                fee_bp = None
-
+        fee_bp, fee_receiver = call_token_fee(token_address)
         if fee_bp is not None:
             fee_percent = float(fee_bp) / 100.0
-            try:
-                fee_receiver = token.functions.feeReceiver().call()
-            except Exception:
-                fee_receiver = None
     except Exception as e:
         print("Fee read error:", e)
 
@@ -472,47 +1776,220 @@ def get_token_info(token_address: str):
         "holders": holders,
         "fee_percent": fee_percent,
         "fee_receiver": fee_receiver,
+        "route": route,
     }
 
 
-def basic_risk_check(token_address: str):
+def _basic_risk_check(token_address: str):
+    score = {"level": RISK_FAILED, "loss_pct": None, "error": None, "block": head_block(), "at": time.time()}
     try:
         amount_in_bnb = 0.01
         amount_in_wei = w3.to_wei(amount_in_bnb, "ether")
         token_addr = Web3.to_checksum_address(token_address)
 
         path_buy = get_path_for_buy(token_addr)
-        token_out = router.functions.getAmountsOut(amount_in_wei, path_buy).call()[-1]
+        token_out = get_amounts_out(amount_in_wei, path_buy)[-1]
 
         path_sell = list(reversed(path_buy))
-        bnb_back = router.functions.getAmountsOut(token_out, path_sell).call()[-1]
+        bnb_back = get_amounts_out(token_out, path_sell)[-1]
         bnb_back_float = float(w3.from_wei(bnb_back, "ether"))
 
         effective_loss = 1 - (bnb_back_float / amount_in_bnb)
         loss_pct = max(effective_loss * 100, 0)
 
         if loss_pct < 5:
-            level = "🟢 Low tax / normal"
+            level = RISK_LOW
         elif loss_pct < 25:
-            level = "🟡 Medium tax / degen"
+            level = RISK_MEDIUM
         else:
-            level = "🔴 High tax / possible honeypot"
-
-        return f"{level}\nEstimated roundtrip loss on 1 trade: ~{loss_pct:.2f}%"
+            level = RISK_HIGH
+        score.update({"level": level, "loss_pct": loss_pct})
     except Exception as e:
-        return f"⚠ Risk check failed (illiquid or blocked): {e}"
+        score["error"] = str(e)
+    return score
+
+
+# ---------- Risk scores ----------
+# One risk score per token, shared by every user. "Risk" answers from the cache;
+# the risk worker recomputes tokens someone looked at or holds recently, and the
+# alert worker tells holders when a token's score gets worse than what they
+# were last shown. A failed check is often a flaky node, so it only alerts after
+# RISK_FAIL_REPEATS failures in a row.
+RISK_LOW, RISK_MEDIUM, RISK_HIGH, RISK_FAILED = 0, 1, 2, 3
+RISK_LABELS = {
+    RISK_LOW: "🟢 Low tax / normal",
+    RISK_MEDIUM: "🟡 Medium tax / degen",
+    RISK_HIGH: "🔴 High tax / possible honeypot",
+    RISK_FAILED: "⚠ Risk check failed (illiquid or blocked)",
+}
+RISK_REFRESH_SEC = int(os.getenv("RISK_REFRESH_SEC", "60"))  # recompute cached scores this old
+RISK_RECENT_SEC = int(os.getenv("RISK_RECENT_SEC", "3600"))  # keep refreshing tokens seen this recently
+RISK_ALERT_SEC = int(os.getenv("RISK_ALERT_SEC", "15"))
+RISK_ALERT_DELTA_PCT = float(os.getenv("RISK_ALERT_DELTA_PCT", "10"))  # loss increase that alerts within a level
+RISK_FAIL_REPEATS = int(os.getenv("RISK_FAIL_REPEATS", "3"))
+risk_scores = {}  # token -> score; a Manager dict in sharded mode
+risk_seen = {}  # token -> last time a user viewed or held it
+risk_pool = ThreadPoolExecutor(max_workers=int(os.getenv("RISK_THREADS", "8")))
+risk_stats = {"hits": 0, "misses": 0, "recomputed": 0, "alerts": 0}
+
+
+def note_risk_interest(token_address):
+    risk_seen[Web3.to_checksum_address(token_address)] = time.time()
+
+
+def note_held_tokens(tokens):
+    """Keeps held tokens' scores refreshed; one update, so one Manager round trip in sharded mode."""
+    now = time.time()
+    risk_seen.update({Web3.to_checksum_address(t): now for t in tokens})
+
+
+def refresh_risk_score(token_address):
+    token = Web3.to_checksum_address(token_address)
+    score = dict(basic_risk_check(token))
+    if score["level"] == RISK_FAILED:
+        last = risk_scores.get(token)
+        score["failures"] = last.get("failures", 1) + 1 if last and last["level"] == RISK_FAILED else 1
+    risk_scores[token] = score
+    return score
+
+
+def risk_score(token_address):
+    """Cached score for the token, computed now only if no user has asked for it before."""
+    token = Web3.to_checksum_address(token_address)
+    note_risk_interest(token)
+    score = risk_scores.get(token)
+    if score is not None:
+        risk_stats["hits"] += 1
+        return score
+    risk_stats["misses"] += 1
+    return refresh_risk_score(token)
+
+
+def risk_text(score):
+    text = RISK_LABELS[score["level"]]
+    if score["level"] == RISK_FAILED:
+        text += f": {score.get('error')}"
+    else:
+        text += f"\nEstimated roundtrip loss on 1 trade: ~{score['loss_pct']:.2f}%"
+    age = max(int(time.time() - score["at"]), 0)
+    return f"{text}\n_Data age: {age}s (block {score['block']})_"
+
+
+def risk_worsened(score, last):
+    if last is None:
+        return False
+    if score["level"] == RISK_FAILED and score.get("failures", 1) < RISK_FAIL_REPEATS:
+        return False
+    if score["level"] != last["level"]:
+        return score["level"] > last["level"]
+    if score["loss_pct"] is None or last.get("loss_pct") is None:
+        return False
+    return score["loss_pct"] - last["loss_pct"] >= RISK_ALERT_DELTA_PCT
+
+
+def risk_moved(score, last):
+    """Whether score differs enough from what the holder was last shown to become the new baseline."""
+    if last is None or score["level"] != last["level"]:
+        return True
+    if score["loss_pct"] is None or last.get("loss_pct") is None:
+        return False
+    return abs(score["loss_pct"] - last["loss_pct"]) >= RISK_ALERT_DELTA_PCT
+
+
+def refresh_risk_scores():
+    """Recomputes stale scores of recently seen tokens on the risk pool."""
+    now = time.time()
+    due = []
+    for token, seen in list(risk_seen.items()):
+        if now - seen > RISK_RECENT_SEC:
+            risk_seen.pop(token, None)
+            risk_scores.pop(token, None)
+            continue
+        score = risk_scores.get(token)
+        if score is None or now - score["at"] >= RISK_REFRESH_SEC:
+            due.append(token)
+    for token, fut in [(t, risk_pool.submit(refresh_risk_score, t)) for t in due]:
+        try:
+            fut.result()
+            risk_stats["recomputed"] += 1
+        except Exception as e:
+            print(f"Risk refresh error {token}:", e)
+
+
+def risk_worker():
+    while True:
+        try:
+            refresh_risk_scores()
+        except Exception as e:
+            print("Risk worker error:", e)
+        time.sleep(max(RISK_REFRESH_SEC // 4, 1))
+
+
+def check_risk_alerts():
+    """Marks held tokens as seen and alerts holders whose token scores got worse."""
+    with users_lock:
+        held = {
+            token for uid, profile in users.items() if owns_user(uid) for token in profile.get("positions", {})
+        }
+    if not held:
+        return
+    note_held_tokens(held)
+    scores = {token: risk_scores.get(token) for token in held}
+    alerts = []
+    with users_lock:
+        changed = False
+        for uid, profile in users.items():
+            if not owns_user(uid):
+                continue
+            shown = profile.setdefault("risk_levels", {})
+            for token, pos in profile.get("positions", {}).items():
+                score = scores.get(token)
+                if score is None:
+                    continue
+                last = shown.get(token)
+                if last is not None and last["block"] == score["block"]:
+                    continue
+                if score["level"] == RISK_FAILED and score.get("failures", 1) < RISK_FAIL_REPEATS:
+                    continue
+                if risk_worsened(score, last):
+                    alerts.append((uid, pos.get("symbol", "?"), token, score))
+                if risk_moved(score, last):
+                    shown[token] = {"level": score["level"], "loss_pct": score["loss_pct"], "block": score["block"]}
+                    changed = True
+                else:
+                    last["block"] = score["block"]  # checked at this block, nothing worth saving
+            for token in [t for t in shown if t not in profile.get("positions", {})]:
+                shown.pop(token)
+                changed = True
+        if changed:
+            save_users(users)
+
+    for uid, symbol, token, score in alerts:
+        risk_stats["alerts"] += 1
+        send_message(uid, f"🚨 *Risk changed for {symbol}*\n`{token}`\n\n{risk_text(score)}")
+
+
+def risk_alert_worker():
+    while True:
+        try:
+            check_risk_alerts()
+        except Exception as e:
+            print("Risk alert error:", e)
+        time.sleep(RISK_ALERT_SEC)
+
+
+GAS_MODE_MULTIPLIERS = {
+    "standard": 1.0,
+    "fast": 1.2,
+    "turbo": 1.5,
+}
 
 
 def get_user_gas_price(user_id):
     base = w3.eth.gas_price
     settings = get_user_settings(user_id)
     mode = settings.get("gas_mode", "standard")
-    mult_map = {
-        "standard": 1.0,
-        "fast": 1.2,
-        "turbo": 1.5,
-    }
-    m = mult_map.get(mode, 1.0)
+    m = GAS_MODE_MULTIPLIERS.get(mode, 1.0)
     return int(base * m)
 
 
@@ -524,7 +2001,7 @@ def get_amount_out(amount_bnb, token_address: str):
     amount_wei = w3.to_wei(amount_bnb, "ether")
     path = get_path_for_buy(token_address)
     try:
-        amounts = router.functions.getAmountsOut(amount_wei, path).call()
+        amounts = get_amounts_out(amount_wei, path)
         out_raw = amounts[-1]
         return out_raw
     except Exception as e:
@@ -532,7 +2009,196 @@ def get_amount_out(amount_bnb, token_address: str):
         raise
 
 
-def swap_bnb_for_token(user_id, amount_bnb, token_address):
+# ---------- Reserves cache / V2 math ----------
+PANCAKE_FEE_NUM = 9975  # PancakeSwap V2 charges 0.25% per hop
+PANCAKE_FEE_DEN = 10000
+RESERVES_TTL_SEC = float(os.getenv("RESERVES_TTL_SEC", "3"))
+GET_PAIR_SELECTOR = abi_selector("getPair(address,address)")
+
+reserves_cache = {}  # pair -> (reserve0, reserve1, fetched_at)
+
+
+def resolve_pair(token_a: str, token_b: str):
+    """Pair address from the local index; asks the factory only while the index is syncing."""
+    pair = get_pair_address(token_a, token_b)
+    if pair or pair_index_ready():
+        return pair
+    data = GET_PAIR_SELECTOR + address_to_topic(token_a)[2:] + address_to_topic(token_b)[2:]
+    res = rpc_call("eth_call", [{"to": PANCAKE_FACTORY, "data": data}, "latest"])
+    if not res or int(res, 16) == 0:
+        return None
+    return topic_to_address(res)
+
+
+def fetch_reserves(pairs):
+    """
+    Returns {pair: (reserve0, reserve1)}. Fresh entries come from the cache,
+    the rest are fetched as one JSON-RPC batch of getReserves calls.
+    """
+    now = time.time()
+    out = {}
+    missing = []
+    for p in pairs:
+        cached = reserves_cache.get(p)
+        if cached and now - cached[2] < RESERVES_TTL_SEC:
+            out[p] = (cached[0], cached[1])
+        else:
+            missing.append(p)
+    if missing:
+        resps = rpc_batch([("eth_call", [{"to": p, "data": GET_RESERVES_SELECTOR}, "latest"]) for p in missing])
+        for p, resp in zip(missing, resps):
+            reserves = decode_reserves(resp.get("result"))
+            if reserves is None:
+                continue
+            reserves_cache[p] = (*reserves, now)
+            out[p] = reserves
+    return out
+
+
+def orient_reserves(reserves, token_in: str, token_out: str):
+    """(reserve_in, reserve_out) for a pair, whose token0 is the lower address."""
+    if token_in.lower() < token_out.lower():
+        return reserves[0], reserves[1]
+    return reserves[1], reserves[0]
+
+
+def v2_amount_out(amount_in, reserve_in, reserve_out):
+    if amount_in <= 0 or reserve_in == 0 or reserve_out == 0:
+        return 0
+    amount_in_with_fee = amount_in * PANCAKE_FEE_NUM
+    return amount_in_with_fee * reserve_out // (reserve_in * PANCAKE_FEE_DEN + amount_in_with_fee)
+
+
+def quote_hops(amount_in, hops):
+    """Router-equivalent getAmountsOut over [(reserve_in, reserve_out), ...]."""
+    amount = amount_in
+    for reserve_in, reserve_out in hops:
+        amount = v2_amount_out(amount, reserve_in, reserve_out)
+    return amount
+
+
+def path_hops(path):
+    """Oriented reserves for every hop of a path, or None if a pair is missing or empty."""
+    pairs = [resolve_pair(a, b) for a, b in zip(path, path[1:])]
+    if not all(pairs):
+        return None
+    reserves = fetch_reserves(pairs)
+    hops = []
+    for (a, b), p in zip(zip(path, path[1:]), pairs):
+        if p not in reserves:
+            return None
+        r_in, r_out = orient_reserves(reserves[p], a, b)
+        if r_in == 0 or r_out == 0:
+            return None
+        hops.append((r_in, r_out))
+    return hops
+
+
+def virtual_pool(hops):
+    """
+    Collapses a multi-hop V2 route into one equivalent pool (Ea, Eb) so that
+    out(x) = g*x*Eb / (Ea + g*x), with g the per-hop fee factor.
+    """
+    g = PANCAKE_FEE_NUM / PANCAKE_FEE_DEN
+    ea, eb = float(hops[0][0]), float(hops[0][1])
+    for r_in, r_out in hops[1:]:
+        denom = r_in + g * eb
+        ea, eb = ea * r_in / denom, g * eb * r_out / denom
+    return ea, eb
+
+
+# ---------- Split order optimizer ----------
+SPLIT_MIN_SHARE = float(os.getenv("SPLIT_MIN_SHARE", "0.05"))  # legs below this share are dropped
+SPLIT_MIN_GAIN_BPS = int(os.getenv("SPLIT_MIN_GAIN_BPS", "30"))  # extra legs cost gas; need this much gain
+
+
+def optimize_split(amount_in, pools):
+    """
+    Closed-form optimal split of amount_in across parallel routes given as virtual
+    pools. Marginal output g*Ea*Eb/(Ea+g*x)^2 is equalised across the active routes;
+    routes whose spot price is below the common marginal price get nothing.
+    Returns the share of amount_in per route.
+    """
+    g = PANCAKE_FEE_NUM / PANCAKE_FEE_DEN
+    active = list(range(len(pools)))
+    x = {}
+    while active:
+        sq = {i: math.sqrt(g * pools[i][0] * pools[i][1]) for i in active}
+        mu = (g * amount_in + sum(pools[i][0] for i in active)) / sum(sq.values())
+        x = {i: (sq[i] * mu - pools[i][0]) / g for i in active}
+        worst = min(active, key=lambda i: x[i])
+        if x[worst] >= 0:
+            break
+        active.remove(worst)
+    shares = [0.0] * len(pools)
+    for i in active:
+        shares[i] = x[i] / amount_in
+    return shares
+
+
+def compute_split_plan(amount_in, routes):
+    """
+    routes: [(path, hops), ...] with hops from cached reserves.
+    Compares the best single route with the optimal split and returns the plan to execute.
+    Pure arithmetic, no RPC: runs in tens of microseconds.
+    """
+    started = time.perf_counter()
+    g = PANCAKE_FEE_NUM / PANCAKE_FEE_DEN
+    pools = [virtual_pool(hops) for _, hops in routes]
+    singles = [quote_hops(amount_in, hops) for _, hops in routes]
+    best = max(range(len(routes)), key=lambda i: singles[i])
+    spot = max(g * eb / ea for ea, eb in pools)  # output per input at zero size, fees included
+
+    shares = optimize_split(amount_in, pools)
+    keep = [i for i, sh in enumerate(shares) if sh >= SPLIT_MIN_SHARE]
+    if 1 < len(keep) < len([sh for sh in shares if sh > 0]):
+        sub = optimize_split(amount_in, [pools[i] for i in keep])
+        shares = [0.0] * len(pools)
+        for i, sh in zip(keep, sub):
+            shares[i] = sh
+
+    legs = []
+    remaining = amount_in
+    for n, i in enumerate(keep):
+        leg_in = remaining if n == len(keep) - 1 else int(amount_in * shares[i])
+        remaining -= leg_in
+        legs.append({"path": routes[i][0], "amount_in": leg_in, "expected_out": quote_hops(leg_in, routes[i][1])})
+    split_out = sum(leg["expected_out"] for leg in legs)
+
+    if len(legs) < 2 or split_out * 10000 < singles[best] * (10000 + SPLIT_MIN_GAIN_BPS):
+        legs = [{"path": routes[best][0], "amount_in": amount_in, "expected_out": singles[best]}]
+        split_out = singles[best]
+
+    ideal = amount_in * spot
+    return {
+        "legs": legs,
+        "expected_out": split_out,
+        "single_path": routes[best][0],
+        "single_out": singles[best],
+        "single_impact": max(1 - singles[best] / ideal, 0.0) if ideal else 0.0,
+        "impact": max(1 - split_out / ideal, 0.0) if ideal else 0.0,
+        "calc_us": (time.perf_counter() - started) * 1e6,
+    }
+
+
+def plan_buy_split(token_address: str, amount_in_wei: int):
+    """Best single route vs split across the WBNB-direct and stablecoin-hop routes."""
+    token = Web3.to_checksum_address(token_address)
+    routes = []
+    for path in [[WBNB, token]] + [[WBNB, hub, token] for hub in HUB_TOKENS]:
+        hops = path_hops(path)
+        if hops:
+            routes.append((path, hops))
+    if not routes:
+        raise Exception("No valid path found for this token")
+    return compute_split_plan(amount_in_wei, routes)
+
+
+def format_path(path, symbol):
+    return " → ".join(HUB_SYMBOLS.get(a, symbol) for a in path)
+
+
+def swap_bnb_for_token(user_id, amount_bnb, token_address, path=None, nonce=None):
     acct, pk = get_user_account(user_id)
     if not acct:
         raise Exception("Wallet not connected")
@@ -541,49 +2207,419 @@ def swap_bnb_for_token(user_id, amount_bnb, token_address):
     slippage = settings.get("slippage", 0.03)
 
     amount_in_wei = w3.to_wei(amount_bnb, "ether")
-    path = get_path_for_buy(token_address)
+    if path is None:
+        path = get_path_for_buy(token_address)
+    if nonce is None:
+        nonce = next_nonce(acct.address)
 
     # estimate expected_out using router
-    expected_out = router.functions.getAmountsOut(amount_in_wei, path).call()[-1]
+    expected_out = get_amounts_out(amount_in_wei, path)[-1]
     amount_out_min = int(expected_out * (1 - slippage))
     deadline = int(time.time()) + 600
 
-    tx = wrapper.functions.swapExactETHForTokensSupportingFeeOnTransferTokens(
-        amount_out_min, path, acct.address, deadline
-    ).build_transaction(
-        {
+    tx = {
+        "from": acct.address,
+        "to": WRAPPER_ADDRESS,
+        "value": amount_in_wei,
+        "gas": 600000,
+        "gasPrice": get_user_gas_price(user_id),
+        "nonce": nonce,
+        "chainId": 56,
+        "data": encode_swap_eth_for_tokens(amount_out_min, path, acct.address, deadline),
+    }
+
+    signed = w3.eth.account.sign_transaction(tx, pk)
+    tx_hash = broadcast_raw_tx(signed.raw_transaction)
+    note_nonce(acct.address, nonce)
+    watch_tx(user_id, tx, tx_hash, label="BUY")
+    return tx_hash, expected_out
+
+
+def swap_bnb_for_token_split(user_id, token_address, legs):
+    """
+    Executes a split plan as one wrapper swap per leg with consecutive nonces, each
+    bounded by the plan's expected output for that leg less slippage; no re-quote.
+    Returns the hashes that went out and their summed expected output. Fewer
+    hashes than legs is a partial fill: the legs after the first rejected one
+    were not sent.
+    """
+    acct, pk = get_user_account(user_id)
+    if not acct:
+        raise Exception("Wallet not connected")
+    slippage = get_user_settings(user_id).get("slippage", 0.03)
+    nonce = next_nonce(acct.address)
+    gas_price = get_user_gas_price(user_id)
+    deadline = int(time.time()) + 600
+    txs, raws = [], []
+    for i, leg in enumerate(legs):
+        data = encode_swap_eth_for_tokens(int(leg["expected_out"] * (1 - slippage)), leg["path"], acct.address, deadline)
+        tx = {
             "from": acct.address,
-            "value": amount_in_wei,
+            "to": WRAPPER_ADDRESS,
+            "value": leg["amount_in"],
             "gas": 600000,
-            "gasPrice": get_user_gas_price(user_id),
-            "nonce": w3.eth.get_transaction_count(acct.address),
+            "gasPrice": gas_price,
+            "nonce": nonce + i,
             "chainId": 56,
+            "data": data,
         }
-    )
+        txs.append(tx)
+        raws.append(w3.eth.account.sign_transaction(tx, pk).raw_transaction)
+
+    hashes = []
+    total_out = 0
+    for tx, leg, tx_hash in zip(txs, legs, broadcast_raw_txs(raws)):
+        if tx_hash is None:
+            break
+        hashes.append(tx_hash)
+        total_out += leg["expected_out"]
+        watch_tx(user_id, tx, tx_hash, label="BUY")
+    if not hashes:
+        raise Exception("No endpoint accepted the transaction")
+    note_nonce(acct.address, nonce + len(hashes) - 1)
+    if len(hashes) < len(legs):
+        print(f"Split buy partially sent: {len(hashes)}/{len(legs)} legs")
+    return hashes, total_out
+
+
+# ---------- Nonces and allowances ----------
+# Txs queued back to back (buy then staged approval, approval then sell) cannot
+# rely on the node's pending count having seen the previous one yet, so the next
+# nonce per wallet is also tracked locally. A dropped tx would leave the local
+# nonce ahead of the chain for good, so the node's count wins again once it has
+# lagged for NONCE_RESYNC_BLOCKS, or when the tx monitor sees a tx dropped or
+# replaced. Approvals are cached as granted when sent and forgotten if they fail.
+MAX_UINT256 = 2**256 - 1
+NONCE_RESYNC_BLOCKS = int(os.getenv("NONCE_RESYNC_BLOCKS", "3"))
+wallet_nonces = {}  # wallet (lowercase) -> next nonce this process expects to use
+nonce_lag_since = {}  # wallet (lowercase) -> block at which the node's pending count fell behind ours
+allowance_cache = {}  # (wallet, token), lowercase -> allowance granted to the wrapper
+nonce_lock = threading.Lock()
+
+
+def note_nonce(address, nonce):
+    with nonce_lock:
+        key = address.lower()
+        wallet_nonces[key] = max(wallet_nonces.get(key, 0), nonce + 1)
+
+
+def reconcile_nonce(address, pending):
+    """Next nonce for a wallet given the node's pending count."""
+    key = address.lower()
+    block = head_block()
+    with nonce_lock:
+        local = wallet_nonces.get(key, 0)
+        if pending >= local:
+            nonce_lag_since.pop(key, None)
+            return pending
+        if block - nonce_lag_since.setdefault(key, block) < NONCE_RESYNC_BLOCKS:
+            return local
+        print(f"Nonce resync for {address}: local {local}, chain {pending}")
+        wallet_nonces[key] = pending
+        nonce_lag_since.pop(key, None)
+        return pending
+
+
+def resync_nonce(address):
+    """Drops the local nonce so the next one comes from the node's pending count."""
+    with nonce_lock:
+        wallet_nonces.pop(address.lower(), None)
+        nonce_lag_since.pop(address.lower(), None)
+
+
+def next_nonce(address):
+    return reconcile_nonce(address, w3.eth.get_transaction_count(address, "pending"))
+
+
+def cached_allowance(wallet, token_address):
+    return allowance_cache.get((wallet.lower(), token_address.lower()))
+
+
+def set_allowance(wallet, token_address, amount):
+    allowance_cache[(wallet.lower(), token_address.lower())] = amount
+
+
+def forget_allowance(wallet, token_address):
+    allowance_cache.pop((wallet.lower(), token_address.lower()), None)
+
+
+def spend_allowance(wallet, token_address, amount):
+    key = (wallet.lower(), token_address.lower())
+    current = allowance_cache.get(key)
+    if current is not None and current != MAX_UINT256:
+        allowance_cache[key] = max(current - amount, 0)
+
+
+def stage_post_buy_approval(user_id, token_address):
+    """
+    Opt-in (settings): right after a buy, queue the wrapper approval with the next
+    nonce so the first sell of this token needs neither the allowance call nor the
+    approval wait. Nonce order keeps the approval ahead of any later sell.
+    """
 
-    signed = w3.eth.account.sign_transaction(tx, pk)
-    tx_hash = w3.eth.send_raw_transaction(signed.raw_transaction)
-    return w3.to_hex(tx_hash), expected_out
+    def run():
+        try:
+            acct, pk = get_user_account(user_id)
+            if not acct:
+                return
+            current = cached_allowance(acct.address, token_address)
+            if current is None:
+                current = call_allowance(token_address, acct.address)
+                set_allowance(acct.address, token_address, current)
+            if current == MAX_UINT256:
+                return
+            nonce = next_nonce(acct.address)
+            tx = {
+                "from": acct.address,
+                "to": Web3.to_checksum_address(token_address),
+                "value": 0,
+                "gas": 150_000,
+                "gasPrice": get_user_gas_price(user_id),
+                "nonce": nonce,
+                "chainId": 56,
+                "data": encode_approve(WRAPPER_ADDRESS, MAX_UINT256),
+            }
+            signed = w3.eth.account.sign_transaction(tx, pk)
+            tx_hash = broadcast_raw_tx(signed.raw_transaction)
+            note_nonce(acct.address, nonce)
+            watch_tx(user_id, tx, tx_hash, label="Approval")
+            set_allowance(acct.address, token_address, MAX_UINT256)
+            record_approval(user_id, token_address, tx_hash)
+            print(f"Staged approval {tx_hash} for {token_address} (nonce {nonce})")
+        except Exception as e:
+            print("Staged approval error:", e)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+# ---------- Speculative pre-warm ----------
+# The slow part of a buy (route, reserves, allowance, gas, nonce) starts when the CA
+# is pasted; the confirm screen stages a tx template per leg. Confirm then only
+# re-reads nonce, gas price and reserves in one batch, signs and broadcasts.
+PREWARM_TTL_SEC = float(os.getenv("PREWARM_TTL_SEC", "120"))
+PREWARM_MAX_ENTRIES = int(os.getenv("PREWARM_MAX_ENTRIES", "1000"))
+CONFIRM_TARGET_MS = float(os.getenv("CONFIRM_TARGET_MS", "100"))
+GAS_ESTIMATE_MARGIN = 1.3
+prewarm_pool = ThreadPoolExecutor(max_workers=int(os.getenv("PREWARM_THREADS", "8")))
+prewarm_cache = OrderedDict()  # (user_id, token) -> {"at", "route", "nonce", "gas_price", "allowance", "template"}
+prewarm_lock = threading.Lock()
+prewarm_stats = {"started": 0, "hits": 0, "misses": 0, "over_target": 0}
+confirm_latency = deque(maxlen=1000)  # click-to-broadcast ms of pre-warmed buys
+
+
+def _user_gas_price(user_id, base):
+    mode = get_user_settings(user_id).get("gas_mode", "standard")
+    return int(base * GAS_MODE_MULTIPLIERS.get(mode, 1.0))
+
+
+def _store_prewarm(key, entry):
+    """Oldest entries first: expired ones and any beyond PREWARM_MAX_ENTRIES are dropped on insert."""
+    with prewarm_lock:
+        prewarm_cache[key] = entry
+        prewarm_cache.move_to_end(key)
+        while prewarm_cache:
+            oldest_key, oldest = next(iter(prewarm_cache.items()))
+            if len(prewarm_cache) <= PREWARM_MAX_ENTRIES and entry["at"] - oldest["at"] <= PREWARM_TTL_SEC:
+                break
+            del prewarm_cache[oldest_key]
+
+
+def prewarm_token(user_id, token_address):
+    """Background: warm token info, routes, reserves, nonce, gas price and allowance for a pasted CA."""
+    acct, _ = get_user_account(user_id)
+    if not acct:
+        return
+    prewarm_stats["started"] += 1
+
+    def run():
+        try:
+            get_token_info(token_address)
+            route = get_path_for_buy(token_address)
+            for path in [[WBNB, token_address]] + [[WBNB, hub, token_address] for hub in HUB_TOKENS]:
+                path_hops(path)
+            allowance_data = encode_allowance(acct.address)
+            nonce, gas_price, allowance = rpc_batch(
+                [
+                    ("eth_getTransactionCount", [acct.address, "pending"]),
+                    ("eth_gasPrice", []),
+                    ("eth_call", [{"to": token_address, "data": allowance_data}, "latest"]),
+                ]
+            )
+            _store_prewarm(
+                (user_id, token_address),
+                {
+                    "at": time.time(),
+                    "route": route,
+                    "nonce": int(nonce["result"], 16),
+                    "gas_price": _user_gas_price(user_id, int(gas_price["result"], 16)),
+                    "allowance": int(allowance.get("result") or "0x0", 16),
+                    "template": None,
+                },
+            )
+            if allowance.get("result"):
+                set_allowance(acct.address, token_address, int(allowance["result"], 16))
+        except Exception as e:
+            print("Prewarm error:", e)
+
+    prewarm_pool.submit(run)
+
+
+def stage_buy_template(user_id, token_address, amount_in_wei, legs=None):
+    """
+    Background: once the amount is known, estimate gas per leg and store everything
+    confirm needs except the final amountOutMin, deadline and signature.
+    """
+
+    def run():
+        try:
+            acct, _ = get_user_account(user_id)
+            with prewarm_lock:
+                entry = prewarm_cache.get((user_id, token_address))
+            if not acct or not entry:
+                return
+            plan = legs or [{"path": entry["route"], "amount_in": amount_in_wei}]
+            staged = []
+            for leg in plan:
+                path = leg["path"]
+                hops = path_hops(path)
+                if not hops:
+                    return
+                data = encode_swap_eth_for_tokens(0, path, acct.address, int(time.time()) + 600)
+                staged.append(
+                    {
+                        "path": path,
+                        "pairs": [resolve_pair(a, b) for a, b in zip(path, path[1:])],
+                        "amount_in": leg["amount_in"],
+                        "expected_out": quote_hops(leg["amount_in"], hops),
+                        "data": data,
+                    }
+                )
+            estimates = rpc_batch(
+                [
+                    (
+                        "eth_estimateGas",
+                        [{"from": acct.address, "to": WRAPPER_ADDRESS, "value": hex(leg["amount_in"]), "data": leg["data"]}],
+                    )
+                    for leg in staged
+                ]
+            )
+            for leg, est in zip(staged, estimates):
+                leg["gas"] = int(int(est["result"], 16) * GAS_ESTIMATE_MARGIN) if est.get("result") else 600000
+                del leg["data"]
+            with prewarm_lock:
+                entry["template"] = {"amount_in": amount_in_wei, "legs": staged}
+        except Exception as e:
+            print("Template staging error:", e)
+
+    prewarm_pool.submit(run)
+
+
+def execute_prewarmed_buy(user_id, token_address, amount_in_wei):
+    """
+    Confirm-time fast path. Returns (hashes, total_out), or None when no fresh
+    template matches and the caller should take the regular path.
+    """
+    with prewarm_lock:
+        entry = prewarm_cache.get((user_id, token_address))
+        template = entry and entry.get("template")
+    if not template or template["amount_in"] != amount_in_wei or time.time() - entry["at"] > PREWARM_TTL_SEC:
+        prewarm_stats["misses"] += 1
+        return None
+    acct, pk = get_user_account(user_id)
+    if not acct:
+        raise Exception("Wallet not connected")
+    slippage = get_user_settings(user_id).get("slippage", 0.03)
+
+    # freshness check: nonce, gas price and every leg's reserves in one round trip;
+    # the staged gas price can be up to PREWARM_TTL_SEC old
+    pairs = list(dict.fromkeys(p for leg in template["legs"] for p in leg["pairs"]))
+    resps = rpc_batch(
+        [("eth_getTransactionCount", [acct.address, "pending"]), ("eth_gasPrice", [])]
+        + [("eth_call", [{"to": p, "data": GET_RESERVES_SELECTOR}, "latest"]) for p in pairs]
+    )
+    nonce = reconcile_nonce(acct.address, int(resps[0]["result"], 16))
+    gas_price = _user_gas_price(user_id, int(resps[1]["result"], 16)) if resps[1].get("result") else entry["gas_price"]
+    now = time.time()
+    fresh = {}
+    for p, resp in zip(pairs, resps[2:]):
+        fresh[p] = decode_reserves(resp.get("result"))
+        if fresh[p] is None:
+            raise Exception("Could not refresh reserves")
+        reserves_cache[p] = (*fresh[p], now)
+
+    txs = []
+    raws = []
+    total_out = 0
+    deadline = int(now) + 600
+    for i, leg in enumerate(template["legs"]):
+        path = leg["path"]
+        hops = [orient_reserves(fresh[p], a, b) for (a, b), p in zip(zip(path, path[1:]), leg["pairs"])]
+        out = quote_hops(leg["amount_in"], hops)
+        if out < leg["expected_out"] * (1 - slippage):
+            raise Exception("Price moved beyond your slippage since the quote. Re-quote and try again.")
+        data = encode_swap_eth_for_tokens(int(out * (1 - slippage)), path, acct.address, deadline)
+        tx = {
+            "to": WRAPPER_ADDRESS,
+            "value": leg["amount_in"],
+            "gas": leg["gas"],
+            "gasPrice": gas_price,
+            "nonce": nonce + i,
+            "chainId": 56,
+            "data": data,
+        }
+        txs.append(tx)
+        raws.append(w3.eth.account.sign_transaction(tx, pk).raw_transaction)
+        total_out += out
+
+    hashes = []
+    for tx, tx_hash in zip(txs, broadcast_raw_txs(raws)):
+        if tx_hash is None:
+            break
+        hashes.append(tx_hash)
+        watch_tx(user_id, tx, tx_hash, label="BUY")
+    if not hashes:
+        raise Exception("No endpoint accepted the transaction")
+    note_nonce(acct.address, nonce + len(hashes) - 1)
+    prewarm_stats["hits"] += 1
+    with prewarm_lock:
+        prewarm_cache.pop((user_id, token_address), None)
+    return hashes, total_out
+
+
+def record_confirm_latency(started):
+    ms = (time.time() - started) * 1000
+    confirm_latency.append(ms)
+    if ms > CONFIRM_TARGET_MS:
+        prewarm_stats["over_target"] += 1
+        print(f"Click-to-broadcast {ms:.0f} ms (target {CONFIRM_TARGET_MS:.0f} ms)")
 
 
 def approve_token_if_needed_for_wrapper(user_id, user_addr, user_pk, token_address, amount_wei):
-    token = get_token_contract(token_address)
-    current = token.functions.allowance(user_addr, WRAPPER_ADDRESS).call()
+    cached = cached_allowance(user_addr, token_address)
+    if cached is not None and cached >= amount_wei:
+        return None
+    current = call_allowance(token_address, user_addr)
+    set_allowance(user_addr, token_address, current)
     if current >= amount_wei:
         return None
 
-    max_uint = 2**256 - 1
-    tx = token.functions.approve(WRAPPER_ADDRESS, max_uint).build_transaction(
-        {
-            "from": user_addr,
-            "gas": 150_000,
-            "gasPrice": get_user_gas_price(user_id),
-            "nonce": w3.eth.get_transaction_count(user_addr),
-            "chainId": 56,
-        }
-    )
+    nonce = next_nonce(user_addr)
+    tx = {
+        "from": user_addr,
+        "to": Web3.to_checksum_address(token_address),
+        "value": 0,
+        "gas": 150_000,
+        "gasPrice": get_user_gas_price(user_id),
+        "nonce": nonce,
+        "chainId": 56,
+        "data": encode_approve(WRAPPER_ADDRESS, MAX_UINT256),
+    }
     signed = w3.eth.account.sign_transaction(tx, user_pk)
-    tx_hash = w3.eth.send_raw_transaction(signed.raw_transaction)
+    tx_hash = broadcast_raw_tx(signed.raw_transaction)
+    note_nonce(user_addr, nonce)
+    watch_tx(user_id, tx, tx_hash, label="Approval")
+    set_allowance(user_addr, token_address, MAX_UINT256)
+    record_approval(user_id, token_address, tx_hash)
     return tx_hash
 
 
@@ -592,8 +2628,7 @@ def swap_token_for_bnb(user_id, token_address, amount_tokens):
     if not acct:
         raise Exception("Wallet not connected")
 
-    token = get_token_contract(token_address)
-    decimals = token.functions.decimals().call()
+    decimals = token_decimals(token_address)
     amount_in_wei = int(amount_tokens * (10**decimals))
 
     # ensure wrapper approved
@@ -606,456 +2641,3345 @@ def swap_token_for_bnb(user_id, token_address, amount_tokens):
     slippage = settings.get("slippage", 0.03)
 
     path = list(reversed(get_path_for_buy(token_address)))
-    expected_out = router.functions.getAmountsOut(amount_in_wei, path).call()[-1]
+    expected_out = get_amounts_out(amount_in_wei, path)[-1]
     amount_out_min = int(expected_out * (1 - slippage))
     deadline = int(time.time()) + 600
 
-    tx = wrapper.functions.swapExactTokensForETHSupportingFeeOnTransferTokens(
-        amount_in_wei, amount_out_min, path, acct.address, deadline
-    ).build_transaction(
-        {
-            "from": acct.address,
-            "gas": 800000,
-            "gasPrice": get_user_gas_price(user_id),
-            "nonce": w3.eth.get_transaction_count(acct.address),
-            "chainId": 56,
-        }
-    )
+    nonce = next_nonce(acct.address)
+    tx = {
+        "from": acct.address,
+        "to": WRAPPER_ADDRESS,
+        "value": 0,
+        "gas": 800000,
+        "gasPrice": get_user_gas_price(user_id),
+        "nonce": nonce,
+        "chainId": 56,
+        "data": encode_swap_tokens_for_eth(amount_in_wei, amount_out_min, path, acct.address, deadline),
+    }
     signed = w3.eth.account.sign_transaction(tx, pk)
-    tx_hash = w3.eth.send_raw_transaction(signed.raw_transaction)
-    return w3.to_hex(tx_hash), expected_out
+    tx_hash = broadcast_raw_tx(signed.raw_transaction)
+    note_nonce(acct.address, nonce)
+    watch_tx(user_id, tx, tx_hash, label="SELL")
+    spend_allowance(acct.address, token_address, amount_in_wei)
+    return tx_hash, expected_out
 
 
 # ---------- Portfolio / positions ----------
-def update_position_buy(user_id, token_addr, symbol, tokens_bought, price_usd):
-    profile = ensure_profile(user_id)
-    if not profile:
-        return
-    positions = profile["positions"]
-    t = token_addr
-    old = positions.get(t)
-    if old:
-        old_amount = old["amount"]
-        old_avg = old["avg_price_usd"]
-        new_amount = old_amount + tokens_bought
+def update_position_buy(user_id, token_addr, symbol, tokens_bought, price_usd, save=True):
+    with users_lock:
+        profile = ensure_profile(user_id)
+        if not profile:
+            return
+        positions = profile["positions"]
+        t = token_addr
+        old = positions.get(t)
+        if old:
+            old_amount = old["amount"]
+            old_avg = old["avg_price_usd"]
+            new_amount = old_amount + tokens_bought
+            if new_amount <= 0:
+                positions.pop(t, None)
+            else:
+                new_avg = (old_amount * old_avg + tokens_bought * price_usd) / new_amount
+                positions[t] = {"symbol": symbol, "amount": new_amount, "avg_price_usd": new_avg}
+        else:
+            positions[t] = {"symbol": symbol, "amount": tokens_bought, "avg_price_usd": price_usd}
+        if save:
+            save_users(users)
+
+
+def update_position_sell(user_id, token_addr, tokens_sold, save=True):
+    with users_lock:
+        profile = ensure_profile(user_id)
+        if not profile:
+            return
+        positions = profile["positions"]
+        t = token_addr
+        old = positions.get(t)
+        if not old:
+            return
+        new_amount = old["amount"] - tokens_sold
         if new_amount <= 0:
             positions.pop(t, None)
         else:
-            new_avg = (old_amount * old_avg + tokens_bought * price_usd) / new_amount
-            positions[t] = {"symbol": symbol, "amount": new_amount, "avg_price_usd": new_avg}
-    else:
-        positions[t] = {"symbol": symbol, "amount": tokens_bought, "avg_price_usd": price_usd}
-    save_users(users)
-
+            old["amount"] = new_amount
+            positions[t] = old
+        if save:
+            save_users(users)
 
-def update_position_sell(user_id, token_addr, tokens_sold):
-    profile = ensure_profile(user_id)
-    if not profile:
-        return
-    positions = profile["positions"]
-    t = token_addr
-    old = positions.get(t)
-    if not old:
-        return
-    new_amount = old["amount"] - tokens_sold
-    if new_amount <= 0:
-        positions.pop(t, None)
-    else:
-        old["amount"] = new_amount
-        positions[t] = old
-    save_users(users)
 
+def reprice_position(user_id, token_addr, symbol, remove_amount, remove_price, add_amount, add_price):
+    """
+    Replaces part of a position (an optimistic fill) with another fill, keeping
+    avg_price_usd the cost-weighted mean of what is left.
+    """
+    with users_lock:
+        profile = ensure_profile(user_id)
+        if not profile:
+            return
+        positions = profile["positions"]
+        old = positions.get(token_addr) or {"symbol": symbol, "amount": 0.0, "avg_price_usd": 0.0}
+        new_amount = old["amount"] - remove_amount + add_amount
+        cost = old["amount"] * old["avg_price_usd"] - remove_amount * remove_price + add_amount * add_price
+        if new_amount <= 1e-12:
+            positions.pop(token_addr, None)
+        else:
+            positions[token_addr] = {
+                "symbol": old.get("symbol", symbol),
+                "amount": new_amount,
+                "avg_price_usd": max(cost / new_amount, 0.0),
+            }
+        save_users(users)
 
-# ---------- Callback handler ----------
-def handle_callback(cb):
-    chat_id = cb["message"]["chat"]["id"]
-    user_id = cb["from"]["id"]
-    msg_id = cb["message"]["message_id"]
-    data = cb["data"]
-    uid = str(user_id)
-    has_wallet = uid in users
 
-    # connect / disconnect / basics
-    if data == "connect_wallet":
-        user_states[user_id] = {"step": "await_pk", "data": {}}
-        edit_message(
-            chat_id,
-            msg_id,
-            "🔐 Send your PRIVATE KEY.\n\n⚠ Use a fresh wallet. You are responsible for your funds.",
-        )
-        return
+# ---------- Token discovery ----------
+# Tokens that reach a connected wallet from outside the bot join its positions.
+# Each new block range is one eth_getLogs for Transfer events whose recipient
+# (topic2) is any of the owned wallets, so the cost follows new blocks rather
+# than users. A wallet connected after the checkpoint gets a one-off scan of
+# its last DISCOVERY_BACKFILL_BLOCKS. Discovered positions have no cost basis.
+# Only tokens with a route whose BNB side holds DISCOVERY_MIN_LIQUIDITY_BNB are
+# adopted, which keeps airdropped spam (no pair, or a dust pair) out.
+DISCOVERY_FILE = os.getenv("DISCOVERY_FILE", "discovery.json")
+DISCOVERY_POLL_SEC = float(os.getenv("DISCOVERY_POLL_SEC", "6"))
+DISCOVERY_BACKFILL_BLOCKS = int(os.getenv("DISCOVERY_BACKFILL_BLOCKS", "100000"))
+DISCOVERY_MIN_LIQUIDITY_BNB = float(os.getenv("DISCOVERY_MIN_LIQUIDITY_BNB", "1"))
+DISCOVERY_WALLETS_PER_QUERY = int(os.getenv("DISCOVERY_WALLETS_PER_QUERY", "1000"))  # topic OR-list cap of most nodes
+discovery_state = {"block": None, "wallets": []}
+discovery_stats = {"scanned_blocks": 0, "queries": 0, "found": 0, "illiquid": 0}
+
+
+def load_discovery():
+    path = shard_path(DISCOVERY_FILE)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                discovery_state.update(json.load(f))
+        except Exception as e:
+            print("Discovery checkpoint load error:", e)
 
-    if data == "disconnect":
-        if uid in users:
-            del users[uid]
-            save_users(users)
-        user_states.pop(user_id, None)
-        edit_message(chat_id, msg_id, "Wallet disconnected.", get_main_menu(False))
-        return
 
-    if data == "wallet":
-        if not has_wallet:
-            edit_message(chat_id, msg_id, "No wallet connected.", get_main_menu(False))
-            return
-        acct, _ = get_user_account(user_id)
-        bnb_balance = w3.from_wei(w3.eth.get_balance(acct.address), "ether")
-        text = f"💼 *Wallet*\n\nAddress:\n`{acct.address}`\n\nBNB Balance: *{bnb_balance}*"
-        edit_message(chat_id, msg_id, text, get_main_menu(True))
-        return
-
-    if data == "help":
-        text = (
-            "🤖 *BSC Multi-User Trading Bot*\n\n"
-            "1️⃣ Connect wallet (fresh wallet only)\n"
-            "2️⃣ Tap Trade → Buy or Sell\n"
-            "3️⃣ Paste token contract address\n"
-            "4️⃣ Bot shows price / MC / holders / risk\n"
-            "5️⃣ Proceed → choose % or custom amount → confirm\n\n"
-            "⚠ Only run this bot on your own server. Trades through this bot pay a fee to the operator."
-        )
-        edit_message(chat_id, msg_id, text, get_main_menu(has_wallet))
-        return
+def _save_discovery():
+    path = shard_path(DISCOVERY_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(discovery_state, f)
+    os.replace(path + ".tmp", path)
 
-    if data == "trade_menu":
-        if not has_wallet:
-            edit_message(chat_id, msg_id, "Connect a wallet first.", get_main_menu(False))
-            return
-        buttons = [
-            [
-                {"text": "🟢 Buy (BNB → Token)", "callback_data": "buy_flow"},
-                {"text": "🔴 Sell (Token → BNB)", "callback_data": "sell_flow"},
-            ],
-            [{"text": "⬅️ Back", "callback_data": "back_main"}],
-        ]
-        edit_message(chat_id, msg_id, "Choose trade type:", buttons)
-        return
 
-    if data == "back_main":
-        edit_message(chat_id, msg_id, "Main menu:", get_main_menu(has_wallet))
-        return
+def owned_wallets():
+    """{lowercase address: uid} of the wallets this process owns."""
+    with users_lock:
+        return {
+            w["address"].lower(): uid
+            for uid, p in users.items()
+            if owns_user(uid) and p.get("address")
+            for w in [p] + p.get("wallets", [])
+        }
 
-    # settings menu
-    if data == "settings":
-        settings = get_user_settings(user_id) if has_wallet else {"slippage": 0.03, "gas_mode": "standard"}
-        slip = settings["slippage"] * 100
-        mode = settings["gas_mode"]
-        text = (
-            "⚙ *Settings*\n\n"
-            f"Slippage: *{slip:.1f}%*\n"
-            f"Gas mode: *{mode}*\n\n"
-            "Adjust below:"
-        )
-        buttons = [
-            [
-                {"text": "Slippage 1%", "callback_data": "set_slip_1"},
-                {"text": "3%", "callback_data": "set_slip_3"},
-                {"text": "5%", "callback_data": "set_slip_5"},
-            ],
-            [
-                {"text": "Gas: standard", "callback_data": "set_gas_standard"},
-                {"text": "fast", "callback_data": "set_gas_fast"},
-                {"text": "turbo", "callback_data": "set_gas_turbo"},
-            ],
-            [{"text": "⬅️ Back", "callback_data": "back_main"}],
-        ]
-        edit_message(chat_id, msg_id, text, buttons)
-        return
 
-    if data.startswith("set_slip_"):
-        if not has_wallet:
-            edit_message(chat_id, msg_id, "Connect wallet first.", get_main_menu(False))
-            return
-        profile = ensure_profile(user_id)
-        if data == "set_slip_1":
-            profile["settings"]["slippage"] = 0.01
-        elif data == "set_slip_3":
-            profile["settings"]["slippage"] = 0.03
-        elif data == "set_slip_5":
-            profile["settings"]["slippage"] = 0.05
-        save_users(users)
-        # refresh settings menu
-        handle_callback({"message": cb["message"], "from": cb["from"], "data": "settings"})
-        return
+def scan_incoming(wallets, from_block, to_block):
+    """{(wallet, token)} received in [from_block, to_block], one OR-list query per chunk of wallets."""
+    found = set()
+    for i in range(0, len(wallets), DISCOVERY_WALLETS_PER_QUERY):
+        topics = [TRANSFER_TOPIC, None, [address_to_topic(w) for w in wallets[i : i + DISCOVERY_WALLETS_PER_QUERY]]]
 
-    if data.startswith("set_gas_"):
-        if not has_wallet:
-            edit_message(chat_id, msg_id, "Connect wallet first.", get_main_menu(False))
-            return
-        profile = ensure_profile(user_id)
-        if data == "set_gas_standard":
-            profile["settings"]["gas_mode"] = "standard"
-        elif data == "set_gas_fast":
-            profile["settings"]["gas_mode"] = "fast"
-        elif data == "set_gas_turbo":
-            profile["settings"]["gas_mode"] = "turbo"
-        save_users(users)
-        handle_callback({"message": cb["message"], "from": cb["from"], "data": "settings"})
-        return
+        def on_logs(logs, _):
+            discovery_stats["queries"] += 1
+            found.update((topic_to_address(log["topics"][2]).lower(), log["address"]) for log in logs if len(log["topics"]) == 3)
 
-    # portfolio
-    if data == "portfolio":
-        if not has_wallet:
-            edit_message(chat_id, msg_id, "Connect wallet first.", get_main_menu(False))
-            return
-        positions = get_user_positions(user_id)
-        if not positions:
-            edit_message(chat_id, msg_id, "📊 No tracked positions yet.", get_main_menu(True))
-            return
+        scan_logs(None, topics, from_block, to_block, on_logs)
+    return found
 
-        total_value = 0.0
-        lines = ["📊 *Portfolio*"]
-        for t, p in positions.items():
-            symbol = p["symbol"]
-            amount = p["amount"]
-            avg = p["avg_price_usd"]
-            try:
-                info = get_token_info(t)
-                price = info["price_usd"]
-                if price is None:
-                    lines.append(f"\n{symbol} ({t}):\nAmount: {format_number(amount)}\nPrice: Unknown")
-                    continue
-                val = amount * price
-                pnl_pct = (price - avg) / avg * 100 if avg > 0 else 0
-                total_value += val
-                lines.append(
-                    f"\n*{symbol}*\nCA: `{t}`\n"
-                    f"Amount: {format_number(amount)}\n"
-                    f"Avg: ${format_number(avg)}\n"
-                    f"Now: ${format_number(price)}\n"
-                    f"Value: ${format_number(val)}\n"
-                    f"PnL: {pnl_pct:+.2f}%"
-                )
-            except Exception as e:
-                lines.append(f"\n{symbol} ({t}): error fetching price: {e}")
-        lines.append(f"\n*Total est. value:* ${format_number(total_value)}")
-        edit_message(chat_id, msg_id, "\n".join(lines), get_main_menu(True))
-        return
 
-    # trade flows
-    if data == "buy_flow":
-        user_states[user_id] = {"step": "await_buy_token", "data": {}}
-        edit_message(chat_id, msg_id, "🟢 Send *token contract address* to BUY:", None)
+def tradable(token):
+    """Whether the token has a route whose entry pool holds DISCOVERY_MIN_LIQUIDITY_BNB."""
+    try:
+        hops = path_hops(get_path_for_buy(token))
+    except Exception:
+        return False
+    return bool(hops) and hops[0][0] >= w3.to_wei(DISCOVERY_MIN_LIQUIDITY_BNB, "ether")
+
+
+def adopt_tokens(found, owners):
+    """Adds received tradable tokens the wallets still hold to their owners' positions."""
+    new = []
+    with users_lock:
+        for wallet, token in found:
+            token = Web3.to_checksum_address(token)
+            profile = ensure_profile(owners.get(wallet))
+            if profile and token not in profile["positions"]:
+                new.append((wallet, token))
+    if not new:
         return
-
-    if data == "sell_flow":
-        user_states[user_id] = {"step": "await_sell_token", "data": {}}
-        edit_message(chat_id, msg_id, "🔴 Send *token contract address* to SELL:", None)
+    _, balances = fetch_balances(pairs=[(w, t) for w, t in new])
+    added = []
+    for wallet, token in new:
+        raw = balances.get((wallet, token.lower()), 0)
+        if raw <= 0:
+            continue
+        if not tradable(token):
+            discovery_stats["illiquid"] += 1
+            continue
+        try:
+            meta = get_token_meta(token)
+        except Exception:
+            continue  # not an ERC-20 we can read
+        added.append((owners[wallet], token, meta["symbol"], raw / 10 ** meta["decimals"]))
+    if not added:
         return
+    with users_lock:
+        for uid, token, symbol, amount in added:
+            profile = ensure_profile(uid)
+            if profile and token not in profile["positions"]:
+                profile["positions"][token] = {"symbol": symbol, "amount": amount, "avg_price_usd": 0.0, "discovered": True}
+                discovery_stats["found"] += 1
+        save_users(users)
 
-    if data == "buy_proceed":
-        state = user_states.get(user_id)
-        if not state or state.get("step") != "await_buy_proceed":
-            edit_message(chat_id, msg_id, "No token selected for BUY.", get_main_menu(has_wallet))
-            return
-        state["step"] = "await_buy_amount"
-        token_addr = state["data"]["token"]
-        # ask amount with presets
-        buttons = [
-            [
-                {"text": "25% BNB", "callback_data": "buy_pct_25"},
-                {"text": "50%", "callback_data": "buy_pct_50"},
-                {"text": "100%", "callback_data": "buy_pct_100"},
-            ],
-        ]
-        send_message(
-            chat_id,
-            "Enter BNB amount to BUY (e.g. `0.01`) or use presets below:",
-            buttons,
-        )
-        return
 
-    if data == "sell_proceed":
-        state = user_states.get(user_id)
-        if not state or state.get("step") != "await_sell_proceed":
-            edit_message(chat_id, msg_id, "No token selected for SELL.", get_main_menu(has_wallet))
-            return
-        state["step"] = "await_sell_amount"
-        token_addr = state["data"]["token"]
-        acct, _ = get_user_account(user_id)
-        balance_info = ""
+def discover_tokens():
+    head = head_block()
+    owners = owned_wallets()
+    if discovery_state["block"] is None:
+        discovery_state.update({"block": head, "wallets": []})
+    known = set(discovery_state["wallets"])
+    fresh = [w for w in owners if w not in known]
+    found = set()
+    if fresh:
+        found |= scan_incoming(fresh, max(discovery_state["block"] - DISCOVERY_BACKFILL_BLOCKS, 0), discovery_state["block"])
+    if head > discovery_state["block"] and owners:
+        found |= scan_incoming(list(owners), discovery_state["block"] + 1, head)
+        discovery_stats["scanned_blocks"] += head - discovery_state["block"]
+    adopt_tokens(found, owners)
+    discovery_state.update({"block": head, "wallets": sorted(owners)})
+    _save_discovery()
+
+
+def discovery_worker():
+    load_discovery()
+    while True:
         try:
-            token = get_token_contract(token_addr)
-            decimals = token.functions.decimals().call()
-            symbol = token.functions.symbol().call()
-            bal_raw = token.functions.balanceOf(acct.address).call()
-            bal_human = bal_raw / (10**decimals)
-            balance_info = f"\nYour balance: {format_number(bal_human)} {symbol}"
+            discover_tokens()
+        except Exception as e:
+            print("Token discovery error:", e)
+        time.sleep(DISCOVERY_POLL_SEC)
+
+
+# ---------- OHLC candles from pair Sync events ----------
+# USD candles (1m / 5m / 1h) for watched tokens, built from the Sync events of
+# their pairs. Closed candles are appended to one file per column
+# (candles/<token>_<interval>.{t,o,h,l,c}): int64 bucket starts and float64
+# prices. Range reads bisect the time column through mmap and slice the other
+# columns as arrays, so a query touches only the rows it returns.
+CANDLE_DIR = os.getenv("CANDLE_DIR", "candles")
+CANDLE_META_FILE = os.path.join(CANDLE_DIR, "meta.json")
+CANDLE_INTERVALS = (60, 300, 3600)
+CANDLE_POLL_SEC = float(os.getenv("CANDLE_POLL_SEC", "3"))
+CANDLE_MAX_WATCH = int(os.getenv("CANDLE_MAX_WATCH", "2000"))
+CANDLE_ADDRESS_GROUP = 500  # pair addresses per eth_getLogs filter
+SYNC_TOPIC = Web3.to_hex(Web3.keccak(text="Sync(uint112,uint112)"))
+CANDLE_COLUMNS = (("t", "q"), ("o", "d"), ("h", "d"), ("l", "d"), ("c", "d"))
+
+candle_lock = threading.Lock()
+candle_state = {"last_block": 0, "bnb_usd": None}
+candle_watch = {}  # pair -> {"token", "quote", "token_is_0", "decimals"}
+candle_watched_tokens = set()
+open_candles = {}  # (token, interval) -> [t, o, h, l, c]
+
+
+def _candle_path(token, interval, col):
+    return os.path.join(CANDLE_DIR, f"{token.lower()}_{interval}.{col}")
+
+
+def load_candle_meta():
+    os.makedirs(CANDLE_DIR, exist_ok=True)
+    if not os.path.exists(CANDLE_META_FILE):
+        return
+    try:
+        with open(CANDLE_META_FILE, "r") as f:
+            meta = json.load(f)
+        candle_state["last_block"] = meta["last_block"]
+        candle_watch.update(meta["watch"])
+        candle_watched_tokens.update(w["token"] for w in candle_watch.values())
+    except Exception as e:
+        print("Candle meta unreadable:", e)
+
+
+def _save_candle_meta():
+    tmp = CANDLE_META_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"last_block": candle_state["last_block"], "watch": candle_watch}, f)
+    os.replace(tmp, CANDLE_META_FILE)
+
+
+def watch_token_candles(token_address, route, decimals):
+    """Starts building candles for a token from the pair on the last hop of its buy route."""
+    token = Web3.to_checksum_address(token_address)
+    if token in candle_watched_tokens or not route or len(candle_watched_tokens) >= CANDLE_MAX_WATCH:
+        return
+    quote = route[-2]
+    pair = resolve_pair(quote, token)
+    if not pair:
+        return
+    entry = {
+        "token": token,
+        "quote": quote,
+        "token_is_0": token.lower() < quote.lower(),
+        "decimals": decimals,
+    }
+    with candle_lock:
+        candle_watched_tokens.add(token)
+        if SHARD["role"] == "worker":
+            # the intake process builds candles; hand the pair over through the shared store
+            shared_store["candle_watch_add"][pair] = entry
+        else:
+            candle_watch[pair] = entry
+
+
+def _flush_candles(closed):
+    for (token, interval), rows in closed.items():
+        for idx, (col, typecode) in enumerate(CANDLE_COLUMNS):
+            with open(_candle_path(token, interval, col), "ab") as f:
+                f.write(array(typecode, [row[idx] for row in rows]).tobytes())
+
+
+def _update_candles(token, ts, price, closed):
+    for interval in CANDLE_INTERVALS:
+        bucket = ts - ts % interval
+        key = (token, interval)
+        cur = open_candles.get(key)
+        if cur and cur[0] == bucket:
+            cur[2] = max(cur[2], price)
+            cur[3] = min(cur[3], price)
+            cur[4] = price
+        elif cur and bucket < cur[0]:
+            continue  # late event for an already closed bucket
+        else:
+            if cur:
+                closed.setdefault(key, []).append(cur)
+            open_candles[key] = [bucket, price, price, price, price]
+
+
+def _block_timestamps(logs):
+    stamps = {}
+    missing = set()
+    for log in logs:
+        if log.get("blockTimestamp"):
+            stamps[log["blockNumber"]] = int(log["blockTimestamp"], 16)
+        else:
+            missing.add(log["blockNumber"])
+    missing -= set(stamps)
+    blocks = sorted(missing)
+    for bn, resp in zip(blocks, rpc_batch_chunked([("eth_getBlockByNumber", [bn, False]) for bn in blocks])):
+        if resp.get("result"):
+            stamps[bn] = int(resp["result"]["timestamp"], 16)
+    return stamps
+
+
+def _apply_sync_logs(logs):
+    logs = sorted(logs, key=lambda log: (int(log["blockNumber"], 16), int(log["logIndex"], 16)))
+    stamps = _block_timestamps(logs)
+    bnb_pair = resolve_pair(WBNB, BUSD)
+    closed = {}
+    with candle_lock:
+        for log in logs:
+            pair = Web3.to_checksum_address(log["address"])
+            watch = candle_watch.get(pair)
+            ts = stamps.get(log["blockNumber"])
+            if not watch or ts is None:
+                continue
+            data = log["data"][2:]
+            r0, r1 = int(data[:64], 16), int(data[64:128], 16)
+            token_res, quote_res = (r0, r1) if watch["token_is_0"] else (r1, r0)
+            if token_res == 0 or quote_res == 0:
+                continue
+            price = (quote_res / 1e18) / (token_res / 10 ** watch["decimals"])
+            if pair == bnb_pair:
+                # BNB per BUSD: invert into the BNB/USD rate later events are priced with
+                candle_state["bnb_usd"] = 1 / price
+                _update_candles(WBNB, ts, candle_state["bnb_usd"], closed)
+                continue
+            if watch["quote"] == WBNB:
+                if not candle_state["bnb_usd"]:
+                    continue
+                price *= candle_state["bnb_usd"]
+            _update_candles(watch["token"], ts, price, closed)
+        _flush_candles(closed)
+
+
+def sync_candles():
+    bnb_pair = resolve_pair(WBNB, BUSD)
+    if bnb_pair and bnb_pair not in candle_watch:
+        with candle_lock:
+            # stored like a token priced in BUSD; _apply_sync_logs inverts it into BNB/USD
+            candle_watch[bnb_pair] = {
+                "token": BUSD,
+                "quote": WBNB,
+                "token_is_0": BUSD.lower() < WBNB.lower(),
+                "decimals": 18,
+            }
+    if shared_store is not None:
+        requested = shared_store["candle_watch_add"]
+        for pair, entry in requested.items():
+            with candle_lock:
+                candle_watch.setdefault(pair, entry)
+                candle_watched_tokens.add(entry["token"])
+            requested.pop(pair, None)
+    if candle_state["bnb_usd"] is None:
+        candle_state["bnb_usd"] = get_bnb_price_usd()
+    head = w3.eth.block_number
+    start = candle_state["last_block"] + 1 if candle_state["last_block"] else head
+    if start > head:
+        return
+    with candle_lock:
+        pairs = list(candle_watch)
+    for i in range(0, len(pairs), CANDLE_ADDRESS_GROUP):
+        group = pairs[i : i + CANDLE_ADDRESS_GROUP]
+        scan_logs(group, [SYNC_TOPIC], start, head, lambda logs, end: _apply_sync_logs(logs))
+    candle_state["last_block"] = head
+    with candle_lock:
+        _save_candle_meta()
+        if shared_store is not None:
+            shared_store["candle_open"].update({f"{t}:{i}": c for (t, i), c in open_candles.items()})
+
+
+def candle_worker():
+    while True:
+        try:
+            sync_candles()
+        except Exception as e:
+            print("Candle sync error:", e)
+        time.sleep(CANDLE_POLL_SEC)
+
+
+def read_candles(token_address, interval, start_ts, end_ts):
+    """Closed candles with start_ts <= t < end_ts, plus the open one, as column arrays."""
+    token = Web3.to_checksum_address(token_address)
+    cols = {col: array(typecode) for col, typecode in CANDLE_COLUMNS}
+    with candle_lock:
+        t_path = _candle_path(token, interval, "t")
+        if os.path.exists(t_path) and os.path.getsize(t_path) > 0:
+            with open(t_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                base = memoryview(mm)
+                times = base.cast("q")
+                lo = bisect.bisect_left(times, start_ts)
+                hi = bisect.bisect_left(times, end_ts)
+                times.release()
+                base.release()
+                cols["t"].frombytes(mm[lo * 8 : hi * 8])
+            for col, typecode in CANDLE_COLUMNS[1:]:
+                with open(_candle_path(token, interval, col), "rb") as f:
+                    f.seek(lo * 8)
+                    cols[col].frombytes(f.read((hi - lo) * 8))
+            # a crash between column appends can leave columns of unequal length
+            n = min(len(a) for a in cols.values())
+            for col in cols:
+                del cols[col][n:]
+        if SHARD["role"] == "worker":
+            cur = shared_store["candle_open"].get(f"{token}:{interval}")
+        else:
+            cur = open_candles.get((token, interval))
+        if cur and start_ts <= cur[0] < end_ts:
+            for idx, (col, _) in enumerate(CANDLE_COLUMNS):
+                cols[col].append(cur[idx])
+    return cols
+
+
+def price_change(token_address, seconds, interval):
+    """(pct change over the window, high, low) from candles, or None without data."""
+    now = int(time.time())
+    cols = read_candles(token_address, interval, now - seconds - interval, now + interval)
+    if not cols["t"]:
+        return None
+    first = bisect.bisect_left(cols["t"], now - seconds)
+    first = max(first - 1, 0)  # close of the candle just before the window is the reference
+    ref = cols["c"][first]
+    last = cols["c"][-1]
+    high = max(cols["h"][first:])
+    low = min(cols["l"][first:])
+    return ((last / ref - 1) * 100 if ref else 0.0), high, low
+
+
+def trend_line(token_address):
+    """'1h / 24h change' overview line, empty until candles exist."""
+    try:
+        h1 = price_change(token_address, 3600, 60)
+        d1 = price_change(token_address, 86400, 300)
+    except Exception as e:
+        print("Trend read error:", e)
+        return ""
+    if not h1 and not d1:
+        return ""
+    parts = []
+    if h1:
+        parts.append(f"1h: {h1[0]:+.2f}%")
+    if d1:
+        parts.append(f"24h: {d1[0]:+.2f}% (H {format_number(d1[1])} / L {format_number(d1[2])})")
+    return "\nTrend: " + " | ".join(parts)
+
+
+# ---------- Trade ledger ----------
+# Append-only JSONL record of every settled buy/sell and every approval, with
+# running per-user / per-token aggregates (average-cost realized PnL, volume,
+# wrapper fees). Aggregates are snapshotted with the ledger offset they cover,
+# so a restart only replays the entries written since the last snapshot.
+LEDGER_FILE = os.getenv("LEDGER_FILE", "ledger.jsonl")
+LEDGER_SNAPSHOT_FILE = os.getenv("LEDGER_SNAPSHOT_FILE", "ledger.snapshot.json")
+LEDGER_SNAPSHOT_EVERY = int(os.getenv("LEDGER_SNAPSHOT_EVERY", "100"))
+LEDGER_HISTORY_LEN = 20
+
+ledger_lock = threading.Lock()
+ledger_state = {"seq": 0, "offset": 0, "since_snapshot": 0}
+ledger_users = {}  # uid -> aggregates
+ledger_history = {}  # uid -> deque of latest entries
+wrapper_fee_cache = {}
+
+
+def get_wrapper_fee_bps():
+    """Wrapper fee in basis points: WRAPPER_FEE_BPS if set, else the contract's feeBasisPoints()."""
+    if "bps" not in wrapper_fee_cache:
+        env_bps = os.getenv("WRAPPER_FEE_BPS")
+        if env_bps:
+            wrapper_fee_cache["bps"] = int(env_bps)
+        else:
+            try:
+                res = rpc_call("eth_call", [{"to": WRAPPER_ADDRESS, "data": FEE_BASIS_POINTS_SELECTOR}, "latest"])
+                wrapper_fee_cache["bps"] = int(res, 16)
+            except Exception as e:
+                print("Wrapper fee read error:", e)
+                return 0
+    return wrapper_fee_cache["bps"]
+
+
+def _new_user_aggregate():
+    return {"trades": 0, "volume_bnb": 0.0, "fees_bnb": 0.0, "realized_usd": 0.0, "tokens": {}}
+
+
+def _apply_ledger_entry(e):
+    uid = str(e["user_id"])
+    agg = ledger_users.setdefault(uid, _new_user_aggregate())
+    ledger_history.setdefault(uid, deque(maxlen=LEDGER_HISTORY_LEN)).append(e)
+    if e["kind"] not in ("buy", "sell") or e["status"] != "ok":
+        return
+    t = agg["tokens"].setdefault(
+        e["token"],
+        {"symbol": e["symbol"], "qty": 0.0, "cost_usd": 0.0, "realized_usd": 0.0,
+         "bought": 0.0, "sold": 0.0, "fees_bnb": 0.0, "trades": 0},
+    )
+    fee = e.get("wrapper_fee_bnb", 0.0)
+    if e["kind"] == "buy":
+        t["qty"] += e["tokens"]
+        t["cost_usd"] += e["value_usd"]
+        t["bought"] += e["tokens"]
+    else:
+        # average cost: only the part of the sale covered by tracked buys realizes PnL against cost
+        covered = min(e["tokens"], t["qty"])
+        avg = t["cost_usd"] / t["qty"] if t["qty"] > 0 else 0.0
+        realized = (e["value_usd"] * covered / e["tokens"] if e["tokens"] else 0.0) - covered * avg
+        t["realized_usd"] += realized
+        agg["realized_usd"] += realized
+        t["cost_usd"] -= covered * avg
+        t["qty"] -= covered
+        t["sold"] += e["tokens"]
+    t["fees_bnb"] += fee
+    t["trades"] += 1
+    agg["trades"] += 1
+    agg["volume_bnb"] += e["bnb"]
+    agg["fees_bnb"] += fee
+
+
+def _save_ledger_snapshot():
+    snap = {
+        "seq": ledger_state["seq"],
+        "offset": ledger_state["offset"],
+        "users": ledger_users,
+        "history": {uid: list(h) for uid, h in ledger_history.items()},
+    }
+    path = shard_path(LEDGER_SNAPSHOT_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(snap, f)
+    os.replace(path + ".tmp", path)
+    ledger_state["since_snapshot"] = 0
+
+
+def load_ledger():
+    snapshot_path = shard_path(LEDGER_SNAPSHOT_FILE)
+    if os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, "r") as f:
+                snap = json.load(f)
+            ledger_state["seq"] = snap["seq"]
+            ledger_state["offset"] = snap["offset"]
+            ledger_users.update(snap["users"])
+            for uid, h in snap["history"].items():
+                ledger_history[uid] = deque(h, maxlen=LEDGER_HISTORY_LEN)
+        except Exception as e:
+            print("Ledger snapshot unreadable, replaying full ledger:", e)
+            ledger_state.update({"seq": 0, "offset": 0})
+            ledger_users.clear()
+            ledger_history.clear()
+    if not os.path.exists(LEDGER_FILE):
+        return
+    replayed = 0
+    with file_lock(LEDGER_FILE), open(LEDGER_FILE, "r+b") as f:
+        f.seek(ledger_state["offset"])
+        for line in f:
+            if not line.endswith(b"\n"):
+                # torn final write: cut it off, or the next append would leave it mid-file
+                f.truncate(ledger_state["offset"])
+                break
+            e = json.loads(line)
+            ledger_state["offset"] += len(line)
+            if not owns_user(e["user_id"]):
+                continue  # another shard's user
+            _apply_ledger_entry(e)
+            ledger_state["seq"] = e["seq"]
+            replayed += 1
+    if replayed:
+        _save_ledger_snapshot()
+
+
+def record_ledger(entry):
+    """Appends one entry (kind, status, user_id, token, symbol, txs, tokens, bnb, value_usd, ...)."""
+    with ledger_lock:
+        ledger_state["seq"] += 1
+        entry = {"seq": ledger_state["seq"], "ts": int(time.time()), **entry}
+        line = (json.dumps(entry) + "\n").encode()
+        with file_lock(LEDGER_FILE), open(LEDGER_FILE, "ab") as f:
+            f.write(line)
+            # other shards append to the same file; their entries are not ours to replay
+            ledger_state["offset"] = f.tell()
+        _apply_ledger_entry(entry)
+        ledger_state["since_snapshot"] += 1
+        if ledger_state["since_snapshot"] >= LEDGER_SNAPSHOT_EVERY:
+            _save_ledger_snapshot()
+    return entry
+
+
+def record_approval(user_id, token_address, tx_hash):
+    record_ledger(
+        {
+            "kind": "approve",
+            "status": "sent",
+            "user_id": user_id,
+            "token": Web3.to_checksum_address(token_address),
+            "symbol": "",
+            "txs": [tx_hash],
+            "tokens": 0.0,
+            "bnb": 0.0,
+            "price_usd": 0.0,
+            "value_usd": 0.0,
+        }
+    )
+
+
+def get_user_history(user_id):
+    with ledger_lock:
+        return list(ledger_history.get(str(user_id), []))
+
+
+def get_user_pnl(user_id):
+    with ledger_lock:
+        agg = ledger_users.get(str(user_id))
+        return json.loads(json.dumps(agg)) if agg else None
+
+
+def spot_prices_usd(tokens):
+    """USD spot price per token from cached reserves (one batch for all tokens)."""
+    prices = {}
+    paths = {}
+    for token in tokens:
+        try:
+            paths[token] = get_path_for_buy(token)
         except Exception:
-            pass
-        buttons = [
+            continue
+    # warm the reserves cache for every hop at once; path_hops below then hits the cache
+    pairs = {resolve_pair(a, b) for path in list(paths.values()) + [[WBNB, BUSD]] for a, b in zip(path, path[1:])}
+    fetch_reserves([p for p in pairs if p])
+    bnb_hops = path_hops([WBNB, BUSD])
+    if not bnb_hops:
+        return prices
+    bnb_usd = bnb_hops[0][1] / bnb_hops[0][0]
+    for token, path in paths.items():
+        try:
+            hops = path_hops(path)
+            if not hops:
+                continue
+            ea, eb = virtual_pool(hops)
+            decimals = token_decimals(token)
+            tokens_per_bnb = eb / ea * 10**18 / 10**decimals
+            prices[token] = bnb_usd / tokens_per_bnb if tokens_per_bnb else None
+        except Exception:
+            continue
+    return prices
+
+
+def token_decimals(token_address):
+    return get_token_meta(token_address)["decimals"]
+
+
+# ---------- Wrapper revenue index ----------
+# Revenue, volume and fees of every swap through the wrapper, indexed from its
+# fee event rather than from the bot's own ledger, so swaps made outside the bot
+# count too. WRAPPER_FEE_EVENT is the event's signature; its parameters must be
+# (user, token, volume, fee) in that order, indexed or not, with volume and fee
+# in wei of BNB. There is no default: without WRAPPER_FEE_EVENT the index is
+# off, and /revenue reports nothing until a log of the event has been seen,
+# since a wrong signature would otherwise read as zero revenue. Rollups per UTC
+# day, token and user live in revenue.json together with the last indexed block
+# and the event's topic, so a restart resumes where it stopped and /revenue
+# reads them without touching the chain. A backfill fetches LOG_CHUNK_BLOCKS
+# ranges in parallel and applies them in block order.
+WRAPPER_FEE_EVENT = os.getenv("WRAPPER_FEE_EVENT", "")
+WRAPPER_FEE_TOPIC = Web3.to_hex(Web3.keccak(text=WRAPPER_FEE_EVENT)) if WRAPPER_FEE_EVENT else None
+REVENUE_FILE = os.getenv("REVENUE_FILE", "revenue.json")
+REVENUE_BACKFILL_DAYS = int(os.getenv("REVENUE_BACKFILL_DAYS", "30"))  # history indexed on the first run
+REVENUE_CONFIRMATIONS = int(os.getenv("REVENUE_CONFIRMATIONS", "15"))
+REVENUE_POLL_SEC = float(os.getenv("REVENUE_POLL_SEC", "30"))
+REVENUE_FETCH_THREADS = int(os.getenv("REVENUE_FETCH_THREADS", "8"))
+REVENUE_WAVE_CHUNKS = 64  # ranges fetched between checkpoints
+
+revenue_lock = threading.Lock()
+revenue = {"topic": WRAPPER_FEE_TOPIC, "block": None, "swaps": 0, "volume": 0, "fees": 0, "days": {}, "tokens": {}, "users": {}}
+
+
+def _new_rollup():
+    return {"swaps": 0, "volume": 0, "fees": 0}
+
+
+def _add_rollup(rollup, volume, fee):
+    rollup["swaps"] += 1
+    rollup["volume"] += volume
+    rollup["fees"] += fee
+
+
+def load_revenue():
+    if not os.path.exists(REVENUE_FILE):
+        return
+    try:
+        with open(REVENUE_FILE, "r") as f:
+            data = json.load(f)
+    except Exception as e:
+        print("Revenue index load error:", e)
+        return
+    if data.get("topic") != WRAPPER_FEE_TOPIC:
+        print(f"Revenue index in {REVENUE_FILE} is for another fee event, re-indexing")
+        return
+    with revenue_lock:
+        revenue.update(data)
+
+
+def _save_revenue():
+    tmp = REVENUE_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(revenue, f)
+    os.replace(tmp, REVENUE_FILE)
+
+
+def decode_fee_log(log):
+    """(user, token, volume wei, fee wei) from a fee event, whichever of its parameters are indexed."""
+    data = log["data"][2:]
+    words = [t[2:] for t in log["topics"][1:]] + [data[i : i + 64] for i in range(0, len(data), 64)]
+    if len(words) != 4:
+        raise Exception(f"{WRAPPER_FEE_EVENT} log has {len(words)} parameters, expected (user, token, volume, fee)")
+    return (
+        Web3.to_checksum_address("0x" + words[0][-40:]),
+        Web3.to_checksum_address("0x" + words[1][-40:]),
+        int(words[2], 16),
+        int(words[3], 16),
+    )
+
+
+def block_timestamps(blocks):
+    resps = rpc_batch_chunked([("eth_getBlockByNumber", [hex(b), False]) for b in blocks])
+    out = {}
+    for b, resp in zip(blocks, resps):
+        if not resp.get("result"):
+            raise Exception(f"block {b} unavailable: {resp.get('error')}")
+        out[b] = int(resp["result"]["timestamp"], 16)
+    return out
+
+
+def fetch_fee_range(start, end):
+    """Fee logs of [start, end] with their block timestamps."""
+    logs = []
+    scan_logs(WRAPPER_ADDRESS, [WRAPPER_FEE_TOPIC], start, end, lambda chunk, _: logs.extend(chunk))
+    stamps = block_timestamps(sorted({int(log["blockNumber"], 16) for log in logs})) if logs else {}
+    return [(stamps[int(log["blockNumber"], 16)], decode_fee_log(log)) for log in logs if not log.get("removed")]
+
+
+def apply_fee_logs(entries, end):
+    with revenue_lock:
+        for ts, (user, token, volume, fee) in entries:
+            day = time.strftime("%Y-%m-%d", time.gmtime(ts))
+            revenue["swaps"] += 1
+            revenue["volume"] += volume
+            revenue["fees"] += fee
+            _add_rollup(revenue["days"].setdefault(day, _new_rollup()), volume, fee)
+            _add_rollup(revenue["tokens"].setdefault(token, _new_rollup()), volume, fee)
+            _add_rollup(revenue["users"].setdefault(user, _new_rollup()), volume, fee)
+        revenue["block"] = end
+
+
+def backfill_start_block(head):
+    """Block about REVENUE_BACKFILL_DAYS ago, from the chain's recent block time."""
+    sample = min(head, 100_000)
+    stamps = block_timestamps([head - sample, head])
+    block_time = max((stamps[head] - stamps[head - sample]) / sample, 0.1)
+    return max(head - int(REVENUE_BACKFILL_DAYS * 86400 / block_time), 0)
+
+
+def sync_revenue():
+    safe_head = w3.eth.block_number - REVENUE_CONFIRMATIONS
+    start = revenue["block"] + 1 if revenue["block"] is not None else backfill_start_block(safe_head)
+    if start > safe_head:
+        return
+    ranges = [(b, min(b + LOG_CHUNK_BLOCKS - 1, safe_head)) for b in range(start, safe_head + 1, LOG_CHUNK_BLOCKS)]
+    with ThreadPoolExecutor(max_workers=REVENUE_FETCH_THREADS) as pool:
+        for w in range(0, len(ranges), REVENUE_WAVE_CHUNKS):
+            wave = ranges[w : w + REVENUE_WAVE_CHUNKS]
+            # map yields in range order, so each range is applied only after every earlier one
+            for (_, end), entries in zip(wave, pool.map(lambda r: fetch_fee_range(*r), wave)):
+                apply_fee_logs(entries, end)
+            with revenue_lock:
+                _save_revenue()
+
+
+def revenue_worker():
+    if not WRAPPER_FEE_EVENT:
+        print("Revenue index off: set WRAPPER_FEE_EVENT to the wrapper's fee event signature")
+        return
+    load_revenue()
+    warned = False
+    while True:
+        try:
+            sync_revenue()
+            if revenue["block"] is not None and not revenue["swaps"] and not warned:
+                print(f"Revenue index: no {WRAPPER_FEE_EVENT} logs from {WRAPPER_ADDRESS} yet, check the signature")
+                warned = True
+        except Exception as e:
+            print("Revenue index error:", e)
+        time.sleep(REVENUE_POLL_SEC)
+
+
+def revenue_snapshot():
+    """Current rollups: from memory where the indexer runs, else from the indexer's last checkpoint."""
+    if SHARD["role"] == "worker":
+        load_revenue()
+    with revenue_lock:
+        return json.loads(json.dumps(revenue))
+
+
+def revenue_report(days=7):
+    if not WRAPPER_FEE_EVENT:
+        return "💸 Revenue index is off. Set `WRAPPER_FEE_EVENT` to the wrapper's fee event signature."
+    rev = revenue_snapshot()
+    if rev["block"] is None:
+        return "💸 Revenue index has not finished its first sync yet."
+    if not rev["swaps"]:
+        return (
+            f"⚠ No `{WRAPPER_FEE_EVENT}` logs from the wrapper up to block {rev['block']}. "
+            "Revenue is not reported until the event is confirmed; check `WRAPPER_FEE_EVENT` against the wrapper's ABI."
+        )
+
+    def bnb(wei):
+        return wei / 10**18
+
+    with users_lock:
+        owners = {
+            w["address"].lower(): uid
+            for uid, profile in users.items()
+            if profile.get("address")
+            for w in [profile] + profile.get("wallets", [])
+        }
+    lines = [
+        "💸 *Wrapper revenue*",
+        f"Indexed to block {rev['block']}\n",
+        f"Total: {rev['swaps']} swaps, {format_number(bnb(rev['volume']))} BNB volume, "
+        f"*{format_number(bnb(rev['fees']))} BNB* fees",
+        f"\n*Last {days} days*",
+    ]
+    for day in sorted(rev["days"], reverse=True)[:days]:
+        r = rev["days"][day]
+        lines.append(f"{day}: {r['swaps']} swaps, {format_number(bnb(r['volume']))} vol, {format_number(bnb(r['fees']))} fees")
+    for title, key in (("Top tokens", "tokens"), ("Top users", "users")):
+        lines.append(f"\n*{title}* (by fees)")
+        top = sorted(rev[key].items(), key=lambda kv: -kv[1]["fees"])[:5]
+        for addr, r in top:
+            if key == "tokens":
+                name = token_meta_cache.get(addr, {}).get("symbol") or f"{addr[:8]}…"
+            else:
+                uid = owners.get(addr.lower())
+                name = f"user {uid}" if uid else f"{addr[:8]}…"
+            lines.append(f"{name}: {r['swaps']} swaps, {format_number(bnb(r['fees']))} BNB fees")
+    return "\n".join(lines)
+
+
+# ---------- Fill reconciliation ----------
+# confirm_buy / confirm_sell update positions optimistically from the quote.
+# Every submitted trade is queued here; a background worker fetches the receipts
+# in JSON-RPC batches, reads the real fills from Transfer logs and corrects the
+# position, or rolls it back if the transaction reverted or was dropped.
+FILLS_FILE = os.getenv("FILLS_FILE", "fills.json")
+RECONCILE_INTERVAL_SEC = float(os.getenv("RECONCILE_INTERVAL_SEC", "3"))
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+RECONCILE_DROP_SEC = int(os.getenv("RECONCILE_DROP_SEC", "1800"))
+
+TRANSFER_TOPIC = Web3.to_hex(Web3.keccak(text="Transfer(address,address,uint256)"))
+WITHDRAWAL_TOPIC = Web3.to_hex(Web3.keccak(text="Withdrawal(address,uint256)"))
+
+fills_lock = threading.Lock()
+
+
+def load_fills():
+    path = shard_path(FILLS_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def save_fills():
+    """Also saves the tracked txs: the fills and their speed-up / cancel handles go to disk together."""
+    path = shard_path(FILLS_FILE)
+    with fills_lock:
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(pending_fills, f, indent=2)
+        os.replace(tmp, path)
+    save_tracked_txs()
+
+
+pending_fills = {}  # first tx hash -> fill
+
+
+def bnb_price_from_info(info):
+    """BNB/USD implied by a get_token_info result, saving a separate quote."""
+    if info.get("price_usd") and info.get("tokens_per_bnb"):
+        return info["price_usd"] * info["tokens_per_bnb"]
+    return None
+
+
+def track_fill(fill, save=True):
+    """fill needs: type, user_id, chat_id, wallet, token, symbol, decimals, txs (list of hashes)."""
+    fill["submitted_at"] = time.time()
+    with fills_lock:
+        pending_fills[fill["txs"][0]] = fill
+    if save:
+        save_fills()
+
+
+def _sum_transfers(receipt, token, from_addr=None, to_addr=None):
+    total = 0
+    token = token.lower()
+    for log in receipt.get("logs", []):
+        topics = log.get("topics", [])
+        if len(topics) < 3 or topics[0] != TRANSFER_TOPIC or log["address"].lower() != token:
+            continue
+        if from_addr and topics[1][-40:].lower() != from_addr[2:].lower():
+            continue
+        if to_addr and topics[2][-40:].lower() != to_addr[2:].lower():
+            continue
+        total += int(log["data"], 16)
+    return total
+
+
+def _sum_wbnb_withdrawals(receipt):
+    total = 0
+    for log in receipt.get("logs", []):
+        topics = log.get("topics", [])
+        if topics and topics[0] == WITHDRAWAL_TOPIC and log["address"].lower() == WBNB.lower():
+            total += int(log["data"], 16)
+    return total
+
+
+def _settle_buy(fill, receipts):
+    decimals = fill["decimals"]
+    spent_wei = 0
+    received_raw = 0
+    for tx, amount_in in zip(fill["txs"], fill["amounts_in"]):
+        rcpt = receipts.get(tx)
+        if rcpt and int(rcpt["status"], 16) == 1 and tx not in fill.get("cancelled", ()):
+            spent_wei += amount_in
+            received_raw += _sum_transfers(rcpt, fill["token"], to_addr=fill["wallet"])
+    received = received_raw / (10**decimals)
+    bnb_price = fill.get("bnb_price_usd") or get_bnb_price_usd() or 0
+    price = (spent_wei / 1e18) * bnb_price / received if received > 0 else 0.0
+    reprice_position(
+        fill["user_id"], fill["token"], fill["symbol"],
+        fill["expected_tokens"], fill["price_usd"], received, price,
+    )
+    fill.update({"filled_tokens": received, "spent_bnb": spent_wei / 1e18, "fill_price_usd": price})
+    record_ledger(
+        {
+            "kind": "buy",
+            "status": "ok" if received > 0 else "failed",
+            "user_id": fill["user_id"],
+            "token": fill["token"],
+            "symbol": fill["symbol"],
+            "txs": fill["txs"],
+            "tokens": received,
+            "bnb": spent_wei / 1e18,
+            "price_usd": price,
+            "value_usd": spent_wei / 1e18 * bnb_price,
+            "wrapper_fee_bnb": spent_wei / 1e18 * get_wrapper_fee_bps() / 10000,
+        }
+    )
+    if received == 0:
+        return f"❌ BUY {fill['symbol']} failed on-chain, position rolled back."
+    return (
+        f"✅ BUY {fill['symbol']} filled: {format_number(received)} {fill['symbol']} "
+        f"(quoted {format_number(fill['expected_tokens'])}) at ${format_number(price)}"
+    )
+
+
+def _settle_sell(fill, receipts):
+    rcpt = receipts.get(fill["txs"][0])
+    if not rcpt or int(rcpt["status"], 16) != 1 or fill["txs"][0] in fill.get("cancelled", ()):
+        reprice_position(
+            fill["user_id"], fill["token"], fill["symbol"], 0, 0, fill["removed_tokens"], fill["avg_price_usd"]
+        )
+        fill.update({"filled_tokens": 0.0, "received_bnb": 0.0})
+        record_ledger(
+            {
+                "kind": "sell",
+                "status": "failed",
+                "user_id": fill["user_id"],
+                "token": fill["token"],
+                "symbol": fill["symbol"],
+                "txs": fill["txs"],
+                "tokens": 0.0,
+                "bnb": 0.0,
+                "price_usd": 0.0,
+                "value_usd": 0.0,
+            }
+        )
+        return f"❌ SELL {fill['symbol']} failed on-chain, position restored."
+    sold = _sum_transfers(rcpt, fill["token"], from_addr=fill["wallet"]) / (10 ** fill["decimals"])
+    received_bnb = _sum_wbnb_withdrawals(rcpt) / 1e18
+    if sold and abs(sold - fill["amount_tokens"]) > 1e-9 * max(sold, 1):
+        # position was reduced by the requested amount; correct to what actually left the wallet
+        reprice_position(
+            fill["user_id"], fill["token"], fill["symbol"],
+            sold - fill["amount_tokens"], fill["avg_price_usd"], 0, 0,
+        )
+    bnb_price = fill.get("bnb_price_usd") or get_bnb_price_usd() or 0
+    # the Withdrawal amount is before the wrapper takes its cut
+    wrapper_fee = received_bnb * get_wrapper_fee_bps() / 10000
+    received_bnb -= wrapper_fee
+    price = received_bnb * bnb_price / sold if sold > 0 else 0.0
+    fill.update({"filled_tokens": sold, "received_bnb": received_bnb, "fill_price_usd": price})
+    record_ledger(
+        {
+            "kind": "sell",
+            "status": "ok",
+            "user_id": fill["user_id"],
+            "token": fill["token"],
+            "symbol": fill["symbol"],
+            "txs": fill["txs"],
+            "tokens": sold,
+            "bnb": received_bnb,
+            "price_usd": price,
+            "value_usd": received_bnb * bnb_price,
+            "wrapper_fee_bnb": wrapper_fee,
+        }
+    )
+    return (
+        f"✅ SELL {fill['symbol']} filled: {format_number(sold)} {fill['symbol']} "
+        f"for {format_number(received_bnb)} BNB"
+    )
+
+
+def settle_fill(fill, receipts):
+    if fill["type"] == "buy":
+        note = _settle_buy(fill, receipts)
+    else:
+        note = _settle_sell(fill, receipts)
+    if fill.get("chat_id"):
+        send_message(fill["chat_id"], note)
+
+
+def reconcile_fills():
+    with fills_lock:
+        fills = list(pending_fills.items())
+    if not fills:
+        return
+    hashes = [tx for _, fill in fills for tx in fill["txs"]]
+    receipts = {}
+    resps = rpc_batch_chunked([("eth_getTransactionReceipt", [tx]) for tx in hashes], RECONCILE_BATCH_SIZE)
+    for tx, resp in zip(hashes, resps):
+        if resp.get("result"):
+            receipts[tx] = resp["result"]
+
+    # past the drop deadline, a hash the node no longer knows will never land
+    now = time.time()
+    stale = [
+        tx for _, fill in fills if now - fill["submitted_at"] > RECONCILE_DROP_SEC
+        for tx in fill["txs"] if tx not in receipts
+    ]
+    dropped = set()
+    resps = rpc_batch_chunked([("eth_getTransactionByHash", [tx]) for tx in stale], RECONCILE_BATCH_SIZE)
+    for tx, resp in zip(stale, resps):
+        if "error" not in resp and resp.get("result") is None:
+            dropped.add(tx)
+
+    done = []
+    for key, fill in fills:
+        if not all(tx in receipts or tx in dropped for tx in fill["txs"]):
+            continue
+        try:
+            settle_fill(fill, receipts)
+        except Exception as e:
+            print("Fill settle error:", key, e)
+            continue
+        done.append(key)
+    if done:
+        with fills_lock:
+            for key in done:
+                pending_fills.pop(key, None)
+        save_fills()
+
+
+def reconcile_worker():
+    while True:
+        try:
+            reconcile_fills()
+        except Exception as e:
+            print("Reconcile error:", e)
+        time.sleep(RECONCILE_INTERVAL_SEC)
+
+
+# ---------- Transaction lifecycle ----------
+# Every user tx is watched by one shared loop: receipts for all tracked hashes go
+# out as one batch per tick. A tx pending past TX_BUMP_AFTER_SEC is re-sent under
+# the same nonce with a higher gas price, up to the user's gas ceiling; speed-up
+# and cancel buttons do the same on demand. The tracked set is saved next to the
+# pending fills, so the buttons of in-flight txs survive a restart.
+TXS_FILE = os.getenv("TXS_FILE", "txs.json")
+TX_MONITOR_SEC = float(os.getenv("TX_MONITOR_SEC", "3"))
+TX_BUMP_AFTER_SEC = float(os.getenv("TX_BUMP_AFTER_SEC", "30"))
+TX_BUMP_PCT = float(os.getenv("TX_BUMP_PCT", "12.5"))  # nodes need >= 10% to accept a replacement
+TX_GAS_CEILING_GWEI = float(os.getenv("TX_GAS_CEILING_GWEI", "20"))
+TX_GIVE_UP_SEC = 1800
+GAS_CEILING_CHOICES = (5, 10, 25)
+
+tx_lock = threading.Lock()
+# short id -> {"user_id", "wallet", "label", "tx", "hashes", "sent_at", "first_sent", "bumps", "cancelled", "approves"}
+tracked_txs = {}
+tx_id_by_hash = {}
+tx_seq = [0]
+tx_saved_seq = [0]
+
+
+def load_tracked_txs():
+    path = shard_path(TXS_FILE)
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except Exception:
+        return
+    with tx_lock:
+        tracked_txs.clear()
+        tracked_txs.update(data.get("txs", {}))
+        tx_id_by_hash.clear()
+        for tx_id, entry in tracked_txs.items():
+            for tx_hash in entry["hashes"]:
+                tx_id_by_hash[tx_hash] = tx_id
+        tx_seq[0] = tx_saved_seq[0] = data.get("seq", 0)
+
+
+def save_tracked_txs():
+    path = shard_path(TXS_FILE)
+    with tx_lock:
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"seq": tx_seq[0], "txs": tracked_txs}, f, indent=2)
+        os.replace(tmp, path)
+        tx_saved_seq[0] = tx_seq[0]
+
+
+def gas_ceiling_wei(user_id):
+    gwei = get_user_settings(user_id).get("gas_ceiling_gwei", TX_GAS_CEILING_GWEI)
+    return int(gwei * 10**9)
+
+
+def watch_tx(user_id, tx, tx_hash, label="tx"):
+    """Hands a sent tx (the dict that was signed) to the monitor. Returns its short id."""
+    acct, _ = get_user_account(user_id)
+    now = time.time()
+    with tx_lock:
+        tx_seq[0] += 1
+        tx_id = str(tx_seq[0])
+        tracked_txs[tx_id] = {
+            "user_id": user_id,
+            "wallet": tx.get("from", acct.address),
+            "label": label,
+            "tx": dict(tx),
+            "hashes": [tx_hash],
+            "sent_at": now,
+            "first_sent": now,
+            "bumps": 0,
+            "cancelled": False,
+            # token of an approval, remembered apart from tx since a cancel replaces the data
+            "approves": tx["to"] if str(tx.get("data", "")).startswith(APPROVE_SELECTOR) else None,
+        }
+        tx_id_by_hash[tx_hash] = tx_id
+    return tx_id
+
+
+def tx_buttons(hashes):
+    """Speed-up / cancel rows for the still tracked txs among hashes."""
+    rows = []
+    for n, tx_hash in enumerate(hashes, 1):
+        with tx_lock:
+            tx_id = tx_id_by_hash.get(tx_hash)
+        if not tx_id:
+            continue
+        suffix = f" {n}" if len(hashes) > 1 else ""
+        rows.append(
             [
-                {"text": "25% tokens", "callback_data": "sell_pct_25"},
-                {"text": "50%", "callback_data": "sell_pct_50"},
-                {"text": "100%", "callback_data": "sell_pct_100"},
-            ],
-        ]
-        send_message(
-            chat_id,
-            "Enter TOKEN amount to SELL (in normal units) or use presets." + balance_info,
-            buttons,
+                {"text": f"⚡ Speed up{suffix}", "callback_data": f"txup_{tx_id}"},
+                {"text": f"✖ Cancel{suffix}", "callback_data": f"txcancel_{tx_id}"},
+            ]
         )
+    return rows
+
+
+def _bumped_gas_price(entry):
+    """Next replacement price, or None when it would cross the user's ceiling. Call with tx_lock held."""
+    price = int(entry["tx"]["gasPrice"] * (1 + TX_BUMP_PCT / 100)) + 1
+    if price > gas_ceiling_wei(entry["user_id"]):
+        return None
+    return price
+
+
+def retarget_fill(old_hashes, new_hash, cancelled=False):
+    """Points a pending fill at the hash that replaced (or cancelled) one of its txs."""
+    changed = False
+    with fills_lock:
+        for fill in pending_fills.values():
+            for i, tx_hash in enumerate(fill["txs"]):
+                if tx_hash in old_hashes and tx_hash != new_hash:
+                    fill["txs"][i] = new_hash
+                    if cancelled:
+                        fill.setdefault("cancelled", []).append(new_hash)
+                    changed = True
+    if changed:
+        save_fills()
+
+
+def _replace_tx(tx_id, cancel, ceiling_error):
+    """
+    Re-sends a tracked tx at the next bump price. The lock is held through the
+    broadcast so the monitor and a button tap cannot both replace the same nonce.
+    Returns (tx hash, gas price).
+    """
+    with tx_lock:
+        entry = tracked_txs.get(tx_id)
+        if entry is None:
+            raise Exception("Transaction is no longer pending")
+        gas_price = _bumped_gas_price(entry)
+        if gas_price is None:
+            raise Exception(ceiling_error)
+        acct, pk = get_user_account(entry["user_id"], entry["wallet"])
+        tx = dict(entry["tx"], gasPrice=gas_price)
+        if cancel:
+            tx.update({"to": acct.address, "value": 0, "data": "0x", "gas": 21000})
+        signed = w3.eth.account.sign_transaction(tx, pk)
+        tx_hash = broadcast_raw_tx(signed.raw_transaction)
+        entry["tx"] = tx
+        entry["hashes"].append(tx_hash)
+        entry["sent_at"] = time.time()
+        entry["bumps"] += 1
+        entry["cancelled"] = cancel
+        tx_id_by_hash[tx_hash] = tx_id
+        replaced = entry["hashes"][:-1]
+    retarget_fill(replaced, tx_hash, cancelled=cancel)
+    save_tracked_txs()
+    return tx_hash, gas_price
+
+
+def speed_up_tx(tx_id):
+    return _replace_tx(tx_id, False, "Next bump would exceed your gas ceiling (Settings)")
+
+
+def cancel_tx(tx_id):
+    """Replaces the tx with a 0 BNB self-transfer under the same nonce."""
+    return _replace_tx(tx_id, True, "Cancelling needs a higher gas price than your ceiling allows (Settings)")[0]
+
+
+def tracked_tx_owner(tx_id):
+    """The user a tracked tx belongs to, or None once it is no longer pending."""
+    with tx_lock:
+        entry = tracked_txs.get(tx_id)
+        return entry and entry["user_id"]
+
+
+def _forget_tx(tx_id):
+    """Call with tx_lock held."""
+    entry = tracked_txs.pop(tx_id, None)
+    if entry:
+        for tx_hash in entry["hashes"]:
+            tx_id_by_hash.pop(tx_hash, None)
+
+
+def _failed_approval(entry):
+    """An approval that did not grant the allowance: the cached MAX_UINT256 must go."""
+    if entry.get("approves"):
+        forget_allowance(entry["wallet"], entry["approves"])
+
+
+def monitor_txs():
+    with tx_lock:
+        # copies: the entries change under the lock while this tick works on them
+        entries = [(tx_id, dict(entry, hashes=list(entry["hashes"]))) for tx_id, entry in tracked_txs.items()]
+        changed = tx_seq[0] != tx_saved_seq[0]
+    if not entries:
+        if changed:
+            save_tracked_txs()
         return
+    hashes = [h for _, entry in entries for h in entry["hashes"]]
+    wallets = list(dict.fromkeys(entry["wallet"] for _, entry in entries))
+    resps = rpc_batch_chunked(
+        [("eth_getTransactionReceipt", [h]) for h in hashes]
+        + [("eth_getTransactionCount", [w, "latest"]) for w in wallets]
+    )
+    receipts = {h: r["result"] for h, r in zip(hashes, resps) if r.get("result")}
+    mined_nonce = {w: int(r["result"], 16) for w, r in zip(wallets, resps[len(hashes):]) if r.get("result")}
+
+    now = time.time()
+    for tx_id, entry in entries:
+        landed = next((h for h in entry["hashes"] if h in receipts), None)
+        if landed:
+            if receipts[landed].get("status") != "0x1" or (entry["cancelled"] and landed == entry["hashes"][-1]):
+                _failed_approval(entry)
+            if entry["bumps"]:
+                # the original may still have won the race against its replacement
+                cancelled = entry["cancelled"] and landed == entry["hashes"][-1]
+                retarget_fill([h for h in entry["hashes"] if h != landed], landed, cancelled=cancelled)
+                what = "cancelled" if cancelled else f"landed after {entry['bumps']} bump(s)"
+                send_message(entry["user_id"], f"⛽ {entry['label']} {what}.\nTx: `{landed}`")
+            with tx_lock:
+                _forget_tx(tx_id)
+            changed = True
+        elif mined_nonce.get(entry["wallet"], 0) > entry["tx"]["nonce"] or now - entry["first_sent"] > TX_GIVE_UP_SEC:
+            # nonce used by a tx we do not track (or we gave up); reconciliation settles the fill
+            _failed_approval(entry)
+            resync_nonce(entry["wallet"])
+            with tx_lock:
+                _forget_tx(tx_id)
+            changed = True
+        elif now - entry["sent_at"] > TX_BUMP_AFTER_SEC:
+            with tx_lock:
+                at_ceiling = _bumped_gas_price(entry) is None and not entry.get("stuck_notified")
+                if at_ceiling and tx_id in tracked_txs:
+                    tracked_txs[tx_id]["stuck_notified"] = True
+            if at_ceiling:
+                send_message(
+                    entry["user_id"],
+                    f"⏳ {entry['label']} still pending and at your gas ceiling.\nTx: `{entry['hashes'][-1]}`",
+                    tx_buttons([entry["hashes"][-1]]),
+                )
+                continue
+            try:
+                tx_hash, price = _replace_tx(tx_id, entry["cancelled"], "at the gas ceiling")
+                print(f"Auto-bumped {entry['label']} to {price / 1e9:.2f} gwei: {tx_hash}")
+            except Exception as e:
+                print("Auto-bump error:", e)
+                with tx_lock:
+                    if tx_id in tracked_txs:
+                        tracked_txs[tx_id]["sent_at"] = now
+    if changed:
+        save_tracked_txs()
+
+
+def tx_monitor_worker():
+    while True:
+        try:
+            monitor_txs()
+        except Exception as e:
+            print("Tx monitor error:", e)
+        time.sleep(TX_MONITOR_SEC)
+
+
+# ---------- Copy trading ----------
+# Followers mirror a leader's trades (or operator signals) with their own size,
+# slippage and gas mode. Reads for all followers go out as JSON-RPC batches,
+# transactions are built and signed in a worker pool, then broadcast together.
+ADMIN_IDS = {x.strip() for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+SIGNAL_SOURCE = "signal"
+COPY_SIGN_WORKERS = int(os.getenv("COPY_SIGN_WORKERS", "16"))
+COPY_GAS_RESERVE_BNB = float(os.getenv("COPY_GAS_RESERVE_BNB", "0.002"))
+
+copy_stats = {"signals": 0, "orders": 0, "last_followers": 0, "last_latency_ms": 0.0, "max_latency_ms": 0.0}
+
+
+def get_followers(source):
+    return [
+        uid for uid, profile in list(users.items())
+        if profile.get("copy", {}).get("leader") == str(source) and uid != str(source) and owns_user(uid)
+    ]
+
+
+def copy_buy_size(copy_cfg, balance_bnb):
+    if copy_cfg.get("mode") == "pct":
+        amount = balance_bnb * copy_cfg["value"] / 100
+    else:
+        amount = copy_cfg["value"]
+    return max(min(amount, balance_bnb - COPY_GAS_RESERVE_BNB), 0.0)
+
+
+def simulate_hops(amount_in, hops):
+    """Quotes amount_in and advances hops in place, so back-to-back followers see each other's impact."""
+    amount = amount_in
+    for i, (r_in, r_out) in enumerate(hops):
+        out = v2_amount_out(amount, r_in, r_out)
+        hops[i] = (r_in + amount, r_out - out)
+        amount = out
+    return amount
+
+
+def _sign_copy_order(order):
+    base = {"from": order["wallet"], "to": WRAPPER_ADDRESS, "value": 0, "gasPrice": order["gas_price"], "chainId": 56}
+    raws = []
+    order["unsigned"] = txs = []
+    nonce = order["nonce"]
+    if order["side"] == "buy":
+        data = encode_swap_eth_for_tokens(order["min_out"], order["path"], order["wallet"], order["deadline"])
+        tx = {**base, "value": order["amount_in"], "gas": 600000, "nonce": nonce, "data": data}
+        txs.append(tx)
+        raws.append(w3.eth.account.sign_transaction(tx, order["pk"]).raw_transaction)
+    else:
+        if order["needs_approval"]:
+            data = encode_approve(WRAPPER_ADDRESS, MAX_UINT256)
+            tx = {**base, "to": Web3.to_checksum_address(order["token"]), "gas": 150_000, "nonce": nonce, "data": data}
+            txs.append(tx)
+            raws.append(w3.eth.account.sign_transaction(tx, order["pk"]).raw_transaction)
+            nonce += 1
+        data = encode_swap_tokens_for_eth(
+            order["amount_in"], order["min_out"], order["path"], order["wallet"], order["deadline"]
+        )
+        tx = {**base, "gas": 800000, "nonce": nonce, "data": data}
+        txs.append(tx)
+        raws.append(w3.eth.account.sign_transaction(tx, order["pk"]).raw_transaction)
+    return [Web3.to_hex(raw) for raw in raws]
+
+
+def book_sent_orders(orders, signed, hashes, icon, label):
+    """
+    Positions, fills, tx monitoring and nonces for orders signed by _sign_copy_order
+    and broadcast together. Returns the (chat_id, text) notes to send; the caller
+    saves users and fills once.
+    """
+    pos = 0
+    for order, raws in zip(orders, signed):
+        # nonces first, before the price lookup: the next send from these wallets must not reuse them
+        for unsigned, sent in zip(order["unsigned"], hashes[pos : pos + len(raws)]):
+            if sent:
+                note_nonce(order["wallet"], unsigned["nonce"])
+        pos += len(raws)
+    bnb_price = get_bnb_price_usd() or 0
+    pos = 0
+    notes = []
+    for order, raws in zip(orders, signed):
+        uid, token, side = order["uid"], order["token"], order["side"]
+        symbol, decimals = order["symbol"], order["decimals"]
+        for unsigned, sent in zip(order["unsigned"], hashes[pos : pos + len(raws)]):
+            if sent:
+                watch_tx(uid, unsigned, sent, label=f"{label} {side.upper()}")
+        if len(raws) > 1 and hashes[pos]:
+            record_approval(uid, token, hashes[pos])
+        tx = hashes[pos + len(raws) - 1]
+        pos += len(raws)
+        order["tx"] = tx
+        if not tx:
+            continue
+        if side == "buy":
+            tokens = order["expected_out"] / (10**decimals)
+            price = (order["amount_in"] / 1e18) * bnb_price / tokens if tokens else 0
+            update_position_buy(uid, token, symbol, tokens, price, save=False)
+            fill = {"amounts_in": [order["amount_in"]], "expected_tokens": tokens, "price_usd": price}
+            note = f"{icon} {label} BUY {symbol}: {format_number(order['amount_in'] / 1e18)} BNB"
+        else:
+            tokens = order["amount_in"] / (10**decimals)
+            held = get_user_positions(uid).get(token, {"amount": 0.0, "avg_price_usd": 0.0})
+            update_position_sell(uid, token, tokens, save=False)
+            fill = {
+                "amount_tokens": tokens,
+                "removed_tokens": min(tokens, held["amount"]),
+                "avg_price_usd": held["avg_price_usd"],
+                "expected_bnb": order["expected_out"] / 1e18,
+            }
+            note = f"{icon} {label} SELL {symbol}: {format_number(tokens)} {symbol}"
+        fill.update(
+            {
+                "type": side,
+                "user_id": int(uid),
+                "chat_id": int(uid),
+                "wallet": order["wallet"],
+                "token": token,
+                "symbol": symbol,
+                "decimals": decimals,
+                "txs": [tx],
+                "bnb_price_usd": bnb_price,
+            }
+        )
+        track_fill(fill, save=False)
+        notes.append((int(uid), f"{note}{order.get('note', '')}\nTx: `{tx}`"))
+    return notes
+
+
+def read_wallet_states(wallets, token_pairs=()):
+    """
+    One JSON-RPC batch for signing from many wallets: next nonce (node pending count
+    or the locally tracked one), BNB balance, and token balance and wrapper
+    allowance for each (wallet, token) pair. Returns
+    (nonces, bnb, token balances, allowances, gas price), keyed as given.
+    """
+    wallets = list(dict.fromkeys(wallets))
+    token_pairs = list(dict.fromkeys(token_pairs))
+    calls = [("eth_getTransactionCount", [w, "pending"]) for w in wallets]
+    calls += [("eth_getBalance", [w, "latest"]) for w in wallets]
+    calls += [
+        ("eth_call", [{"to": t, "data": encode_balance_of(w)}, "latest"]) for w, t in token_pairs
+    ]
+    calls += [
+        ("eth_call", [{"to": t, "data": encode_allowance(w)}, "latest"])
+        for w, t in token_pairs
+    ]
+    calls.append(("eth_gasPrice", []))
+    resps = rpc_batch_chunked(calls)
+    n, m = len(wallets), len(token_pairs)
+    nonces, bnb, token_bal, allowance = {}, {}, {}, {}
+    for i, w in enumerate(wallets):
+        nonces[w] = reconcile_nonce(w, int(resps[i].get("result") or "0x0", 16))
+        bnb[w] = int(resps[n + i].get("result") or "0x0", 16)
+    for i, key in enumerate(token_pairs):
+        token_bal[key] = int(resps[2 * n + i].get("result") or "0x0", 16)
+        allowance[key] = int(resps[2 * n + m + i].get("result") or "0x0", 16)
+    return nonces, bnb, token_bal, allowance, int(resps[-1]["result"], 16)
+
+
+def fan_out_copy(source, side, token_address, sell_fraction=None, leader_amount_in=None):
+    """
+    Repeats one trade for every follower of source (a leader user id or SIGNAL_SOURCE).
+    leader_amount_in is the raw input of the leader's own trade, which is still
+    pending and lands ahead of the followers'. Returns the number of transactions sent.
+    """
+    started = time.perf_counter()
+    followers = get_followers(source)
+    if not followers:
+        return 0
+    token = Web3.to_checksum_address(token_address)
+    buy_path = get_path_for_buy(token)
+    path = buy_path if side == "buy" else list(reversed(buy_path))
+    hops = path_hops(path)
+    if not hops:
+        raise Exception("No liquid route for copy trade")
+    if leader_amount_in:
+        simulate_hops(leader_amount_in, hops)
+    meta = get_token_meta(token)
+    decimals, symbol = meta["decimals"], meta["symbol"]
+
+    accounts = {uid: get_user_account(uid)[0] for uid in followers}
+    wallets = [accounts[uid].address for uid in followers]
+    token_pairs = [(w, token) for w in wallets] if side == "sell" else []
+    nonces, bnb, token_bal, allowances, base_gas = read_wallet_states(wallets, token_pairs)
+
+    deadline = int(time.time()) + 600
+    orders = []
+    for uid in followers:
+        profile = ensure_profile(uid)
+        settings = profile["settings"]
+        acct = accounts[uid]
+        order = {
+            "uid": uid,
+            "side": side,
+            "token": token,
+            "path": path,
+            "wallet": acct.address,
+            "pk": profile["private_key"],
+            "nonce": nonces[acct.address],
+            "gas_price": int(base_gas * GAS_MODE_MULTIPLIERS.get(settings.get("gas_mode"), 1.0)),
+            "deadline": deadline,
+        }
+        if side == "buy":
+            balance_bnb = bnb[acct.address] / 1e18
+            amount_bnb = copy_buy_size(profile["copy"], balance_bnb)
+            if amount_bnb <= 0:
+                continue
+            order["amount_in"] = w3.to_wei(amount_bnb, "ether")
+        else:
+            balance_raw = token_bal[(acct.address, token)]
+            order["amount_in"] = int(balance_raw * min(sell_fraction or 1.0, 1.0))
+            if order["amount_in"] <= 0:
+                continue
+            order["needs_approval"] = allowances[(acct.address, token)] < order["amount_in"]
+        order["expected_out"] = simulate_hops(order["amount_in"], hops)
+        order["min_out"] = int(order["expected_out"] * (1 - settings.get("slippage", 0.03)))
+        orders.append(order)
+
+    if not orders:
+        return 0
+    with ThreadPoolExecutor(max_workers=COPY_SIGN_WORKERS) as pool:
+        signed = list(pool.map(_sign_copy_order, orders))
+    hashes = broadcast_raw_txs([raw for raws in signed for raw in raws])
+
+    latency_ms = (time.perf_counter() - started) * 1000
+    copy_stats["signals"] += 1
+    copy_stats["orders"] += len(orders)
+    copy_stats["last_followers"] = len(orders)
+    copy_stats["last_latency_ms"] = latency_ms
+    copy_stats["max_latency_ms"] = max(copy_stats["max_latency_ms"], latency_ms)
+    print(f"Copy {side} {symbol}: {len(orders)} followers, signal to last send {latency_ms:.0f} ms")
+
+    # bookkeeping and notifications are off the latency path
+    for order in orders:
+        order.update({"symbol": symbol, "decimals": decimals})
+    notes = book_sent_orders(orders, signed, hashes, "🔁", "Copied")
+    save_users(users)
+    save_fills()
+    with ThreadPoolExecutor(max_workers=COPY_SIGN_WORKERS) as pool:
+        list(pool.map(lambda item: send_message(*item), notes))
+    return len(orders)
+
+
+def announce_copy_trade(source, side, token_address, sell_fraction=None, leader_amount_in=None):
+    """Fans a trade out to followers; in sharded mode every worker handles its own followers."""
+    if SHARD["role"] == "worker":
+        signal = {
+            "copy_signal": {
+                "source": str(source),
+                "side": side,
+                "token": token_address,
+                "fraction": sell_fraction,
+                "leader_amount_in": leader_amount_in,
+            }
+        }
+        for q in shard_queues:
+            q.put(signal)
+    elif get_followers(source):
+        start_copy_fan_out(source, side, token_address, sell_fraction, leader_amount_in)
+
+
+def start_copy_fan_out(source, side, token_address, sell_fraction=None, leader_amount_in=None):
+    def run():
+        try:
+            fan_out_copy(source, side, token_address, sell_fraction, leader_amount_in)
+        except Exception as e:
+            print("Copy fan-out error:", e)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def snipe_latency_line():
+    samples = sorted(snipe_stats["latency"])
+    if not samples:
+        return ""
+    lags = list(snipe_stats["block_lag"])
+    lag = f", blocks behind launch: max {max(lags)}" if lags else ""
+    return (
+        f"\n\n🎯 *Snipes*: {snipe_stats['fired']} launches, {snipe_stats['orders']} buys\n"
+        f"Detection to broadcast: p50 {samples[len(samples) // 2]:.0f} ms, max {samples[-1]:.0f} ms{lag}"
+    )
+
+
+# ---------- Launch sniper ----------
+# Users arm a buy for a token that has no liquidity yet. One watcher (in the
+# intake process in sharded mode) reads each new block's factory PairCreated and
+# the watched pairs' Sync and Mint logs in a single eth_getLogs. When a WBNB or
+# stable pair of an armed token gets liquidity, every buy is checked against the
+# launch reserves from the Sync log: the pool must hold the buy's minimum
+# liquidity and the price must not exceed its maximum. Buys that pass are signed
+# with a slippage-bounded minimum output and a short deadline and go out in one
+# broadcast; the others stay armed for the next Mint. Nonces and gas prices are
+# prepared ahead, so only signing is left between detection and broadcast.
+MINT_TOPIC = Web3.to_hex(Web3.keccak(text="Mint(address,uint256,uint256)"))
+SNIPE_HUBS = [WBNB] + HUB_TOKENS
+SNIPE_POLL_SEC = float(os.getenv("SNIPE_POLL_SEC", "0.25"))
+SNIPE_RESIGN_SEC = float(os.getenv("SNIPE_RESIGN_SEC", "15"))  # re-check nonces / gas of armed buys
+SNIPE_MIN_LIQUIDITY_BNB = float(os.getenv("SNIPE_MIN_LIQUIDITY_BNB", "1"))  # default guard, per snipe with liq=
+SNIPE_DEADLINE_SEC = 60  # a snipe that misses the next blocks should fail rather than fill late
+
+snipe_lock = threading.Lock()
+snipe_book = {}  # token -> {uid: {"wallet", "amount_wei", "min_liquidity_bnb", "max_price_bnb", "nonce", "gas_price", ...}}
+snipe_watch = {}  # (shard index, token) -> {hub: pair or None}; a Manager dict in sharded mode
+snipe_created = {}  # pair created after arming (lowercase) -> (token, hub), kept by the watcher
+snipe_stats = {"fired": 0, "orders": 0, "held": 0, "latency": deque(maxlen=200), "block_lag": deque(maxlen=200)}
+
+
+def _snipe_path(hub, token):
+    return [WBNB, token] if hub == WBNB else [WBNB, hub, token]
+
+
+def prepare_snipe(uid, cfg, nonce, gas_price):
+    """An armed buy without its signature: the minimum output needs the launch reserves."""
+    acct, _ = get_user_account(uid)
+    return {
+        "wallet": acct.address,
+        "amount_wei": w3.to_wei(cfg["amount_bnb"], "ether"),
+        "min_liquidity_bnb": cfg.get("min_liquidity_bnb", SNIPE_MIN_LIQUIDITY_BNB),
+        "max_price_bnb": cfg.get("max_price_bnb"),
+        "nonce": nonce,
+        "gas_price": gas_price,
+        "prepared_at": time.time(),
+        "held": None,  # last reason a launch did not fire this buy
+    }
+
+
+def sign_snipe(uid, order, path, min_out):
+    _, pk = get_user_account(uid)
+    data = encode_swap_eth_for_tokens(min_out, path, order["wallet"], int(time.time()) + SNIPE_DEADLINE_SEC)
+    tx = {
+        "to": WRAPPER_ADDRESS,
+        "value": order["amount_wei"],
+        "gas": 600000,
+        "gasPrice": order["gas_price"],
+        "nonce": order["nonce"],
+        "chainId": 56,
+        "data": data,
+    }
+    return tx, Web3.to_hex(w3.eth.account.sign_transaction(tx, pk).raw_transaction)
+
+
+def launch_pairs(token):
+    """{hub: pair or None} for the launch routes of token, and whether any of them already has liquidity."""
+    pairs = {hub: resolve_pair(hub, token) for hub in SNIPE_HUBS}
+    reserves = fetch_reserves([p for p in pairs.values() if p])
+    live = any(r[0] > 0 and r[1] > 0 for r in reserves.values())
+    return pairs, live
+
 
-    # refresh & risk check
-    if data in ("buy_refresh", "sell_refresh", "buy_risk", "sell_risk"):
-        state = user_states.get(user_id)
-        if not state or "data" not in state or "token" not in state["data"]:
-            edit_message(chat_id, msg_id, "No token in context.", get_main_menu(has_wallet))
+def _watch_launch_pairs(token, pairs):
+    snipe_watch[(SHARD["index"], token)] = pairs
+
+
+def _unwatch_if_empty(token):
+    """Call with snipe_lock held."""
+    if token in snipe_book and not snipe_book[token]:
+        del snipe_book[token]
+    if token not in snipe_book:
+        snipe_watch.pop((SHARD["index"], token), None)
+
+
+def arm_snipe(user_id, token, amount_bnb, min_liquidity_bnb=None, max_price_bnb=None):
+    pairs, live = launch_pairs(token)
+    if live:
+        raise Exception("This token already has liquidity; use Trade → Buy.")
+    meta = get_token_meta(token)
+    cfg = {
+        "amount_bnb": amount_bnb,
+        "min_liquidity_bnb": SNIPE_MIN_LIQUIDITY_BNB if min_liquidity_bnb is None else min_liquidity_bnb,
+        "max_price_bnb": max_price_bnb,
+        "armed_at": time.time(),
+    }
+    with users_lock:
+        ensure_profile(user_id).setdefault("snipes", {})[token] = cfg
+    save_users(users)
+    acct, _ = get_user_account(user_id)
+    order = prepare_snipe(str(user_id), cfg, next_nonce(acct.address), get_user_gas_price(user_id))
+    with snipe_lock:
+        snipe_book.setdefault(token, {})[str(user_id)] = order
+    _watch_launch_pairs(token, pairs)
+    return meta
+
+
+def disarm_snipe(user_id, token):
+    with users_lock:
+        profile = ensure_profile(user_id)
+        removed = profile and profile.get("snipes", {}).pop(token, None)
+    if removed:
+        save_users(users)
+    with snipe_lock:
+        snipe_book.get(token, {}).pop(str(user_id), None)
+        _unwatch_if_empty(token)
+    return bool(removed)
+
+
+def refresh_snipes():
+    """Rebuilds the book from profiles and re-prepares orders whose nonce or gas price went stale."""
+    armed = []
+    with users_lock:
+        for uid, profile in users.items():
+            if owns_user(uid):
+                armed.extend((uid, token, cfg) for token, cfg in profile.get("snipes", {}).items())
+    if not armed:
+        return
+    wallets = list(dict.fromkeys(get_user_account(uid)[0].address for uid, _, _ in armed))
+    resps = rpc_batch([("eth_getTransactionCount", [w, "pending"]) for w in wallets] + [("eth_gasPrice", [])])
+    nonces = {w: int(r["result"], 16) for w, r in zip(wallets, resps) if r.get("result")}
+    base_gas = int(resps[-1]["result"], 16)
+    for uid, token, cfg in armed:
+        with snipe_lock:
+            order = snipe_book.get(token, {}).get(uid)
+        wallet = get_user_account(uid)[0].address
+        nonce = reconcile_nonce(wallet, nonces.get(wallet, 0))
+        gas_price = _user_gas_price(uid, base_gas)
+        if order and order["nonce"] == nonce and order["gas_price"] >= gas_price:
+            continue
+        fresh = prepare_snipe(uid, cfg, nonce, gas_price)
+        fresh["held"] = order and order["held"]
+        with snipe_lock:
+            snipe_book.setdefault(token, {})[uid] = fresh
+        if (SHARD["index"], token) not in snipe_watch:
+            _watch_launch_pairs(token, launch_pairs(token)[0])
+
+
+def snipe_guard(order, hops, liquidity_bnb, decimals):
+    """Why the launch reserves in hops do not satisfy order, or None when the buy can go out."""
+    if liquidity_bnb < order["min_liquidity_bnb"]:
+        return f"liquidity is {format_number(liquidity_bnb)} BNB, below your {format_number(order['min_liquidity_bnb'])} BNB minimum"
+    out = quote_hops(order["amount_wei"], hops)
+    if out <= 0:
+        return "the pool returns nothing for your amount"
+    price = order["amount_wei"] / 1e18 / (out / 10**decimals)
+    if order["max_price_bnb"] is not None and price > order["max_price_bnb"]:
+        return f"price is {format_number(price)} BNB per token, above your {format_number(order['max_price_bnb'])} BNB maximum"
+    return None
+
+
+def fire_snipes(token, hub, pair, reserves, detected_at, block):
+    """Signs and sends the armed buys of token that the launch reserves satisfy; the rest stay armed."""
+    with snipe_lock:
+        orders = dict(snipe_book.get(token, {}))
+    if not orders:
+        return
+    reserves_cache[pair] = (reserves[0], reserves[1], time.time())
+    path = _snipe_path(hub, token)
+    # the launch pair may not be in the pair index yet: its hop comes straight from the launch reserves
+    hops = [orient_reserves(reserves, hub, token)]
+    if hub != WBNB:
+        entry = path_hops([WBNB, hub])
+        if not entry:
             return
-        token_addr = state["data"]["token"]
+        hops = entry + hops
+    meta = get_token_meta(token)
+    # the launch pool's hub side, in BNB
+    liquidity_bnb = (hops[-1][0] if len(hops) == 1 else hops[-1][0] * hops[0][0] / hops[0][1]) / 1e18
+    jobs, held = [], []
+    for uid, order in orders.items():
+        reason = snipe_guard(order, hops, liquidity_bnb, meta["decimals"])
+        if reason:
+            held.append((uid, order, reason))
+            continue
+        # advances hops, so each later buy is bounded by the price the earlier ones leave
+        out = simulate_hops(order["amount_wei"], hops)
+        min_out = int(out * (1 - get_user_settings(uid).get("slippage", 0.03)))
+        jobs.append((uid, order, min_out, out))
+    with snipe_lock:
+        book = snipe_book.get(token, {})
+        jobs = [job for job in jobs if book.pop(job[0], None)]  # a disarm that came first wins
+        _unwatch_if_empty(token)
+
+    symbol_path = format_path(path, meta["symbol"])
+    signed, hashes = [], []
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(len(jobs), COPY_SIGN_WORKERS)) as pool:
+            signed = list(pool.map(lambda job: sign_snipe(job[0], job[1], path, job[2]), jobs))
+        hashes = broadcast_raw_txs([raw for _, raw in signed])
+        latency_ms = (time.time() - detected_at) * 1000
         try:
-            info = get_token_info(token_addr)
+            lag = head_block() - block
+        except Exception:
+            lag = None
+        snipe_stats["fired"] += 1
+        snipe_stats["orders"] += len(jobs)
+        snipe_stats["latency"].append(latency_ms)
+        if lag is not None:
+            snipe_stats["block_lag"].append(lag)
+        print(f"Snipe {token} via {symbol_path}: {len(jobs)} buys, detection to broadcast {latency_ms:.1f} ms")
+
+    # bookkeeping off the latency path
+    bnb_price = get_bnb_price_usd()
+    for (uid, order, _, out), (tx, _), tx_hash in zip(jobs, signed, hashes):
+        with users_lock:
+            ensure_profile(uid).get("snipes", {}).pop(token, None)
+        if not tx_hash:
+            send_message(uid, f"❌ Snipe of {meta['symbol']} could not be broadcast.")
+            continue
+        note_nonce(order["wallet"], order["nonce"])
+        watch_tx(uid, tx, tx_hash, label=f"Snipe {meta['symbol']}")
+        tokens = out / 10 ** meta["decimals"]
+        track_fill(
+            {
+                "type": "buy",
+                "user_id": int(uid),
+                "chat_id": int(uid),
+                "wallet": order["wallet"],
+                "token": token,
+                "symbol": meta["symbol"],
+                "decimals": meta["decimals"],
+                "txs": [tx_hash],
+                "amounts_in": [order["amount_wei"]],
+                "expected_tokens": tokens,
+                "price_usd": order["amount_wei"] / 1e18 * (bnb_price or 0) / tokens,
+                "bnb_price_usd": bnb_price,
+            },
+            save=False,
+        )
+        send_message(
+            uid,
+            f"🎯 Liquidity detected for *{meta['symbol']}* ({symbol_path}), snipe sent in {latency_ms:.0f} ms.\nTx: `{tx_hash}`",
+            tx_buttons([tx_hash]),
+        )
+    for uid, order, reason in held:
+        snipe_stats["held"] += 1
+        if order["held"] != reason:
+            order["held"] = reason
+            send_message(uid, f"🎯 Liquidity added for *{meta['symbol']}*, but {reason}. Your snipe stays armed.")
+    if jobs:
+        save_users(users)
+        save_fills()
+
+
+def announce_launch(launch):
+    """Fires the armed buys for a launch here, or in every shard worker when this is the intake process."""
+    if SHARD["role"] == "intake":
+        for q in shard_queues:
+            q.put({"snipe_launch": launch})
+    else:
+        fire_snipes(**launch)
+
+
+def check_launches(from_block, to_block, watch):
+    armed = {token for _, token in watch}
+    for pair in [p for p, (t, _) in snipe_created.items() if t not in armed]:
+        del snipe_created[pair]
+    if not armed:
+        return
+    pairs = {p.lower(): (token, hub) for (_, token), hubs in watch.items() for hub, p in hubs.items() if p}
+    pairs.update(snipe_created)
+    logs = rpc_call(
+        "eth_getLogs",
+        [
+            {
+                "fromBlock": hex(from_block),
+                "toBlock": hex(to_block),
+                "address": [PANCAKE_FACTORY] + list(pairs),
+                "topics": [[PAIR_CREATED_TOPIC, SYNC_TOPIC, MINT_TOPIC]],
+            }
+        ],
+    )
+    synced = {}  # pair -> reserves from its latest Sync, which V2 emits just before Mint
+    for log in logs or []:
+        detected_at = time.time()
+        block = int(log["blockNumber"], 16)
+        topic, address = log["topics"][0], log["address"].lower()
+        if topic == PAIR_CREATED_TOPIC and address == PANCAKE_FACTORY.lower():
+            t0, t1 = topic_to_address(log["topics"][1]), topic_to_address(log["topics"][2])
+            token, hub = (t0, t1) if t0 in armed else (t1, t0)
+            if token not in armed or hub not in SNIPE_HUBS:
+                continue
+            pair = topic_to_address(log["data"][:66])
+            snipe_created[pair.lower()] = (token, hub)
+            # addLiquidityETH creates the pair and mints in one tx; the new pair's logs are not in this query
+            reserves = fetch_reserves([pair]).get(pair)
+            if reserves and reserves[0] > 0 and reserves[1] > 0:
+                announce_launch(
+                    {"token": token, "hub": hub, "pair": pair, "reserves": list(reserves), "detected_at": detected_at, "block": block}
+                )
+        elif topic == SYNC_TOPIC:
+            synced[address] = decode_reserves(log["data"])
+        elif topic == MINT_TOPIC and address in pairs and synced.get(address):
+            token, hub = pairs[address]
+            announce_launch(
+                {
+                    "token": token,
+                    "hub": hub,
+                    "pair": Web3.to_checksum_address(address),
+                    "reserves": list(synced[address]),
+                    "detected_at": detected_at,
+                    "block": block,
+                }
+            )
+
+
+def snipe_watcher():
+    """The one launch watcher: in the bot's process, or in the intake process in sharded mode."""
+    last_block = None
+    while True:
+        try:
+            watch = snipe_watch.copy()  # one round trip on a Manager dict
+            if watch:
+                head = int(rpc_call("eth_blockNumber", []), 16)
+                if last_block is None:
+                    last_block = head - 1
+                if head > last_block:
+                    check_launches(last_block + 1, head, watch)
+                    last_block = head
+            else:
+                last_block = None
+        except Exception as e:
+            print("Snipe watcher error:", e)
+        time.sleep(SNIPE_POLL_SEC)
+
+
+def snipe_refresh_worker():
+    while True:
+        try:
+            refresh_snipes()
+        except Exception as e:
+            print("Snipe refresh error:", e)
+        time.sleep(SNIPE_RESIGN_SEC)
+
+
+# ---------- DCA / TWAP schedules ----------
+# Recurring buys (DCA) and large orders cut into slices over time (TWAP). Schedules
+# live in the user profile and are put on a hashed timing wheel at start-up:
+# inserting is O(1) and each tick only touches the entries of one slot. Slices
+# that come due in the same block are quoted against one reserves snapshot (each
+# slice seeing the impact of the ones before it), signed in parallel and
+# broadcast together. A slice whose price impact exceeds its guard waits.
+SCHED_TICK_SEC = float(os.getenv("SCHED_TICK_SEC", "1"))
+SCHED_WHEEL_SLOTS = int(os.getenv("SCHED_WHEEL_SLOTS", "4096"))
+SCHED_MAX_IMPACT_PCT = float(os.getenv("SCHED_MAX_IMPACT_PCT", "3"))
+SCHED_RETRY_SEC = float(os.getenv("SCHED_RETRY_SEC", "60"))  # wait after a guarded or unfunded slice
+SCHED_MIN_INTERVAL_SEC = 60
+SCHED_MAX_PER_USER = 20
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+sched_lock = threading.Lock()
+sched_snapshot = {"block": None, "hops": {}}  # head block -> hops per path, advanced by each slice
+sched_stats = {"ticks": 0, "slices": 0, "guarded": 0, "max_batch": 0}
+
+
+class TimingWheel:
+    """Hashed timing wheel of (key, generation) entries."""
+
+    def __init__(self, slots, tick):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.cursor = 0
+        self.now = time.time()  # time the cursor slot stands for
+        self.lock = threading.Lock()
+
+    def add(self, key, due, gen=0):
+        with self.lock:
+            ticks = max(math.ceil((due - self.now) / self.tick), 1)
+            rounds = (ticks - 1) // len(self.slots)
+            self.slots[(self.cursor + ticks) % len(self.slots)].append([rounds, key, gen])
+
+    def advance(self):
+        """Moves one tick forward and returns the (key, generation) entries now due."""
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            self.now += self.tick
+            slot = self.slots[self.cursor]
+            due = [(key, gen) for rounds, key, gen in slot if rounds == 0]
+            if due:
+                slot[:] = [e for e in slot if e[0] > 0]
+            for e in slot:
+                e[0] -= 1
+            return due
+
+
+sched_wheel = TimingWheel(SCHED_WHEEL_SLOTS, SCHED_TICK_SEC)
+
+
+def parse_duration(text):
+    """'30m' / '4h' / '1d' / '90s' -> seconds."""
+    text = text.strip().lower()
+    if not text or text[-1] not in DURATION_UNITS:
+        raise ValueError(f"bad duration {text!r}")
+    return float(text[:-1]) * DURATION_UNITS[text[-1]]
+
+
+def format_duration(seconds):
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size and seconds % size == 0:
+            return f"{int(seconds // size)}{unit}"
+    return f"{int(seconds)}s"
+
+
+def _wheel_schedule(uid, sched):
+    sched_wheel.add((uid, sched["id"]), sched["next_at"], sched["gen"])
+
+
+def create_schedule(user_id, sched):
+    """Stores a new schedule in the user's profile and puts its first slice on the wheel."""
+    with users_lock:
+        profile = ensure_profile(user_id)
+        schedules = profile.setdefault("schedules", {})
+        if len(schedules) >= SCHED_MAX_PER_USER:
+            raise Exception(f"at most {SCHED_MAX_PER_USER} schedules per user")
+        sched_id = f"{int(time.time() * 1000) % 10**8:08d}"
+        while sched_id in schedules:
+            sched_id = f"{(int(sched_id) + 1) % 10**8:08d}"
+        sched.update(
+            {
+                "id": sched_id,
+                "gen": 0,
+                "done": 0,
+                "paused": False,
+                "next_at": time.time(),
+                "created": time.time(),
+            }
+        )
+        schedules[sched["id"]] = sched
+        save_users(users)
+    _wheel_schedule(str(user_id), sched)
+    return sched
+
+
+def cancel_schedule(user_id, sched_id):
+    with users_lock:
+        profile = ensure_profile(user_id)
+        if not profile or not profile.get("schedules", {}).pop(sched_id, None):
+            return False
+        save_users(users)
+    return True
+
+
+def load_schedules():
+    with users_lock:
+        for uid, profile in users.items():
+            if owns_user(uid):
+                for sched in profile.get("schedules", {}).values():
+                    _wheel_schedule(uid, sched)
+
+
+def slice_amount(sched):
+    """Raw input of the next slice: wei for buys, token units for sells."""
+    if sched["kind"] == "dca":
+        return sched["amount"]
+    per = sched["amount"] // sched["slices"]
+    return sched["amount"] - per * (sched["slices"] - 1) if sched["done"] == sched["slices"] - 1 else per
+
+
+def snapshot_hops(paths):
+    """Hops for each path at the head block, shared by every slice run in that block."""
+    block = head_block()
+    with sched_lock:
+        if sched_snapshot["block"] != block:
+            sched_snapshot.update({"block": block, "hops": {}})
+        missing = [p for p in paths if tuple(p) not in sched_snapshot["hops"]]
+    if missing:
+        pairs = list({resolve_pair(a, b) for path in missing for a, b in zip(path, path[1:])} - {None})
+        for pair in pairs:
+            reserves_cache.pop(pair, None)
+        fetch_reserves(pairs)
+        fetched = {tuple(p): path_hops(p) for p in missing}
+        with sched_lock:
+            if sched_snapshot["block"] == block:
+                for key, hops in fetched.items():
+                    sched_snapshot["hops"].setdefault(key, hops)
+    with sched_lock:
+        return sched_snapshot["hops"]
+
+
+def price_impact(amount_in, hops):
+    """Output shortfall against the route's spot price (fees excluded), from reserves before the slice."""
+    ea, eb = virtual_pool(hops)
+    g = PANCAKE_FEE_NUM / PANCAKE_FEE_DEN
+    ideal = amount_in * g * eb / ea
+    return 1 - quote_hops(amount_in, hops) / ideal if ideal > 0 else 1.0
+
+
+def next_slot(sched, now):
+    """The schedule's next slot after now; slots missed while the bot was down are skipped."""
+    missed = max(math.floor((now - sched["next_at"]) / sched["interval"]), 0)
+    return sched["next_at"] + (missed + 1) * sched["interval"]
+
+
+def run_due_slices(due):
+    """Quotes, guards, signs and broadcasts every slice in due as one batch."""
+    entries = []
+    with users_lock:
+        for (uid, sid), gen in due:
+            sched = users.get(uid, {}).get("schedules", {}).get(sid)
+            if sched and sched["gen"] == gen and owns_user(uid):
+                entries.append((uid, dict(sched), get_user_account(uid)[0], users[uid]["private_key"]))
+    if not entries:
+        return
+    sched_stats["max_batch"] = max(sched_stats["max_batch"], len(entries))
+
+    wallets = [acct.address for _, _, acct, _ in entries]
+    sells = [(acct.address, s["token"]) for _, s, acct, _ in entries if s["side"] == "sell"]
+    nonces, bnb, token_bal, allowance, base_gas = read_wallet_states(wallets, sells)
+
+    paths = {}
+    for _, sched, _, _ in entries:
+        key = (sched["side"], sched["token"])
+        if key in paths:
+            continue
+        try:
+            buy_path = get_path_for_buy(sched["token"])
+            paths[key] = buy_path if sched["side"] == "buy" else list(reversed(buy_path))
+        except Exception:
+            paths[key] = None
+    hops_by_path = snapshot_hops([p for p in paths.values() if p])
+
+    deadline = int(time.time()) + 600
+    orders, waiting = [], []
+    for uid, sched, acct, pk in entries:
+        w = acct.address
+        path = paths[(sched["side"], sched["token"])]
+        hops = hops_by_path.get(tuple(path)) if path else None
+        amount = slice_amount(sched)
+        if sched["side"] == "buy":
+            funded = bnb[w] >= amount + w3.to_wei(COPY_GAS_RESERVE_BNB, "ether")
+        else:
+            amount = min(amount, token_bal[(w, sched["token"])])
+            funded = amount > 0
+        reason = None
+        if not hops:
+            reason = "no liquid route"
+        elif not funded:
+            reason = "insufficient balance"
+        else:
+            impact = price_impact(amount, hops)
+            if impact * 100 > sched["max_impact"]:
+                reason = f"price impact {impact * 100:.2f}% > {sched['max_impact']:g}%"
+        if reason:
+            waiting.append((uid, sched, reason))
+            continue
+        settings = get_user_settings(uid)
+        order = {
+            "uid": uid,
+            "sched": sched,
+            "side": sched["side"],
+            "token": sched["token"],
+            "symbol": sched["symbol"],
+            "decimals": sched["decimals"],
+            "path": path,
+            "wallet": w,
+            "pk": pk,
+            "nonce": nonces[w],
+            "gas_price": int(base_gas * GAS_MODE_MULTIPLIERS.get(settings.get("gas_mode"), 1.0)),
+            "deadline": deadline,
+            "amount_in": amount,
+            "expected_out": simulate_hops(amount, hops),
+            "note": f" (slice {sched['done'] + 1}{'/' + str(sched['slices']) if sched['slices'] else ''}, {sched['kind'].upper()})",
+        }
+        order["min_out"] = int(order["expected_out"] * (1 - settings.get("slippage", 0.03)))
+        if sched["side"] == "buy":
+            bnb[w] -= amount
+        else:
+            order["needs_approval"] = allowance[(w, sched["token"])] < amount
+            allowance[(w, sched["token"])] = MAX_UINT256 if order["needs_approval"] else allowance[(w, sched["token"])] - amount
+            token_bal[(w, sched["token"])] -= amount
+        nonces[w] += 2 if order.get("needs_approval") else 1
+        orders.append(order)
+
+    notes, finished = [], []
+    if orders:
+        with ThreadPoolExecutor(max_workers=COPY_SIGN_WORKERS) as pool:
+            signed = list(pool.map(_sign_copy_order, orders))
+        hashes = broadcast_raw_txs([raw for raws in signed for raw in raws])
+        sched_stats["slices"] += len(orders)
+        # progress is saved before booking: if anything after the broadcast fails, the
+        # worker's retry sees the new generation and never sends the slice again
+        pos = 0
+        now = time.time()
+        with users_lock:
+            for order, raws in zip(orders, signed):
+                pos += len(raws)
+                sched = users.get(order["uid"], {}).get("schedules", {}).get(order["sched"]["id"])
+                if not sched:
+                    continue
+                if not hashes[pos - 1]:
+                    sched["next_at"] = now + SCHED_RETRY_SEC
+                else:
+                    sched["done"] += 1
+                    sched["paused"] = False
+                    sched["next_at"] = next_slot(sched, now)
+                if sched["slices"] and sched["done"] >= sched["slices"]:
+                    users[order["uid"]]["schedules"].pop(sched["id"])
+                    finished.append((int(order["uid"]), f"✅ {sched['kind'].upper()} `{sched['id']}` for {sched['symbol']} completed."))
+                    continue
+                sched["gen"] += 1
+                _wheel_schedule(order["uid"], sched)
+            save_users(users)
+        notes = book_sent_orders(orders, signed, hashes, "⏱", "Scheduled") + finished
+
+    now = time.time()
+    with users_lock:
+        for uid, snap, reason in waiting:
+            sched = users.get(uid, {}).get("schedules", {}).get(snap["id"])
+            if not sched:
+                continue
+            sched_stats["guarded"] += 1
+            if not sched["paused"]:
+                notes.append((int(uid), f"⏸ {sched['kind'].upper()} `{sched['id']}` ({sched['symbol']}) waiting: {reason}. Retrying every {format_duration(SCHED_RETRY_SEC)}."))
+            sched["paused"] = True
+            sched["next_at"] = now + min(SCHED_RETRY_SEC, sched["interval"])
+            sched["gen"] += 1
+            _wheel_schedule(uid, sched)
+        save_users(users)
+    if orders:
+        save_fills()
+    for chat_id, text in notes:
+        send_message(chat_id, text)
+
+
+def schedule_worker():
+    load_schedules()
+    next_tick = sched_wheel.now
+    while True:
+        next_tick += SCHED_TICK_SEC
+        time.sleep(max(next_tick - time.time(), 0))
+        due = sched_wheel.advance()
+        sched_stats["ticks"] += 1
+        if not due:
+            continue
+        try:
+            run_due_slices(due)
         except Exception as e:
-            edit_message(chat_id, msg_id, f"Error reading token info: {e}", get_main_menu(has_wallet))
+            print("Schedule run error:", e)
+            retry_unsent(due)
+
+
+def retry_unsent(due):
+    """Puts due entries that a failed run left untouched back on the wheel after the usual wait."""
+    with users_lock:
+        for (uid, sid), gen in due:
+            sched = users.get(uid, {}).get("schedules", {}).get(sid)
+            if not sched or sched["gen"] != gen:
+                continue  # removed, or already sent and rescheduled
+            sched["next_at"] = time.time() + SCHED_RETRY_SEC
+            sched["gen"] += 1
+            _wheel_schedule(uid, sched)
+        save_users(users)
+
+
+# ---------- Multiple wallets ----------
+# A user can add wallets next to the one they connected with and pick an active
+# set. With more than one active wallet a buy is split evenly and a sell in
+# proportion to each wallet's holdings; every wallet's tx is built from one batch
+# of reads (own nonce, balances, allowance), signed in parallel and broadcast
+# together. The first wallet stays primary for snipes, schedules and copy trades.
+MAX_WALLETS_PER_USER = int(os.getenv("MAX_WALLETS_PER_USER", "10"))
+
+
+def multi_wallet_trade(user_id, side, token_address, amount_raw):
+    """
+    Splits one trade over the user's active wallets: amount_raw is BNB wei for a
+    buy, token units for a sell. Returns (orders sent, wallets skipped).
+    """
+    uid = str(user_id)
+    token = Web3.to_checksum_address(token_address)
+    wallets = active_wallets(user_id)
+    addresses = [acct.address for acct, _ in wallets]
+    pairs = [(w, token) for w in addresses] if side == "sell" else []
+    nonces, bnb, token_bal, allowance, base_gas = read_wallet_states(addresses, pairs)
+    buy_path = get_path_for_buy(token)
+    path = buy_path if side == "buy" else list(reversed(buy_path))
+    hops = path_hops(path)
+    if not hops:
+        raise Exception("No liquid route")
+    meta = get_token_meta(token)
+    settings = get_user_settings(user_id)
+    reserve = w3.to_wei(COPY_GAS_RESERVE_BNB, "ether")
+
+    if side == "buy":
+        shares = [amount_raw // len(wallets)] * len(wallets)
+        shares[0] += amount_raw - sum(shares)
+    else:
+        held = sum(token_bal[p] for p in pairs)
+        if held <= 0:
+            raise Exception("No balance in the active wallets")
+        shares = [min(amount_raw * token_bal[p] // held, token_bal[p]) for p in pairs]
+
+    deadline = int(time.time()) + 600
+    orders, skipped = [], []
+    for (acct, pk), amount in zip(wallets, shares):
+        w = acct.address
+        if amount <= 0 or (side == "buy" and bnb[w] < amount + reserve):
+            skipped.append(w)
+            continue
+        order = {
+            "uid": uid,
+            "side": side,
+            "token": token,
+            "symbol": meta["symbol"],
+            "decimals": meta["decimals"],
+            "path": path,
+            "wallet": w,
+            "pk": pk,
+            "nonce": nonces[w],
+            "gas_price": int(base_gas * GAS_MODE_MULTIPLIERS.get(settings.get("gas_mode"), 1.0)),
+            "deadline": deadline,
+            "amount_in": amount,
+            "expected_out": simulate_hops(amount, hops),
+            "note": f" from `{w[:8]}…`",
+        }
+        order["min_out"] = int(order["expected_out"] * (1 - settings.get("slippage", 0.03)))
+        if side == "sell":
+            order["needs_approval"] = allowance[(w, token)] < amount
+        orders.append(order)
+    if not orders:
+        raise Exception("No active wallet can cover its share")
+
+    with ThreadPoolExecutor(max_workers=min(len(orders), COPY_SIGN_WORKERS)) as pool:
+        signed = list(pool.map(_sign_copy_order, orders))
+    hashes = broadcast_raw_txs([raw for raws in signed for raw in raws])
+    book_sent_orders(orders, signed, hashes, "👛", "Multi-wallet")
+    save_users(users)
+    save_fills()
+    for order in orders:
+        if order.get("needs_approval") and order["tx"]:
+            set_allowance(order["wallet"], token, MAX_UINT256)
+    return orders, skipped
+
+
+def wallets_screen(user_id):
+    profile = ensure_profile(user_id)
+    wallets = user_wallets(user_id)
+    active = {acct.address for acct, _ in active_wallets(user_id)}
+    bnb = fetch_balances([acct.address for acct, _ in wallets])[0]
+    total = 0
+    lines = ["💼 *Wallets*"]
+    buttons = []
+    for i, (acct, _) in enumerate(wallets):
+        wei = bnb.get(acct.address.lower(), 0)
+        total += wei
+        mark = "✅" if acct.address in active else "▫️"
+        tag = " (primary)" if i == 0 else ""
+        lines.append(f"\n{mark} #{i + 1}{tag}\n`{acct.address}`\nBNB: *{format_number(wei / 1e18)}*")
+        row = [{"text": f"{mark} #{i + 1}", "callback_data": f"wtoggle_{i}"}]
+        if i > 0:
+            row.append({"text": f"🗑 #{i + 1}", "callback_data": f"wremove_{i}"})
+        buttons.append(row)
+    lines.append(f"\nTotal BNB: *{format_number(total / 1e18)}*")
+    lines.append(f"Trades run on {len(active)} active wallet(s). Tap a wallet to toggle it.")
+    lines.append(f"\nCopy-trade ID: `{user_id}` (others follow you with `/copy {user_id} <size>`)")
+    if len(wallets) < MAX_WALLETS_PER_USER:
+        buttons.append([{"text": "➕ Add wallet", "callback_data": "add_wallet"}])
+    buttons.append([{"text": "⬅️ Back", "callback_data": "back_main"}])
+    return "\n".join(lines), buttons
+
+
+def wallets_line(user_id, side):
+    """Confirmation-screen note when a trade will not run on the primary wallet alone."""
+    active = active_wallets(user_id)
+    count = len(active)
+    if trades_on_primary(user_id):
+        return ""
+    if count == 1:
+        return f"\n👛 From wallet `{active[0][0].address}`."
+    how = "evenly" if side == "buy" else "in proportion to each wallet's balance"
+    return f"\n👛 Split {how} over {count} active wallets."
+
+
+def set_wallet_active(user_id, index, active=None):
+    """Toggles (or sets) wallet index in the active set; the set never ends up empty."""
+    with users_lock:
+        profile = ensure_profile(user_id)
+        addresses = [acct.address for acct, _ in user_wallets(user_id)]
+        if not 0 <= index < len(addresses):
             return
+        chosen = [acct.address for acct, _ in active_wallets(user_id)]
+        addr = addresses[index]
+        if active is None:
+            active = addr not in chosen
+        if active and addr not in chosen:
+            chosen.append(addr)
+        elif not active and addr in chosen and len(chosen) > 1:
+            chosen.remove(addr)
+        profile["active_wallets"] = chosen
+        save_users(users)
+
+
+# ---------- Update routing ----------
+# Callback data and conversation steps map to handlers by exact name or prefix.
+# Every route gets latency metrics; heavy screens get a concurrency limit so they
+# cannot occupy every handler thread (HANDLER_THREADS, see Update dispatch), and
+# static screens can be cached.
+HEAVY_ROUTE_LIMIT = int(os.getenv("HEAVY_ROUTE_LIMIT", "2"))
+LIGHT_ROUTE_LIMIT = int(os.getenv("LIGHT_ROUTE_LIMIT", "4"))
+ROUTE_LATENCY_SAMPLES = 500
+
+
+class UpdateContext:
+    """What a handler needs about the update it is serving, resolved once."""
+
+    def __init__(self, chat_id, user_id, msg_id=None, data=None, text=None, cb=None):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.msg_id = msg_id
+        self.data = data
+        self.text = text
+        self.cb = cb
+        self.uid = str(user_id)
+        self.has_wallet = self.uid in users
+        self.state = None
+        self.route = None
+        self.received = time.time()
+
+
+class Router:
+    """
+    Exact routes win over prefixes, longest prefix first. Middleware wraps every
+    handler as mw(ctx, call_next). Routes with cache=key_fn return (text, buttons)
+    and the router edits the message; the screen is cached per key_fn(ctx).
+    """
+
+    def __init__(self, name, on_busy):
+        self.name = name
+        self.on_busy = on_busy
+        self.exact = {}
+        self.prefixes = []  # (prefix, route), longest first
+        self.middleware = []
+        self.lock = threading.Lock()
+        self.screens = {}  # (route name, cache key) -> (text, buttons)
+
+    def route(self, *keys, prefix=False, limit=None, cache=None):
+        def register(handler):
+            route = {
+                "name": "|".join(keys) + ("*" if prefix else ""),
+                "handler": handler,
+                "slots": threading.BoundedSemaphore(limit) if limit else None,
+                "cache": cache,
+                "stats": {"calls": 0, "errors": 0, "busy": 0, "cached": 0, "latency": deque(maxlen=ROUTE_LATENCY_SAMPLES)},
+            }
+            for key in keys:
+                if prefix:
+                    self.prefixes.append((key, route))
+                    self.prefixes.sort(key=lambda item: -len(item[0]))
+                else:
+                    self.exact[key] = route
+            return handler
+
+        return register
+
+    def use(self, middleware):
+        self.middleware.append(middleware)
+        return middleware
+
+    def resolve(self, key):
+        route = self.exact.get(key)
+        if route:
+            return route
+        for prefix, route in self.prefixes:
+            if key.startswith(prefix):
+                return route
+        return None
+
+    def routes(self):
+        seen = {}
+        for route in list(self.exact.values()) + [r for _, r in self.prefixes]:
+            seen[route["name"]] = route
+        return list(seen.values())
+
+    def _call(self, route, ctx):
+        try:
+            if not route["cache"]:
+                route["handler"](ctx)
+                return
+            key = (route["name"], route["cache"](ctx))
+            screen = self.screens.get(key)
+            if screen is None:
+                screen = self.screens[key] = route["handler"](ctx)
+            else:
+                with self.lock:
+                    route["stats"]["cached"] += 1
+            edit_message(ctx.chat_id, ctx.msg_id, *screen)
+        except Exception:
+            with self.lock:
+                route["stats"]["errors"] += 1
+            raise
+
+    def dispatch(self, key, ctx):
+        """Runs the handler for key. Returns False when no route matches."""
+        route = self.resolve(key)
+        if route is None:
+            return False
+        ctx.route = route["name"]
+        stats = route["stats"]
+        slots = route["slots"]
+        if slots and not slots.acquire(blocking=False):
+            with self.lock:
+                stats["busy"] += 1
+            self.on_busy(ctx)
+            return True
+
+        call = lambda c: self._call(route, c)
+        for mw in reversed(self.middleware):
+            call = (lambda mw, call_next: lambda c: mw(c, call_next))(mw, call)
+        started = time.perf_counter()
+        try:
+            with span(route["name"], "handler"):
+                call(ctx)
+        finally:
+            if slots:
+                slots.release()
+            with self.lock:
+                stats["calls"] += 1
+                stats["latency"].append((time.perf_counter() - started) * 1000)
+        return True
+
+    def report(self):
+        """One line per route, slowest p95 first."""
+        rows = []
+        with self.lock:
+            for route in self.routes():
+                st = route["stats"]
+                samples = sorted(st["latency"])
+                if not samples:
+                    continue
+                p50 = samples[len(samples) // 2]
+                p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+                rows.append((p95, f"`{route['name']}`: {st['calls']} calls, p50 {p50:.0f} ms, p95 {p95:.0f} ms, "
+                             f"errors {st['errors']}, busy {st['busy']}, cached {st['cached']}"))
+        return [line for _, line in sorted(rows, reverse=True)]
+
+
+def busy_reply(ctx):
+    send_message(ctx.chat_id, "⏳ Busy right now, tap again in a moment.")
+
+
+callback_router = Router("callback", busy_reply)
+message_router = Router("message", busy_reply)
+command_router = Router("command", busy_reply)
+ADMIN_COMMANDS = ("/signal", "/rpcstats", "/copystats", "/trace", "/profile", "/revenue", "/lookupstats", "/routestats", "/latency")
+WALLET_COMMANDS = ("/copy", "/snipe", "/unsnipe", "/snipes", "/dca|/twap", "/schedules", "/unschedule")
+
+
+def report_handler_errors(ctx, call_next):
+    """Logs a failing handler with its route and tells the user instead of going silent."""
+    try:
+        call_next(ctx)
+    except Exception as e:
+        print(f"Handler error in {ctx.route}:", e)
+        send_message(ctx.chat_id, "❌ Something went wrong, please try again.")
+
+
+def command_access(ctx, call_next):
+    """Admin commands only for ADMIN_IDS; wallet commands only once a wallet is connected."""
+    if ctx.route in ADMIN_COMMANDS and ctx.uid not in ADMIN_IDS:
+        send_message(ctx.chat_id, "Use the menu buttons below.", get_main_menu(ctx.has_wallet))
+        return
+    if ctx.route in WALLET_COMMANDS and not ctx.has_wallet:
+        send_message(ctx.chat_id, "Connect a wallet first.", get_main_menu(False))
+        return
+    call_next(ctx)
+
+
+callback_router.use(report_handler_errors)
+message_router.use(report_handler_errors)
+command_router.use(report_handler_errors)
+command_router.use(command_access)
+
+
+# ---------- Callback handlers ----------
+# connect / disconnect / basics
+@callback_router.route("connect_wallet")
+def cb_connect_wallet(ctx):
+    user_states[ctx.user_id] = {"step": "await_pk", "data": {}}
+    edit_message(
+        ctx.chat_id,
+        ctx.msg_id,
+        "🔐 Send your PRIVATE KEY.\n\n⚠ Use a fresh wallet. You are responsible for your funds.",
+    )
+
+
+@callback_router.route("disconnect")
+def cb_disconnect(ctx):
+    if ctx.uid in users:
+        del users[ctx.uid]
+        save_users(users)
+    user_states.pop(ctx.user_id, None)
+    edit_message(ctx.chat_id, ctx.msg_id, "Wallet disconnected.", get_main_menu(False))
+
+
+@callback_router.route("wallet", limit=LIGHT_ROUTE_LIMIT)
+def cb_wallet(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "No wallet connected.", get_main_menu(False))
+        return
+    edit_message(ctx.chat_id, ctx.msg_id, *wallets_screen(ctx.user_id))
+
+
+@callback_router.route("add_wallet")
+def cb_add_wallet(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect a wallet first.", get_main_menu(False))
+        return
+    user_states[ctx.user_id] = {"step": "await_extra_pk", "data": {}}
+    edit_message(
+        ctx.chat_id,
+        ctx.msg_id,
+        "➕ Send the PRIVATE KEY of the wallet to add.\n\n⚠ Use a fresh wallet. You are responsible for your funds.",
+    )
+
+
+@callback_router.route("wtoggle_", "wremove_", prefix=True, limit=LIGHT_ROUTE_LIMIT)
+def cb_wallet_edit(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "No wallet connected.", get_main_menu(False))
+        return
+    action, index = ctx.data.split("_", 1)
+    index = int(index)
+    if action == "wtoggle":
+        set_wallet_active(ctx.user_id, index)
+    elif index > 0:
+        set_wallet_active(ctx.user_id, index, active=False)
+        with users_lock:
+            extra = ensure_profile(ctx.user_id).get("wallets", [])
+            if index - 1 < len(extra):
+                removed = extra.pop(index - 1)
+                profile = ensure_profile(ctx.user_id)
+                profile["active_wallets"] = [a for a in profile.get("active_wallets", []) if a != removed["address"]]
+                save_users(users)
+    edit_message(ctx.chat_id, ctx.msg_id, *wallets_screen(ctx.user_id))
+
+
+@callback_router.route("help", cache=lambda ctx: ctx.has_wallet)
+def cb_help(ctx):
+    text = (
+        "🤖 *BSC Multi-User Trading Bot*\n\n"
+        "1️⃣ Connect wallet (fresh wallet only)\n"
+        "2️⃣ Tap Trade → Buy or Sell\n"
+        "3️⃣ Paste token contract address\n"
+        "4️⃣ Bot shows price / MC / holders / risk\n"
+        "5️⃣ Proceed → choose % or custom amount → confirm\n\n"
+        "🔁 Copy trading: `/copy <leader id|signal> <BNB or %>`, stop with `/uncopy`\n"
+        "🎯 Launch snipe: `/snipe <CA> <BNB>`, list with `/snipes`, stop with `/unsnipe <CA>`\n"
+        "⏱ DCA / TWAP: `/dca <CA> <BNB> <every>`, `/twap <buy|sell> <CA> <size> <over> <slices>`, see `/schedules`\n\n"
+        "⚠ Only run this bot on your own server. Trades through this bot pay a fee to the operator."
+    )
+    return text, get_main_menu(ctx.has_wallet)
+
+
+@callback_router.route("trade_menu", cache=lambda ctx: ctx.has_wallet)
+def cb_trade_menu(ctx):
+    if not ctx.has_wallet:
+        return "Connect a wallet first.", get_main_menu(False)
+    buttons = [
+        [
+            {"text": "🟢 Buy (BNB → Token)", "callback_data": "buy_flow"},
+            {"text": "🔴 Sell (Token → BNB)", "callback_data": "sell_flow"},
+        ],
+        [{"text": "⬅️ Back", "callback_data": "back_main"}],
+    ]
+    return "Choose trade type:", buttons
+
+
+@callback_router.route("back_main", cache=lambda ctx: ctx.has_wallet)
+def cb_back_main(ctx):
+    return "Main menu:", get_main_menu(ctx.has_wallet)
+
+
+# settings menu
+def settings_screen(ctx):
+    settings = get_user_settings(ctx.user_id) if ctx.has_wallet else {"slippage": 0.03, "gas_mode": "standard"}
+    slip = settings["slippage"] * 100
+    mode = settings["gas_mode"]
+    auto_approve = "on" if settings.get("auto_approve") else "off"
+    ceiling = settings.get("gas_ceiling_gwei", TX_GAS_CEILING_GWEI)
+    text = (
+        "⚙ *Settings*\n\n"
+        f"Slippage: *{slip:.1f}%*\n"
+        f"Gas mode: *{mode}*\n"
+        f"Gas ceiling for bumps: *{ceiling:g} gwei*\n"
+        f"Approve after buy: *{auto_approve}*\n\n"
+        "Adjust below:"
+    )
+    buttons = [
+        [
+            {"text": "Slippage 1%", "callback_data": "set_slip_1"},
+            {"text": "3%", "callback_data": "set_slip_3"},
+            {"text": "5%", "callback_data": "set_slip_5"},
+        ],
+        [
+            {"text": "Gas: standard", "callback_data": "set_gas_standard"},
+            {"text": "fast", "callback_data": "set_gas_fast"},
+            {"text": "turbo", "callback_data": "set_gas_turbo"},
+        ],
+        [{"text": f"Max gas {g} gwei", "callback_data": f"set_ceiling_{g}"} for g in GAS_CEILING_CHOICES],
+        [{"text": f"Approve after buy: {auto_approve}", "callback_data": "toggle_auto_approve"}],
+        [{"text": "⬅️ Back", "callback_data": "back_main"}],
+    ]
+    return text, buttons
+
+
+@callback_router.route("settings")
+def cb_settings(ctx):
+    edit_message(ctx.chat_id, ctx.msg_id, *settings_screen(ctx))
+
+
+@callback_router.route("set_slip_", prefix=True)
+def cb_set_slip(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect wallet first.", get_main_menu(False))
+        return
+    profile = ensure_profile(ctx.user_id)
+    if ctx.data == "set_slip_1":
+        profile["settings"]["slippage"] = 0.01
+    elif ctx.data == "set_slip_3":
+        profile["settings"]["slippage"] = 0.03
+    elif ctx.data == "set_slip_5":
+        profile["settings"]["slippage"] = 0.05
+    save_users(users)
+    edit_message(ctx.chat_id, ctx.msg_id, *settings_screen(ctx))
+
+
+@callback_router.route("set_gas_", prefix=True)
+def cb_set_gas(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect wallet first.", get_main_menu(False))
+        return
+    profile = ensure_profile(ctx.user_id)
+    if ctx.data == "set_gas_standard":
+        profile["settings"]["gas_mode"] = "standard"
+    elif ctx.data == "set_gas_fast":
+        profile["settings"]["gas_mode"] = "fast"
+    elif ctx.data == "set_gas_turbo":
+        profile["settings"]["gas_mode"] = "turbo"
+    save_users(users)
+    edit_message(ctx.chat_id, ctx.msg_id, *settings_screen(ctx))
+
+
+@callback_router.route("set_ceiling_", prefix=True)
+def cb_set_ceiling(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect wallet first.", get_main_menu(False))
+        return
+    gwei = int(ctx.data[len("set_ceiling_") :])
+    if gwei not in GAS_CEILING_CHOICES:
+        return
+    ensure_profile(ctx.user_id)["settings"]["gas_ceiling_gwei"] = gwei
+    save_users(users)
+    edit_message(ctx.chat_id, ctx.msg_id, *settings_screen(ctx))
+
+
+@callback_router.route("toggle_auto_approve")
+def cb_toggle_auto_approve(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect wallet first.", get_main_menu(False))
+        return
+    profile = ensure_profile(ctx.user_id)
+    profile["settings"]["auto_approve"] = not profile["settings"].get("auto_approve", False)
+    save_users(users)
+    edit_message(ctx.chat_id, ctx.msg_id, *settings_screen(ctx))
+
+
+# portfolio
+@callback_router.route("portfolio", limit=HEAVY_ROUTE_LIMIT)
+def cb_portfolio(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect wallet first.", get_main_menu(False))
+        return
+    positions = get_user_positions(ctx.user_id)
+    if not positions:
+        edit_message(ctx.chat_id, ctx.msg_id, "📊 No tracked positions yet.", get_main_menu(True))
+        return
+
+    try:
+        bnb_wei, onchain = user_balances(ctx.user_id)
+    except Exception as e:
+        print("Portfolio balances error:", e)
+        bnb_wei, onchain = None, {}
+
+    total_value = 0.0
+    lines = ["📊 *Portfolio*"]
+    if bnb_wei is not None:
+        lines.append(f"BNB: *{format_number(bnb_wei / 1e18)}*")
+    for t, p in positions.items():
+        symbol = p["symbol"]
+        amount = p["amount"]
+        avg = p["avg_price_usd"]
+        held_line = ""
+        if t in onchain:
+            held_line = f"On-chain: {format_number(onchain[t] / (10 ** token_decimals(t)))}\n"
+        try:
+            info = get_token_info(t)
+            price = info["price_usd"]
+            if price is None:
+                lines.append(f"\n{symbol} ({t}):\nAmount: {format_number(amount)}\n{held_line}Price: Unknown")
+                continue
+            val = amount * price
+            pnl_pct = (price - avg) / avg * 100 if avg > 0 else 0
+            total_value += val
+            lines.append(
+                f"\n*{symbol}*\nCA: `{t}`\n"
+                f"Amount: {format_number(amount)}\n{held_line}"
+                f"Avg: {'received, no cost basis' if p.get('discovered') and not avg else '$' + format_number(avg)}\n"
+                f"Now: ${format_number(price)}\n"
+                f"Value: ${format_number(val)}\n"
+                f"PnL: {pnl_pct:+.2f}%"
+            )
+        except Exception as e:
+            lines.append(f"\n{symbol} ({t}): error fetching price: {e}")
+    lines.append(f"\n*Total est. value:* ${format_number(total_value)}")
+    edit_message(ctx.chat_id, ctx.msg_id, "\n".join(lines), get_main_menu(True))
+
 
-        state["data"]["info"] = info
-        base = (
-            "📊 TOKEN OVERVIEW (BUY)\n\n"
-            if data.startswith("buy_")
-            else "📊 TOKEN OVERVIEW (SELL)\n\n"
+# ledger screens
+@callback_router.route("history", limit=HEAVY_ROUTE_LIMIT)
+def cb_history(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect wallet first.", get_main_menu(False))
+        return
+    entries = get_user_history(ctx.user_id)
+    if not entries:
+        edit_message(ctx.chat_id, ctx.msg_id, "📜 No trades recorded yet.", get_main_menu(True))
+        return
+    lines = ["📜 *Trade history* (latest first)"]
+    for e in reversed(entries[-10:]):
+        when = time.strftime("%m-%d %H:%M", time.gmtime(e["ts"]))
+        name = e["symbol"] or e["token"][:10]
+        if e["kind"] == "approve":
+            lines.append(f"\n{when} APPROVE {name}\nTx: `{e['txs'][0]}`")
+            continue
+        status = "" if e["status"] == "ok" else " ❌ failed"
+        lines.append(
+            f"\n{when} {e['kind'].upper()} {name}{status}\n"
+            f"{format_number(e['tokens'])} for {format_number(e['bnb'])} BNB"
+            f" @ ${format_number(e['price_usd'])}\nTx: `{e['txs'][-1]}`"
         )
-        text = (
-            f"{base}"
-            f"Symbol: {info['symbol']}\n"
-            f"Address:\n`{info['address']}`\n\n"
-            f"Price: {format_number(info['price_usd'])} USD\n"
-            f"Market Cap: {format_number(info['market_cap_usd'])} USD\n"
-            f"Total Supply: {format_number(info['total_supply'])} {info['symbol']}\n"
-            f"Holders: {info['holders']}\n"
+    edit_message(ctx.chat_id, ctx.msg_id, "\n".join(lines), get_main_menu(True))
+
+
+@callback_router.route("pnl", limit=HEAVY_ROUTE_LIMIT)
+def cb_pnl(ctx):
+    if not ctx.has_wallet:
+        edit_message(ctx.chat_id, ctx.msg_id, "Connect wallet first.", get_main_menu(False))
+        return
+    agg = get_user_pnl(ctx.user_id)
+    if not agg or not agg["trades"]:
+        edit_message(ctx.chat_id, ctx.msg_id, "💰 No settled trades yet.", get_main_menu(True))
+        return
+    open_tokens = [t for t, a in agg["tokens"].items() if a["qty"] > 0]
+    prices = spot_prices_usd(open_tokens)
+    total_unrealized = 0.0
+    lines = ["💰 *PnL*"]
+    for t, a in agg["tokens"].items():
+        unrealized = None
+        if a["qty"] > 0 and prices.get(t) is not None:
+            unrealized = a["qty"] * prices[t] - a["cost_usd"]
+            total_unrealized += unrealized
+        lines.append(
+            f"\n*{a['symbol']}* ({a['trades']} trades)\n"
+            f"Realized: ${format_number(a['realized_usd'], 2)}\n"
+            f"Unrealized: {'$' + format_number(unrealized, 2) if unrealized is not None else 'n/a'}\n"
+            f"Wrapper fees: {format_number(a['fees_bnb'], 6)} BNB"
         )
+    lines.append(
+        f"\n*Total realized:* ${format_number(agg['realized_usd'], 2)}\n"
+        f"*Total unrealized:* ${format_number(total_unrealized, 2)}\n"
+        f"*Volume:* {format_number(agg['volume_bnb'])} BNB, *fees:* {format_number(agg['fees_bnb'], 6)} BNB"
+    )
+    edit_message(ctx.chat_id, ctx.msg_id, "\n".join(lines), get_main_menu(True))
 
-        if data.endswith("risk"):
-            risk = basic_risk_check(token_addr)
-            text += f"\n*Risk check:*\n{risk}\n"
 
-        # if token exposes fee, show it
-        if info.get("fee_percent", 0.0) > 0:
-            text += f"\nToken fee: ~{info['fee_percent']:.2f}% (to: {info.get('fee_receiver')})\n"
+# trade flows
+@callback_router.route("buy_flow")
+def cb_buy_flow(ctx):
+    user_states[ctx.user_id] = {"step": "await_buy_token", "data": {}}
+    edit_message(ctx.chat_id, ctx.msg_id, "🟢 Send *token contract address* to BUY:", None)
+
+
+@callback_router.route("sell_flow")
+def cb_sell_flow(ctx):
+    user_states[ctx.user_id] = {"step": "await_sell_token", "data": {}}
+    edit_message(ctx.chat_id, ctx.msg_id, "🔴 Send *token contract address* to SELL:", None)
+
+
+@callback_router.route("buy_proceed")
+def cb_buy_proceed(ctx):
+    state = user_states.get(ctx.user_id)
+    if not state or state.get("step") != "await_buy_proceed":
+        edit_message(ctx.chat_id, ctx.msg_id, "No token selected for BUY.", get_main_menu(ctx.has_wallet))
+        return
+    state["step"] = "await_buy_amount"
+    user_states[ctx.user_id] = state
+    token_addr = state["data"]["token"]
+    # ask amount with presets
+    buttons = [
+        [
+            {"text": "25% BNB", "callback_data": "buy_pct_25"},
+            {"text": "50%", "callback_data": "buy_pct_50"},
+            {"text": "100%", "callback_data": "buy_pct_100"},
+        ],
+    ]
+    send_message(
+        ctx.chat_id,
+        "Enter BNB amount to BUY (e.g. `0.01`) or use presets below:",
+        buttons,
+    )
+
+
+@callback_router.route("sell_proceed")
+def cb_sell_proceed(ctx):
+    state = user_states.get(ctx.user_id)
+    if not state or state.get("step") != "await_sell_proceed":
+        edit_message(ctx.chat_id, ctx.msg_id, "No token selected for SELL.", get_main_menu(ctx.has_wallet))
+        return
+    state["step"] = "await_sell_amount"
+    user_states[ctx.user_id] = state
+    token_addr = state["data"]["token"]
+    balance_info = ""
+    try:
+        meta = get_token_meta(token_addr)
+        symbol = meta["symbol"]
+        bal_human = active_token_balance(ctx.user_id, token_addr) / (10 ** meta["decimals"])
+        balance_info = f"\nYour balance: {format_number(bal_human)} {symbol}"
+    except Exception:
+        pass
+    buttons = [
+        [
+            {"text": "25% tokens", "callback_data": "sell_pct_25"},
+            {"text": "50%", "callback_data": "sell_pct_50"},
+            {"text": "100%", "callback_data": "sell_pct_100"},
+        ],
+    ]
+    send_message(
+        ctx.chat_id,
+        "Enter TOKEN amount to SELL (in normal units) or use presets." + balance_info,
+        buttons,
+    )
+
+
+# refresh & risk check
+@callback_router.route("buy_refresh", "sell_refresh", "buy_risk", "sell_risk", limit=LIGHT_ROUTE_LIMIT)
+def cb_token_view(ctx):
+    state = user_states.get(ctx.user_id)
+    if not state or "data" not in state or "token" not in state["data"]:
+        edit_message(ctx.chat_id, ctx.msg_id, "No token in context.", get_main_menu(ctx.has_wallet))
+        return
+    token_addr = state["data"]["token"]
+    try:
+        info = get_token_info(token_addr)
+    except Exception as e:
+        edit_message(ctx.chat_id, ctx.msg_id, f"Error reading token info: {e}", get_main_menu(ctx.has_wallet))
+        return
+
+    state["data"]["info"] = info
+    user_states[ctx.user_id] = state
+    base = (
+        "📊 TOKEN OVERVIEW (BUY)\n\n"
+        if ctx.data.startswith("buy_")
+        else "📊 TOKEN OVERVIEW (SELL)\n\n"
+    )
+    text = (
+        f"{base}"
+        f"Symbol: {info['symbol']}\n"
+        f"Address:\n`{info['address']}`\n\n"
+        f"Price: {format_number(info['price_usd'])} USD\n"
+        f"Market Cap: {format_number(info['market_cap_usd'])} USD\n"
+        f"Total Supply: {format_number(info['total_supply'])} {info['symbol']}\n"
+        f"Holders: {info['holders']}{route_line(info)}{trend_line(token_addr)}\n"
+    )
+
+    if ctx.data.endswith("risk"):
+        risk = risk_text(risk_score(token_addr))
+        text += f"\n*Risk check:*\n{risk}\n"
+
+    # if token exposes fee, show it
+    if info.get("fee_percent", 0.0) > 0:
+        text += f"\nToken fee: ~{info['fee_percent']:.2f}% (to: {info.get('fee_receiver')})\n"
+
+    text += "\nPress Proceed to continue."
+
+    buttons = [
+        [
+            {"text": "🔄 Refresh", "callback_data": ctx.data.split("_")[0] + "_refresh"},
+            {"text": "🧪 Risk", "callback_data": ctx.data.split("_")[0] + "_risk"},
+        ],
+        [
+            {"text": "✅ Proceed", "callback_data": ctx.data.split("_")[0] + "_proceed"},
+            {"text": "❌ Cancel", "callback_data": "cancel_trade"},
+        ],
+    ]
+    edit_message(ctx.chat_id, ctx.msg_id, text, buttons)
+
+
+# presets buy %
+@callback_router.route("buy_pct_", prefix=True)
+def cb_buy_pct(ctx):
+    state = user_states.get(ctx.user_id)
+    if not state or state.get("step") != "await_buy_amount":
+        send_message(ctx.chat_id, "No token context for preset. Start /start again.")
+        return
+    token_addr = state["data"]["token"]
+    bal_wei = sum(fetch_balances([acct.address for acct, _ in active_wallets(ctx.user_id)])[0].values())
+    bal_bnb = float(w3.from_wei(bal_wei, "ether"))
+    pct = {"buy_pct_25": 0.25, "buy_pct_50": 0.5, "buy_pct_100": 1.0}[ctx.data]
+    amount = bal_bnb * pct
+    if amount <= 0:
+        send_message(ctx.chat_id, "BNB balance too low for this preset.")
+        return
+    # directly show confirmation
+    prepare_buy_confirmation(ctx.user_id, ctx.chat_id, token_addr, amount)
+    user_states.pop(ctx.user_id, None)
+
+
+# presets sell %
+@callback_router.route("sell_pct_", prefix=True)
+def cb_sell_pct(ctx):
+    state = user_states.get(ctx.user_id)
+    if not state or state.get("step") != "await_sell_amount":
+        send_message(ctx.chat_id, "No token context for preset. Start /start again.")
+        return
+    token_addr = state["data"]["token"]
+    meta = get_token_meta(token_addr)
+    symbol = meta["symbol"]
+    bal_human = active_token_balance(ctx.user_id, token_addr) / (10 ** meta["decimals"])
+    pct = {"sell_pct_25": 0.25, "sell_pct_50": 0.5, "sell_pct_100": 1.0}[ctx.data]
+    amount = bal_human * pct
+    if amount <= 0:
+        send_message(ctx.chat_id, f"{symbol} balance too low for this preset.")
+        return
+    prepare_sell_confirmation(ctx.user_id, ctx.chat_id, token_addr, amount)
+    user_states.pop(ctx.user_id, None)
 
-        text += "\nPress Proceed to continue."
 
+@callback_router.route("confirm_buy")
+def cb_confirm_buy(ctx):
+    trade = pending_trades.get(ctx.user_id)
+    if not trade or trade.get("type") != "buy":
+        edit_message(ctx.chat_id, ctx.msg_id, "No pending BUY trade (it may have expired).", get_main_menu(ctx.has_wallet))
+        return
+    age = quote_age_blocks(trade)
+    if age is not None and age > MAX_QUOTE_AGE_BLOCKS:
         buttons = [
             [
-                {"text": "🔄 Refresh", "callback_data": data.split("_")[0] + "_refresh"},
-                {"text": "🧪 Risk", "callback_data": data.split("_")[0] + "_risk"},
-            ],
-            [
-                {"text": "✅ Proceed", "callback_data": data.split("_")[0] + "_proceed"},
+                {"text": "🔄 Re-quote", "callback_data": "requote"},
                 {"text": "❌ Cancel", "callback_data": "cancel_trade"},
-            ],
+            ]
         ]
-        edit_message(chat_id, msg_id, text, buttons)
+        edit_message(
+            ctx.chat_id,
+            ctx.msg_id,
+            f"⌛ Quote is {age} blocks old (max {MAX_QUOTE_AGE_BLOCKS}). Re-quote before confirming.",
+            buttons,
+        )
         return
-
-    # presets buy %
-    if data in ("buy_pct_25", "buy_pct_50", "buy_pct_100"):
-        state = user_states.get(user_id)
-        if not state or state.get("step") != "await_buy_amount":
-            send_message(chat_id, "No token context for preset. Start /start again.")
-            return
-        token_addr = state["data"]["token"]
-        acct, _ = get_user_account(user_id)
-        bal_wei = w3.eth.get_balance(acct.address)
-        bal_bnb = float(w3.from_wei(bal_wei, "ether"))
-        pct = {"buy_pct_25": 0.25, "buy_pct_50": 0.5, "buy_pct_100": 1.0}[data]
-        amount = bal_bnb * pct
-        if amount <= 0:
-            send_message(chat_id, "BNB balance too low for this preset.")
-            return
-        # directly show confirmation
-        prepare_buy_confirmation(user_id, chat_id, token_addr, amount)
-        user_states.pop(user_id, None)
+    token = trade["token"]
+    amount_bnb = trade["amount"]
+    if not trades_on_primary(ctx.user_id):
+        confirm_multi_wallet(ctx, trade)
         return
+    try:
+        fast = execute_prewarmed_buy(ctx.user_id, token, w3.to_wei(amount_bnb, "ether"))
+        if fast:
+            record_confirm_latency(ctx.received)
+            txs, expected_out = fast
+            legs = trade.get("legs") or [{"amount_in": w3.to_wei(amount_bnb, "ether")}]
+            amounts_in = [leg["amount_in"] for leg in legs[: len(txs)]]
+        elif len(trade.get("legs", [])) > 1:
+            txs, expected_out = swap_bnb_for_token_split(ctx.user_id, token, trade["legs"])
+            amounts_in = [leg["amount_in"] for leg in trade["legs"][: len(txs)]]
+        else:
+            tx, expected_out = swap_bnb_for_token(ctx.user_id, amount_bnb, token)
+            txs = [tx]
+            amounts_in = [w3.to_wei(amount_bnb, "ether")]
+        info = get_token_info(token)
+        decimals = info["decimals"]
+        tokens_bought = expected_out / (10**decimals)
+        price = info["price_usd"] or 0
+        update_position_buy(ctx.user_id, token, info["symbol"], tokens_bought, price)
+        acct, _ = get_user_account(ctx.user_id)
+        track_fill(
+            {
+                "type": "buy",
+                "user_id": ctx.user_id,
+                "chat_id": ctx.chat_id,
+                "wallet": acct.address,
+                "token": token,
+                "symbol": info["symbol"],
+                "decimals": decimals,
+                "txs": txs,
+                "amounts_in": amounts_in,
+                "expected_tokens": tokens_bought,
+                "price_usd": price,
+                "bnb_price_usd": bnb_price_from_info(info),
+            }
+        )
+        announce_copy_trade(ctx.uid, "buy", token, leader_amount_in=sum(amounts_in))
+        if get_user_settings(ctx.user_id).get("auto_approve"):
+            stage_post_buy_approval(ctx.user_id, token)
+        tx_lines = "\n\n".join(f"Tx: `{tx}`\nhttps://bscscan.com/tx/{tx}" for tx in txs)
+        sent_bnb = sum(amounts_in) / 1e18
+        partial = (
+            f"\n\n⚠️ Partial fill: only {len(txs)} of {len(trade['legs'])} route legs went out "
+            f"({format_number(sent_bnb)} of {format_number(amount_bnb)} BNB). The rest stays in your wallet."
+            if len(txs) < len(trade.get("legs") or [None])
+            else ""
+        )
+        edit_message(
+            ctx.chat_id,
+            ctx.msg_id,
+            f"✅ BUY submitted!\n\n{tx_lines}{partial}",
+            tx_buttons(txs) + get_main_menu(ctx.has_wallet),
+        )
+    except Exception as e:
+        edit_message(ctx.chat_id, ctx.msg_id, f"❌ BUY failed: `{e}`", get_main_menu(ctx.has_wallet))
+    finally:
+        pending_trades.pop(ctx.user_id, None)
 
-    # presets sell %
-    if data in ("sell_pct_25", "sell_pct_50", "sell_pct_100"):
-        state = user_states.get(user_id)
-        if not state or state.get("step") != "await_sell_amount":
-            send_message(chat_id, "No token context for preset. Start /start again.")
-            return
-        token_addr = state["data"]["token"]
-        acct, _ = get_user_account(user_id)
-        token = get_token_contract(token_addr)
-        decimals = token.functions.decimals().call()
-        symbol = token.functions.symbol().call()
-        bal_raw = token.functions.balanceOf(acct.address).call()
-        bal_human = bal_raw / (10**decimals)
-        pct = {"sell_pct_25": 0.25, "sell_pct_50": 0.5, "sell_pct_100": 1.0}[data]
-        amount = bal_human * pct
-        if amount <= 0:
-            send_message(chat_id, f"{symbol} balance too low for this preset.")
-            return
-        prepare_sell_confirmation(user_id, chat_id, token_addr, amount)
-        user_states.pop(user_id, None)
+
+@callback_router.route("confirm_sell")
+def cb_confirm_sell(ctx):
+    trade = pending_trades.get(ctx.user_id)
+    if not trade or trade.get("type") != "sell":
+        edit_message(ctx.chat_id, ctx.msg_id, "No pending SELL trade (it may have expired).", get_main_menu(ctx.has_wallet))
         return
+    age = quote_age_blocks(trade)
+    if age is not None and age > MAX_QUOTE_AGE_BLOCKS:
+        buttons = [
+            [
+                {"text": "🔄 Re-quote", "callback_data": "requote"},
+                {"text": "❌ Cancel", "callback_data": "cancel_trade"},
+            ]
+        ]
+        edit_message(
+            ctx.chat_id,
+            ctx.msg_id,
+            f"⌛ Quote is {age} blocks old (max {MAX_QUOTE_AGE_BLOCKS}). Re-quote before confirming.",
+            buttons,
+        )
+        return
+    token = trade["token"]
+    amount_tokens = trade["amount"]
+    if not trades_on_primary(ctx.user_id):
+        confirm_multi_wallet(ctx, trade)
+        return
+    try:
+        info = get_token_info(token)
+        tx, expected_out = swap_token_for_bnb(ctx.user_id, token, amount_tokens)
+        held = get_user_positions(ctx.user_id).get(token, {"amount": 0.0, "avg_price_usd": 0.0})
+        update_position_sell(ctx.user_id, token, amount_tokens)
+        acct, _ = get_user_account(ctx.user_id)
+        track_fill(
+            {
+                "type": "sell",
+                "user_id": ctx.user_id,
+                "chat_id": ctx.chat_id,
+                "wallet": acct.address,
+                "token": token,
+                "symbol": info["symbol"],
+                "decimals": info["decimals"],
+                "txs": [tx],
+                "amount_tokens": amount_tokens,
+                "removed_tokens": min(amount_tokens, held["amount"]),
+                "avg_price_usd": held["avg_price_usd"],
+                "expected_bnb": expected_out / 1e18,
+                "bnb_price_usd": bnb_price_from_info(info),
+            }
+        )
+        if held["amount"] > 0:
+            amount_raw = int(amount_tokens * 10 ** info["decimals"])
+            announce_copy_trade(ctx.uid, "sell", token, amount_tokens / held["amount"], amount_raw)
+        bnb_received = float(w3.from_wei(expected_out, "ether"))
+        bscscan = f"https://bscscan.com/tx/{tx}"
+        edit_message(
+            ctx.chat_id,
+            ctx.msg_id,
+            f"✅ SELL submitted!\n\nEst. BNB: {bnb_received}\n\nTx: `{tx}`\n{bscscan}",
+            tx_buttons([tx]) + get_main_menu(ctx.has_wallet),
+        )
+    except Exception as e:
+        edit_message(ctx.chat_id, ctx.msg_id, f"❌ SELL failed: `{e}`", get_main_menu(ctx.has_wallet))
+    finally:
+        pending_trades.pop(ctx.user_id, None)
 
-    if data == "confirm_buy":
-        trade = pending_trades.get(user_id)
-        if not trade or trade.get("type") != "buy":
-            edit_message(chat_id, msg_id, "No pending BUY trade.", get_main_menu(has_wallet))
-            return
-        token = trade["token"]
-        amount_bnb = trade["amount"]
-        try:
-            info = get_token_info(token)
-            tx, expected_out = swap_bnb_for_token(user_id, amount_bnb, token)
-            decimals = info["decimals"]
-            tokens_bought = expected_out / (10**decimals)
-            price = info["price_usd"] or 0
-            update_position_buy(user_id, token, info["symbol"], tokens_bought, price)
-            bscscan = f"https://bscscan.com/tx/{tx}"
-            edit_message(
-                chat_id,
-                msg_id,
-                f"✅ BUY submitted!\n\nTx: `{tx}`\n{bscscan}",
-                get_main_menu(has_wallet),
-            )
-        except Exception as e:
-            edit_message(chat_id, msg_id, f"❌ BUY failed: `{e}`", get_main_menu(has_wallet))
-        finally:
-            pending_trades.pop(user_id, None)
+
+def confirm_multi_wallet(ctx, trade):
+    """Confirm step for a trade on any active set other than the primary wallet alone."""
+    token = trade["token"]
+    try:
+        if trade["type"] == "buy":
+            amount_raw = w3.to_wei(trade["amount"], "ether")
+        else:
+            amount_raw = int(trade["amount"] * 10 ** token_decimals(token))
+        held = get_user_positions(ctx.user_id).get(token, {"amount": 0.0})["amount"]
+        orders, skipped = multi_wallet_trade(ctx.user_id, trade["type"], token, amount_raw)
+        sent = [o for o in orders if o["tx"]]
+        sent_in = sum(o["amount_in"] for o in sent)
+        if trade["type"] == "buy":
+            announce_copy_trade(ctx.uid, "buy", token, leader_amount_in=sent_in)
+        elif held > 0:
+            announce_copy_trade(ctx.uid, "sell", token, trade["amount"] / held, sent_in)
+        unit = "BNB" if trade["type"] == "buy" else orders[0]["symbol"]
+        scale = 1e18 if trade["type"] == "buy" else 10 ** orders[0]["decimals"]
+        lines = [f"✅ {trade['type'].upper()} submitted from {len(sent)}/{len(orders) + len(skipped)} wallets\n"]
+        for o in orders:
+            status = f"`{o['tx']}`" if o["tx"] else "❌ not accepted"
+            lines.append(f"`{o['wallet'][:8]}…` {format_number(o['amount_in'] / scale)} {unit}: {status}")
+        for w in skipped:
+            lines.append(f"`{w[:8]}…` skipped (balance too low for its share)")
+        edit_message(
+            ctx.chat_id,
+            ctx.msg_id,
+            "\n".join(lines),
+            tx_buttons([o["tx"] for o in sent]) + get_main_menu(ctx.has_wallet),
+        )
+    except Exception as e:
+        edit_message(ctx.chat_id, ctx.msg_id, f"❌ {trade['type'].upper()} failed: `{e}`", get_main_menu(ctx.has_wallet))
+    finally:
+        pending_trades.pop(ctx.user_id, None)
+
+
+# pending tx speed-up / cancel
+@callback_router.route("txup_", prefix=True)
+def cb_tx_speed_up(ctx):
+    tx_id = ctx.data[len("txup_") :]
+    if tracked_tx_owner(tx_id) not in (ctx.user_id, ctx.uid):
+        send_message(ctx.chat_id, "That transaction is no longer pending.")
         return
+    try:
+        tx_hash, price = speed_up_tx(tx_id)
+    except Exception as e:
+        send_message(ctx.chat_id, f"❌ Speed-up failed: `{e}`")
+        return
+    send_message(ctx.chat_id, f"⚡ Re-sent at {price / 1e9:.2f} gwei.\nTx: `{tx_hash}`", tx_buttons([tx_hash]))
+
 
-    if data == "confirm_sell":
-        trade = pending_trades.get(user_id)
-        if not trade or trade.get("type") != "sell":
-            edit_message(chat_id, msg_id, "No pending SELL trade.", get_main_menu(has_wallet))
-            return
-        token = trade["token"]
-        amount_tokens = trade["amount"]
-        try:
-            info = get_token_info(token)
-            tx, expected_out = swap_token_for_bnb(user_id, token, amount_tokens)
-            update_position_sell(user_id, token, amount_tokens)
-            bnb_received = float(w3.from_wei(expected_out, "ether"))
-            bscscan = f"https://bscscan.com/tx/{tx}"
-            edit_message(
-                chat_id,
-                msg_id,
-                f"✅ SELL submitted!\n\nEst. BNB: {bnb_received}\n\nTx: `{tx}`\n{bscscan}",
-                get_main_menu(has_wallet),
-            )
-        except Exception as e:
-            edit_message(chat_id, msg_id, f"❌ SELL failed: `{e}`", get_main_menu(has_wallet))
-        finally:
-            pending_trades.pop(user_id, None)
+@callback_router.route("txcancel_", prefix=True)
+def cb_tx_cancel(ctx):
+    tx_id = ctx.data[len("txcancel_") :]
+    if tracked_tx_owner(tx_id) not in (ctx.user_id, ctx.uid):
+        send_message(ctx.chat_id, "That transaction is no longer pending.")
+        return
+    try:
+        tx_hash = cancel_tx(tx_id)
+    except Exception as e:
+        send_message(ctx.chat_id, f"❌ Cancel failed: `{e}`")
         return
+    send_message(ctx.chat_id, f"✖ Cancel sent (0 BNB to yourself, same nonce).\nTx: `{tx_hash}`", tx_buttons([tx_hash]))
 
-    if data == "cancel_trade":
-        pending_trades.pop(user_id, None)
-        user_states.pop(user_id, None)
-        edit_message(chat_id, msg_id, "Trade cancelled.", get_main_menu(has_wallet))
+
+@callback_router.route("requote")
+def cb_requote(ctx):
+    trade = pending_trades.get(ctx.user_id)
+    if not trade:
+        edit_message(ctx.chat_id, ctx.msg_id, "No pending trade to re-quote.", get_main_menu(ctx.has_wallet))
         return
+    if trade["type"] == "buy":
+        prepare_buy_confirmation(ctx.user_id, ctx.chat_id, trade["token"], trade["amount"])
+    else:
+        prepare_sell_confirmation(ctx.user_id, ctx.chat_id, trade["token"], trade["amount"])
+
+
+@callback_router.route("cancel_trade")
+def cb_cancel_trade(ctx):
+    pending_trades.pop(ctx.user_id, None)
+    user_states.pop(ctx.user_id, None)
+    edit_message(ctx.chat_id, ctx.msg_id, "Trade cancelled.", get_main_menu(ctx.has_wallet))
+
+
+def handle_callback(cb):
+    ctx = UpdateContext(
+        cb["message"]["chat"]["id"],
+        cb["from"]["id"],
+        msg_id=cb["message"]["message_id"],
+        data=cb["data"],
+        cb=cb,
+    )
+    if not callback_router.dispatch(ctx.data, ctx):
+        print("Unrouted callback:", ctx.data)
 
 
 # ---------- helper to build confirmations ----------
 def prepare_buy_confirmation(user_id, chat_id, token_addr, amount_bnb):
     try:
         out_raw = get_amount_out(amount_bnb, token_addr)
-        token = get_token_contract(token_addr)
-        decimals = token.functions.decimals().call()
-        symbol = token.functions.symbol().call()
+        meta = get_token_meta(token_addr)
+        decimals, symbol = meta["decimals"], meta["symbol"]
         out_human = out_raw / (10**decimals)
         try:
             info = get_token_info(token_addr)
@@ -1065,7 +5989,32 @@ def prepare_buy_confirmation(user_id, chat_id, token_addr, amount_bnb):
         send_message(chat_id, f"Error quoting price: `{e}`")
         return
 
-    pending_trades[user_id] = {"type": "buy", "token": token_addr, "amount": amount_bnb}
+    trade = {"type": "buy", "token": token_addr, "amount": amount_bnb, "quote_block": w3.eth.block_number}
+
+    # compare the best single route against a split over the direct and stable-hop routes
+    route_lines = ""
+    try:
+        plan = plan_buy_split(token_addr, w3.to_wei(amount_bnb, "ether"))
+        single_out = plan["single_out"] / (10**decimals)
+        route_lines = (
+            f"\nSingle route ({format_path(plan['single_path'], symbol)}): "
+            f"*{format_number(single_out)}* {symbol}, impact {plan['single_impact'] * 100:.2f}%"
+        )
+        if len(plan["legs"]) > 1:
+            split_desc = " / ".join(
+                f"{leg['amount_in'] * 100 // w3.to_wei(amount_bnb, 'ether')}% {format_path(leg['path'], symbol)}"
+                for leg in plan["legs"]
+            )
+            gain = (plan["expected_out"] / plan["single_out"] - 1) * 100 if plan["single_out"] else 0
+            route_lines += (
+                f"\nSplit ({split_desc}): *{format_number(plan['expected_out'] / (10**decimals))}* {symbol}, "
+                f"impact {plan['impact'] * 100:.2f}% ({gain:+.2f}%)\n_Will execute as the split above._"
+            )
+            trade["legs"] = plan["legs"]
+    except Exception as e:
+        print("Split plan error:", e)
+    pending_trades[user_id] = trade
+    stage_buy_template(user_id, token_addr, w3.to_wei(amount_bnb, "ether"), trade.get("legs"))
 
     fee_line = ""
     if info.get("fee_percent", 0.0) > 0:
@@ -1081,26 +6030,30 @@ def prepare_buy_confirmation(user_id, chat_id, token_addr, amount_bnb):
         chat_id,
         f"🟢 *BUY CONFIRMATION*\n\nToken: *{symbol}*\nCA: `{token_addr}`\n"
         f"Amount: *{amount_bnb}* BNB\nEst. received (router quote): *{out_human}* {symbol}"
-        f"{fee_line}\n\nConfirm?",
+        f"{route_lines}{fee_line}{wallets_line(user_id, 'buy')}\n\nConfirm?",
         buttons,
     )
 
 
 def prepare_sell_confirmation(user_id, chat_id, token_addr, amount_tokens):
     try:
-        token = get_token_contract(token_addr)
-        decimals = token.functions.decimals().call()
-        symbol = token.functions.symbol().call()
+        meta = get_token_meta(token_addr)
+        decimals, symbol = meta["decimals"], meta["symbol"]
         amount_in_wei = int(amount_tokens * (10**decimals))
         path = list(reversed(get_path_for_buy(token_addr)))
-        out_raw = router.functions.getAmountsOut(amount_in_wei, path).call()[-1]
+        out_raw = get_amounts_out(amount_in_wei, path)[-1]
         # note: tokens with transfer tax may cause actual received to differ
         out_bnb = float(w3.from_wei(out_raw, "ether"))
     except Exception as e:
         send_message(chat_id, f"Error quoting sell: `{e}`")
         return
 
-    pending_trades[user_id] = {"type": "sell", "token": token_addr, "amount": amount_tokens}
+    pending_trades[user_id] = {
+        "type": "sell",
+        "token": token_addr,
+        "amount": amount_tokens,
+        "quote_block": w3.eth.block_number,
+    }
 
     fee_line = ""
     try:
@@ -1120,203 +6073,868 @@ def prepare_sell_confirmation(user_id, chat_id, token_addr, amount_tokens):
         chat_id,
         f"🔴 *SELL CONFIRMATION*\n\nToken: *{symbol}*\nCA: `{token_addr}`\n"
         f"Amount: *{amount_tokens}* {symbol}\nEst. received (router quote): *{out_bnb}* BNB"
-        f"{fee_line}\n\nConfirm?",
+        f"{fee_line}{wallets_line(user_id, 'sell')}\n\nConfirm?",
         buttons,
     )
 
 
-# ---------- Message handler ----------
-def handle_message(msg):
-    chat_id = msg["chat"]["id"]
-    user_id = msg["from"]["id"]
-    text = msg.get("text", "").strip()
-    uid = str(user_id)
-    has_wallet = uid in users
+# ---------- Message handlers ----------
+# awaiting private key
+def read_private_key(ctx, buttons=None):
+    """The account for the private key in ctx.text, or None after telling the user what is wrong."""
+    if not ctx.text.startswith("0x") or len(ctx.text) < 60:
+        send_message(ctx.chat_id, "❌ Invalid private key format. Try again or /start.", buttons)
+        return None
+    try:
+        return w3.eth.account.from_key(ctx.text)
+    except Exception:
+        send_message(ctx.chat_id, "❌ Could not parse this private key.", buttons)
+        return None
+
+
+@message_router.route("await_pk")
+def msg_pk(ctx):
+    acct = read_private_key(ctx)
+    if not acct:
+        return
+
+    users[ctx.uid] = {
+        "private_key": ctx.text,
+        "address": acct.address,
+        "settings": {"slippage": 0.03, "gas_mode": "standard"},
+        "positions": {},
+    }
+    save_users(users)
+    user_states.pop(ctx.user_id, None)
+    send_message(
+        ctx.chat_id,
+        f"✅ Wallet connected!\nAddress:\n`{acct.address}`",
+        get_main_menu(True),
+    )
 
-    state = user_states.get(user_id)
 
-    # awaiting private key
-    if state and state.get("step") == "await_pk":
-        if not text.startswith("0x") or len(text) < 60:
-            send_message(chat_id, "❌ Invalid private key format. Try again or /start.")
+# awaiting an additional wallet's private key
+@message_router.route("await_extra_pk")
+def msg_extra_pk(ctx):
+    acct = read_private_key(ctx, get_main_menu(ctx.has_wallet))
+    if not acct:
+        return
+    user_states.pop(ctx.user_id, None)
+    with users_lock:
+        profile = ensure_profile(ctx.user_id)
+        if not profile:
+            send_message(ctx.chat_id, "Connect a wallet first.", get_main_menu(False))
             return
+        if any(a.address == acct.address for a, _ in user_wallets(ctx.user_id)):
+            send_message(ctx.chat_id, "That wallet is already added.", get_main_menu(True))
+            return
+        if len(profile.get("wallets", [])) + 1 >= MAX_WALLETS_PER_USER:
+            send_message(ctx.chat_id, f"❌ At most {MAX_WALLETS_PER_USER} wallets.", get_main_menu(True))
+            return
+        profile.setdefault("wallets", []).append({"address": acct.address, "private_key": ctx.text})
+        index = len(profile["wallets"])
+        save_users(users)
+    set_wallet_active(ctx.user_id, index, active=True)
+    text, buttons = wallets_screen(ctx.user_id)
+    send_message(ctx.chat_id, f"✅ Wallet #{index + 1} added and active.\n\n{text}", buttons)
+
+
+# awaiting BUY token CA -> show token info
+@message_router.route("await_buy_token")
+def msg_buy_token(ctx):
+    try:
+        token_addr = Web3.to_checksum_address(ctx.text)
+    except Exception:
+        send_message(ctx.chat_id, "❌ Invalid contract address. Send again.")
+        return
+
+    prewarm_token(ctx.user_id, token_addr)
+    note_risk_interest(token_addr)
+    try:
+        info = get_token_info(token_addr)
+    except Exception as e:
+        send_message(ctx.chat_id, f"Error reading token info: `{e}`")
+        user_states.pop(ctx.user_id, None)
+        return
+
+    user_states[ctx.user_id] = {
+        "step": "await_buy_proceed",
+        "data": {"token": info["address"], "info": info},
+    }
+
+    fee_line = ""
+    if info.get("fee_percent", 0.0) > 0:
+        fee_line = f"\nToken fee: ~{info['fee_percent']:.2f}% (to: {info.get('fee_receiver')})"
+
+    info_text = (
+        "📊 *TOKEN OVERVIEW (BUY)*\n\n"
+        f"Symbol: *{info['symbol']}*\n"
+        f"Address:\n`{info['address']}`\n\n"
+        f"Price: *{format_number(info['price_usd'])}* USD\n"
+        f"Market Cap: *{format_number(info['market_cap_usd'])}* USD\n"
+        f"Total Supply: *{format_number(info['total_supply'])}* {info['symbol']}\n"
+        f"Holders: *{info['holders']}*"
+        f"{route_line(info)}{trend_line(token_addr)}{fee_line}\n\n"
+        "Press buttons to refresh, check risk, or proceed."
+    )
+
+    buttons = [
+        [
+            {"text": "🔄 Refresh", "callback_data": "buy_refresh"},
+            {"text": "🧪 Risk", "callback_data": "buy_risk"},
+        ],
+        [
+            {"text": "✅ Proceed", "callback_data": "buy_proceed"},
+            {"text": "❌ Cancel", "callback_data": "cancel_trade"},
+        ],
+    ]
+    send_message(ctx.chat_id, info_text, buttons)
+
+
+# awaiting BUY amount (custom)
+@message_router.route("await_buy_amount")
+def msg_buy_amount(ctx):
+    try:
+        amount = float(ctx.text)
+        if amount <= 0:
+            raise ValueError()
+    except Exception:
+        send_message(ctx.chat_id, "❌ Invalid amount. Send a positive number.")
+        return
+
+    token_addr = ctx.state["data"]["token"]
+    prepare_buy_confirmation(ctx.user_id, ctx.chat_id, token_addr, amount)
+    user_states.pop(ctx.user_id, None)
+
+
+# awaiting SELL token CA -> show info
+@message_router.route("await_sell_token")
+def msg_sell_token(ctx):
+    try:
+        token_addr = Web3.to_checksum_address(ctx.text)
+    except Exception:
+        send_message(ctx.chat_id, "❌ Invalid contract address. Send again.")
+        return
+
+    note_risk_interest(token_addr)
+    try:
+        info = get_token_info(token_addr)
+    except Exception as e:
+        send_message(ctx.chat_id, f"Error reading token info: `{e}`")
+        user_states.pop(ctx.user_id, None)
+        return
+
+    balance_line = ""
+    if ctx.has_wallet:
         try:
-            acct = w3.eth.account.from_key(text)
+            bal_human = active_token_balance(ctx.user_id, token_addr) / (10 ** info["decimals"])
+            balance_line = f"\nYour balance: *{format_number(bal_human)}* {info['symbol']}"
         except Exception:
-            send_message(chat_id, "❌ Could not parse this private key.")
-            return
+            pass
 
-        users[uid] = {
-            "private_key": text,
-            "address": acct.address,
-            "settings": {"slippage": 0.03, "gas_mode": "standard"},
-            "positions": {},
-        }
-        save_users(users)
-        user_states.pop(user_id, None)
+    user_states[ctx.user_id] = {
+        "step": "await_sell_proceed",
+        "data": {"token": info["address"], "info": info},
+    }
+
+    fee_line = ""
+    if info.get("fee_percent", 0.0) > 0:
+        fee_line = f"\nToken fee: ~{info['fee_percent']:.2f}% (to: {info.get('fee_receiver')})"
+
+    info_text = (
+        "📊 *TOKEN OVERVIEW (SELL)*\n\n"
+        f"Symbol: *{info['symbol']}*\n"
+        f"Address:\n`{info['address']}`\n\n"
+        f"Price: *{format_number(info['price_usd'])}* USD\n"
+        f"Market Cap: *{format_number(info['market_cap_usd'])}* USD\n"
+        f"Total Supply: *{format_number(info['total_supply'])}* {info['symbol']}\n"
+        f"Holders: *{info['holders']}*"
+        f"{route_line(info)}{trend_line(token_addr)}{balance_line}{fee_line}\n\n"
+        "Press buttons to refresh, check risk, or proceed."
+    )
+
+    buttons = [
+        [
+            {"text": "🔄 Refresh", "callback_data": "sell_refresh"},
+            {"text": "🧪 Risk", "callback_data": "sell_risk"},
+        ],
+        [
+            {"text": "✅ Proceed", "callback_data": "sell_proceed"},
+            {"text": "❌ Cancel", "callback_data": "cancel_trade"},
+        ],
+    ]
+    send_message(ctx.chat_id, info_text, buttons)
+
+
+# awaiting SELL amount (custom)
+@message_router.route("await_sell_amount")
+def msg_sell_amount(ctx):
+    try:
+        amount = float(ctx.text)
+        if amount <= 0:
+            raise ValueError()
+    except Exception:
+        send_message(ctx.chat_id, "❌ Invalid amount. Send a positive number.")
+        return
+
+    token_addr = ctx.state["data"]["token"]
+    prepare_sell_confirmation(ctx.user_id, ctx.chat_id, token_addr, amount)
+    user_states.pop(ctx.user_id, None)
+
+
+# no active state: a command, else the menu hint
+@message_router.route("", prefix=True)
+def msg_default(ctx):
+    if ctx.text.startswith("/") and command_router.dispatch(ctx.text.split()[0].lower(), ctx):
+        return
+    send_message(ctx.chat_id, "Use the menu buttons below.", get_main_menu(ctx.has_wallet))
+
+
+def handle_message(msg):
+    ctx = UpdateContext(
+        msg["chat"]["id"],
+        msg["from"]["id"],
+        msg_id=msg.get("message_id"),
+        text=msg.get("text", "").strip(),
+    )
+    ctx.state = user_states.get(ctx.user_id)
+    message_router.dispatch(ctx.state.get("step", "") if ctx.state else "", ctx)
+
+
+# ---------- Commands ----------
+# Slash commands are routes of their own router, keyed by the command word.
+# Middleware keeps admin commands to ADMIN_IDS (everyone else gets the menu hint,
+# as for unknown text) and asks for a wallet before the commands that need one.
+@command_router.route("/start")
+def cmd_start(ctx):
+    send_message(
+        ctx.chat_id,
+        "Welcome to the *BSC Multi-User Trading Bot*.\nUse the menu below.",
+        get_main_menu(ctx.has_wallet),
+    )
+
+
+# copy trading
+@command_router.route("/copy")
+def cmd_copy(ctx):
+    parts = ctx.text.split()
+    if len(parts) != 3:
         send_message(
-            chat_id,
-            f"✅ Wallet connected!\nAddress:\n`{acct.address}`",
-            get_main_menu(True),
+            ctx.chat_id,
+            "Usage: `/copy <leader id|signal> <BNB per trade | % of balance>`\ne.g. `/copy 12345 0.05` or `/copy signal 10%`",
         )
         return
+    leader, size = parts[1], parts[2]
+    try:
+        if size.endswith("%"):
+            cfg = {"leader": leader, "mode": "pct", "value": float(size[:-1])}
+        else:
+            cfg = {"leader": leader, "mode": "fixed", "value": float(size)}
+        if cfg["value"] <= 0:
+            raise ValueError()
+    except ValueError:
+        send_message(ctx.chat_id, "❌ Invalid size. Use a BNB amount or a percentage.")
+        return
+    if leader != SIGNAL_SOURCE and leader not in users:
+        send_message(ctx.chat_id, "❌ Unknown leader id.")
+        return
+    ensure_profile(ctx.user_id)["copy"] = cfg
+    save_users(users)
+    send_message(ctx.chat_id, f"🔁 Copy trading on: following `{leader}` with {size} per trade.", get_main_menu(True))
 
-    # awaiting BUY token CA -> show token info
-    if state and state.get("step") == "await_buy_token":
-        try:
-            token_addr = Web3.to_checksum_address(text)
-        except Exception:
-            send_message(chat_id, "❌ Invalid contract address. Send again.")
-            return
 
-        try:
-            info = get_token_info(token_addr)
-        except Exception as e:
-            send_message(chat_id, f"Error reading token info: `{e}`")
-            user_states.pop(user_id, None)
-            return
+@command_router.route("/uncopy")
+def cmd_uncopy(ctx):
+    if ctx.uid in users and users[ctx.uid].pop("copy", None):
+        save_users(users)
+    send_message(ctx.chat_id, "Copy trading off.", get_main_menu(ctx.uid in users))
 
-        user_states[user_id] = {
-            "step": "await_buy_proceed",
-            "data": {"token": info["address"], "info": info},
-        }
 
-        fee_line = ""
-        if info.get("fee_percent", 0.0) > 0:
-            fee_line = f"\nToken fee: ~{info['fee_percent']:.2f}% (to: {info.get('fee_receiver')})"
-
-        info_text = (
-            "📊 *TOKEN OVERVIEW (BUY)*\n\n"
-            f"Symbol: *{info['symbol']}*\n"
-            f"Address:\n`{info['address']}`\n\n"
-            f"Price: *{format_number(info['price_usd'])}* USD\n"
-            f"Market Cap: *{format_number(info['market_cap_usd'])}* USD\n"
-            f"Total Supply: *{format_number(info['total_supply'])}* {info['symbol']}\n"
-            f"Holders: *{info['holders']}*"
-            f"{fee_line}\n\n"
-            "Press buttons to refresh, check risk, or proceed."
+# launch sniper
+@command_router.route("/snipes")
+def cmd_snipes(ctx):
+    armed = ensure_profile(ctx.user_id).get("snipes", {})
+    if not armed:
+        send_message(ctx.chat_id, "No armed snipes. Arm one with `/snipe <CA> <BNB>`.")
+        return
+    lines = ["🎯 *Armed snipes*"]
+    for token, cfg in armed.items():
+        price = cfg.get("max_price_bnb")
+        guard = f"min liquidity {format_number(cfg.get('min_liquidity_bnb', SNIPE_MIN_LIQUIDITY_BNB))} BNB"
+        guard += f", max price {format_number(price)} BNB" if price is not None else ""
+        lines.append(f"\n`{token}`\n{format_number(cfg['amount_bnb'])} BNB, {guard}")
+    send_message(ctx.chat_id, "\n".join(lines))
+
+
+@command_router.route("/unsnipe")
+def cmd_unsnipe(ctx):
+    parts = ctx.text.split()
+    try:
+        token = Web3.to_checksum_address(parts[1])
+    except Exception:
+        send_message(ctx.chat_id, "Usage: `/unsnipe <CA>`")
+        return
+    msg = "Snipe disarmed." if disarm_snipe(ctx.user_id, token) else "No snipe armed for that token."
+    send_message(ctx.chat_id, msg)
+
+
+@command_router.route("/snipe")
+def cmd_snipe(ctx):
+    parts = ctx.text.split()
+    # /snipe <CA> <BNB> [liq=<BNB>] [price=<BNB per token>]
+    guards = {"liq": None, "price": None}
+    try:
+        while len(parts) > 3 and parts[-1].split("=")[0].lower() in guards:
+            key, value = parts.pop().split("=", 1)
+            guards[key.lower()] = float(value)
+        token = Web3.to_checksum_address(parts[1])
+        amount_bnb = float(parts[2])
+        if amount_bnb <= 0 or any(v is not None and v < 0 for v in guards.values()):
+            raise ValueError()
+    except Exception:
+        send_message(
+            ctx.chat_id,
+            "Usage: `/snipe <CA> <BNB> [liq=<BNB>] [price=<BNB per token>]`, e.g. `/snipe 0xabc... 0.1 liq=20`\n"
+            f"The buy waits for a pool holding at least `liq` BNB (default {format_number(SNIPE_MIN_LIQUIDITY_BNB)}) "
+            "and a launch price of at most `price`.",
         )
+        return
+    try:
+        meta = arm_snipe(ctx.user_id, token, amount_bnb, guards["liq"], guards["price"])
+    except Exception as e:
+        send_message(ctx.chat_id, f"❌ Could not arm snipe: `{e}`")
+        return
+    cfg = ensure_profile(ctx.user_id)["snipes"][token]
+    price = f" at a price of at most {format_number(guards['price'])} BNB per token" if guards["price"] is not None else ""
+    send_message(
+        ctx.chat_id,
+        f"🎯 Snipe armed: {format_number(amount_bnb)} BNB into *{meta['symbol']}* as soon as a WBNB or stable pair "
+        f"holds at least {format_number(cfg['min_liquidity_bnb'])} BNB of liquidity{price}.\n"
+        "The buy uses your slippage setting. Disarm with `/unsnipe <CA>`.",
+    )
 
-        buttons = [
-            [
-                {"text": "🔄 Refresh", "callback_data": "buy_refresh"},
-                {"text": "🧪 Risk", "callback_data": "buy_risk"},
-            ],
-            [
-                {"text": "✅ Proceed", "callback_data": "buy_proceed"},
-                {"text": "❌ Cancel", "callback_data": "cancel_trade"},
-            ],
-        ]
-        send_message(chat_id, info_text, buttons)
+
+# DCA / TWAP schedules
+@command_router.route("/schedules")
+def cmd_schedules(ctx):
+    schedules = ensure_profile(ctx.user_id).get("schedules", {})
+    if not schedules:
+        send_message(ctx.chat_id, "No schedules. Start one with `/dca` or `/twap`.")
         return
+    lines = ["⏱ *Schedules*"]
+    for sched in schedules.values():
+        amount = sched["amount"] / 10 ** (18 if sched["side"] == "buy" else sched["decimals"])
+        unit = "BNB" if sched["side"] == "buy" else sched["symbol"]
+        total = f"{sched['done']}/{sched['slices']}" if sched["slices"] else f"{sched['done']} done"
+        state = " ⏸" if sched["paused"] else ""
+        lines.append(
+            f"\n`{sched['id']}` {sched['kind'].upper()} {sched['side']} *{sched['symbol']}*{state}\n"
+            f"{format_number(amount)} {unit} {'per slice' if sched['kind'] == 'dca' else 'total'}, "
+            f"every {format_duration(sched['interval'])}, slices {total}, max impact {sched['max_impact']:g}%"
+        )
+    send_message(ctx.chat_id, "\n".join(lines))
+
+
+@command_router.route("/unschedule")
+def cmd_unschedule(ctx):
+    parts = ctx.text.split()
+    ok = len(parts) > 1 and cancel_schedule(ctx.user_id, parts[1])
+    send_message(ctx.chat_id, "Schedule cancelled." if ok else "No schedule with that id. See /schedules.")
+
 
-    # awaiting BUY amount (custom)
-    if state and state.get("step") == "await_buy_amount":
+@command_router.route("/dca", "/twap")
+def cmd_schedule(ctx):
+    parts = ctx.text.split()
+    cmd = parts[0].lower()
+    max_impact = SCHED_MAX_IMPACT_PCT
+    if parts[-1].lower().startswith("impact="):
         try:
-            amount = float(text)
-            if amount <= 0:
+            max_impact = float(parts.pop()[7:].rstrip("%"))
+        except ValueError:
+            pass
+    try:
+        if cmd == "/dca":
+            # /dca <CA> <BNB per buy> <every> [count]
+            side, token = "buy", Web3.to_checksum_address(parts[1])
+            amount = w3.to_wei(float(parts[2]), "ether")
+            interval = parse_duration(parts[3])
+            slices = int(parts[4]) if len(parts) > 4 else 0
+        else:
+            # /twap <buy|sell> <CA> <BNB | tokens | %> <over> <slices>
+            side, token = parts[1].lower(), Web3.to_checksum_address(parts[2])
+            slices = int(parts[5])
+            if side not in ("buy", "sell") or slices < 2:
                 raise ValueError()
-        except Exception:
-            send_message(chat_id, "❌ Invalid amount. Send a positive number.")
-            return
+            interval = parse_duration(parts[4]) / (slices - 1)
+        if interval < SCHED_MIN_INTERVAL_SEC or slices < 0:
+            raise ValueError()
+    except Exception:
+        send_message(
+            ctx.chat_id,
+            "Usage:\n`/dca <CA> <BNB per buy> <every> [count]` e.g. `/dca 0xabc... 0.05 4h 30`\n"
+            "`/twap <buy|sell> <CA> <BNB | tokens | pct%> <over> <slices>` e.g. `/twap sell 0xabc... 50% 2h 12`\n"
+            f"Add `impact=<pct>` to change the {SCHED_MAX_IMPACT_PCT:g}% max price impact per slice. "
+            f"Slices are at least {format_duration(SCHED_MIN_INTERVAL_SEC)} apart.",
+        )
+        return
 
-        token_addr = state["data"]["token"]
-        prepare_buy_confirmation(user_id, chat_id, token_addr, amount)
-        user_states.pop(user_id, None)
+    try:
+        meta = get_token_meta(token)
+        if cmd == "/twap":
+            size = parts[3]
+            if side == "buy":
+                amount = w3.to_wei(float(size), "ether")
+            elif size.endswith("%"):
+                acct, _ = get_user_account(ctx.user_id)
+                held = get_token_balance(acct.address, token)
+                amount = int(held * min(float(size[:-1]), 100) / 100)
+            else:
+                amount = int(float(size) * 10 ** meta["decimals"])
+            if amount <= 0:
+                raise Exception("nothing to trade")
+        sched = create_schedule(
+            ctx.user_id,
+            {
+                "kind": cmd[1:],
+                "side": side,
+                "token": token,
+                "symbol": meta["symbol"],
+                "decimals": meta["decimals"],
+                "amount": amount,
+                "interval": interval,
+                "slices": slices,
+                "max_impact": max_impact,
+            },
+        )
+    except Exception as e:
+        send_message(ctx.chat_id, f"❌ Could not create schedule: `{e}`")
         return
+    send_message(
+        ctx.chat_id,
+        f"⏱ {sched['kind'].upper()} `{sched['id']}` started for *{meta['symbol']}*: first slice now, "
+        f"then every {format_duration(interval)}. Cancel with `/unschedule {sched['id']}`.",
+    )
 
-    # awaiting SELL token CA -> show info
-    if state and state.get("step") == "await_sell_token":
-        try:
-            token_addr = Web3.to_checksum_address(text)
-        except Exception:
-            send_message(chat_id, "❌ Invalid contract address. Send again.")
-            return
 
-        try:
-            info = get_token_info(token_addr)
-        except Exception as e:
-            send_message(chat_id, f"Error reading token info: `{e}`")
-            user_states.pop(user_id, None)
-            return
+# admin
+@command_router.route("/signal")
+def cmd_signal(ctx):
+    parts = ctx.text.split()
+    try:
+        side, token_addr = parts[1].lower(), Web3.to_checksum_address(parts[2])
+        fraction = float(parts[3].rstrip("%")) / 100 if side == "sell" and len(parts) > 3 else None
+        if side not in ("buy", "sell"):
+            raise ValueError()
+    except Exception:
+        send_message(ctx.chat_id, "Usage: `/signal buy <CA>` or `/signal sell <CA> [pct]`")
+        return
+    announce_copy_trade(SIGNAL_SOURCE, side, token_addr, fraction)
+    send_message(ctx.chat_id, f"📣 Signal {side.upper()} sent to followers.")
 
-        acct, _ = get_user_account(user_id) if has_wallet else (None, None)
-        balance_line = ""
-        if acct:
-            try:
-                token = get_token_contract(token_addr)
-                decimals = token.functions.decimals().call()
-                bal_raw = token.functions.balanceOf(acct.address).call()
-                bal_human = bal_raw / (10**decimals)
-                balance_line = f"\nYour balance: *{format_number(bal_human)}* {info['symbol']}"
-            except Exception:
-                pass
-
-        user_states[user_id] = {
-            "step": "await_sell_proceed",
-            "data": {"token": info["address"], "info": info},
-        }
 
-        fee_line = ""
-        if info.get("fee_percent", 0.0) > 0:
-            fee_line = f"\nToken fee: ~{info['fee_percent']:.2f}% (to: {info.get('fee_receiver')})"
-
-        info_text = (
-            "📊 *TOKEN OVERVIEW (SELL)*\n\n"
-            f"Symbol: *{info['symbol']}*\n"
-            f"Address:\n`{info['address']}`\n\n"
-            f"Price: *{format_number(info['price_usd'])}* USD\n"
-            f"Market Cap: *{format_number(info['market_cap_usd'])}* USD\n"
-            f"Total Supply: *{format_number(info['total_supply'])}* {info['symbol']}\n"
-            f"Holders: *{info['holders']}*"
-            f"{balance_line}{fee_line}\n\n"
-            "Press buttons to refresh, check risk, or proceed."
-        )
+@command_router.route("/rpcstats")
+def cmd_rpcstats(ctx):
+    lines = [f"🔌 *Reads*: {rpc_stats_line()}\n", "📡 *Broadcast endpoints* (fastest landing first)"]
+    for url, first, landed, land_ms, accept_ms, errs in endpoint_ranking():
+        host = url.split("//")[-1].split("/")[0]
+        land = f"{land_ms:.0f} ms" if land_ms is not None else "n/a"
+        accept = f"{accept_ms:.0f} ms" if accept_ms is not None else "n/a"
+        lines.append(f"\n{host}\nfirst: {first}, landed: {landed}, to inclusion: {land}, accept: {accept}, errors: {errs}")
+    send_message(ctx.chat_id, "\n".join(lines))
 
-        buttons = [
-            [
-                {"text": "🔄 Refresh", "callback_data": "sell_refresh"},
-                {"text": "🧪 Risk", "callback_data": "sell_risk"},
-            ],
-            [
-                {"text": "✅ Proceed", "callback_data": "sell_proceed"},
-                {"text": "❌ Cancel", "callback_data": "cancel_trade"},
-            ],
-        ]
-        send_message(chat_id, info_text, buttons)
+
+@command_router.route("/copystats")
+def cmd_copystats(ctx):
+    send_message(
+        ctx.chat_id,
+        "🔁 *Copy trading*\n\n"
+        f"Signals: {copy_stats['signals']}\nOrders: {copy_stats['orders']}\n"
+        f"Last fan-out: {copy_stats['last_followers']} wallets in {copy_stats['last_latency_ms']:.0f} ms\n"
+        f"Slowest fan-out: {copy_stats['max_latency_ms']:.0f} ms",
+    )
+
+
+@command_router.route("/trace")
+def cmd_trace(ctx):
+    parts = ctx.text.split()
+    arg = parts[1].lower() if len(parts) > 1 else ""
+    if arg == "off":
+        trace_window["until"] = 0
+        trace_seen["checked"] = 0
+        send_message(ctx.chat_id, "Tracing off.")
+        return
+    if not arg:
+        left = trace_window.get("until", 0) - time.time()
+        status = f"on for {left:.0f}s more, writing `{trace_window.get('file')}`" if left > 0 else "off"
+        send_message(ctx.chat_id, f"Tracing is {status}.\nUsage: `/trace <seconds>` or `/trace off`")
+        return
+    try:
+        seconds = min(max(int(arg), 1), TRACE_MAX_SEC)
+    except ValueError:
+        send_message(ctx.chat_id, "Usage: `/trace <seconds>` or `/trace off`")
+        return
+    until = time.time() + seconds
+    path = f"trace-{int(time.time())}.json"
+    trace_window.update({"until": until, "file": path})
+    trace_seen["checked"] = 0
+    threading.Thread(target=finish_trace, args=(ctx.chat_id, path, until), daemon=True).start()
+    send_message(ctx.chat_id, f"🔎 Tracing every update for {seconds}s into `{path}`.")
+
+
+@command_router.route("/profile")
+def cmd_profile(ctx):
+    parts = ctx.text.split()
+    try:
+        seconds = min(max(int(parts[1]), 1), PROFILE_MAX_SEC) if len(parts) > 1 else 10
+    except ValueError:
+        send_message(ctx.chat_id, f"Usage: `/profile [seconds]` (max {PROFILE_MAX_SEC})")
+        return
+    if not profile_lock.acquire(blocking=False):
+        send_message(ctx.chat_id, "A profile is already running.")
         return
+    threading.Thread(target=run_profile, args=(ctx.chat_id, seconds), daemon=True).start()
+    send_message(ctx.chat_id, f"🔥 Sampling all threads every {PROFILE_INTERVAL_MS:g} ms for {seconds}s…")
+
+
+@command_router.route("/revenue")
+def cmd_revenue(ctx):
+    parts = ctx.text.split()
+    try:
+        days = min(max(int(parts[1]), 1), 90) if len(parts) > 1 else 7
+    except ValueError:
+        days = 7
+    send_message(ctx.chat_id, revenue_report(days))
+
+
+@command_router.route("/lookupstats")
+def cmd_lookupstats(ctx):
+    lines = ["🧮 *Coalesced lookups*"]
+    for name, st in sorted(flight_stats.items()):
+        lines.append(f"\n{name}: {st['calls']} calls, {st['computed']} computed, {st['absorbed']} absorbed")
+    lines.append(
+        f"\nbalances: {balance_stats['snapshots']} snapshots, {balance_stats['hits']} hits, "
+        f"{balance_stats['misses']} misses, {balance_stats['requests']} requests"
+    )
+    lines.append(
+        f"schedules: {sched_stats['ticks']} ticks, {sched_stats['slices']} slices sent, "
+        f"{sched_stats['guarded']} held back, largest batch {sched_stats['max_batch']}"
+    )
+    lines.append(
+        f"discovery: {discovery_stats['scanned_blocks']} blocks in {discovery_stats['queries']} queries, "
+        f"{discovery_stats['found']} tokens found, {discovery_stats['illiquid']} illiquid skipped"
+    )
+    lines.append(
+        f"risk scores: {len(risk_scores)} cached, {risk_stats['hits']} hits, {risk_stats['misses']} misses, "
+        f"{risk_stats['recomputed']} recomputed, {risk_stats['alerts']} alerts"
+    )
+    send_message(ctx.chat_id, "\n".join(lines))
+
+
+@command_router.route("/routestats")
+def cmd_routestats(ctx):
+    lines = ["🧭 *Routes* (slowest p95 first)"]
+    for router in (callback_router, message_router, command_router):
+        lines.append(f"\n_{router.name}_")
+        lines.extend(router.report())
+    send_message(ctx.chat_id, "\n".join(lines))
+
 
-    # awaiting SELL amount (custom)
-    if state and state.get("step") == "await_sell_amount":
+@command_router.route("/latency")
+def cmd_latency(ctx):
+    samples = sorted(confirm_latency)
+    if samples:
+        pct = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+        dist = f"p50 {pct(0.5):.0f} ms, p95 {pct(0.95):.0f} ms, max {samples[-1]:.0f} ms"
+    else:
+        dist = "no samples yet"
+    send_message(
+        ctx.chat_id,
+        "⚡ *Click-to-broadcast* (pre-warmed buys)\n\n"
+        f"{dist}\nOver {CONFIRM_TARGET_MS:.0f} ms: {prewarm_stats['over_target']}\n"
+        f"Pre-warms: {prewarm_stats['started']}, hits: {prewarm_stats['hits']}, misses: {prewarm_stats['misses']}"
+        f"{snipe_latency_line()}",
+    )
+
+
+# ---------- Update dispatch ----------
+# Updates run on a bounded handler pool. Each user's updates stay in order, one
+# at a time: the handlers mutate that user's profile and conversation state
+# without further locking. Different users run side by side, so a slow heavy
+# screen only holds its route's slots while cheap taps keep flowing. Sharded
+# mode is how handling scales past one core.
+HANDLER_THREADS = int(os.getenv("HANDLER_THREADS", "8"))
+handler_pool = ThreadPoolExecutor(max_workers=HANDLER_THREADS)
+handler_lock = threading.Lock()
+handler_queues = {}  # user id (or signal kind) -> deque of updates waiting behind the running one
+
+
+def get_update_user_id(upd):
+    if "callback_query" in upd:
+        return upd["callback_query"]["from"]["id"]
+    if "message" in upd:
+        return upd["message"].get("from", {}).get("id")
+    return None
+
+
+def dispatch_update(upd):
+    kind = next((k for k in ("callback_query", "message", "copy_signal", "snipe_launch") if k in upd), "update")
+    with trace_update(kind, update_id=upd.get("update_id"), user_id=get_update_user_id(upd)):
+        if "callback_query" in upd:
+            handle_callback(upd["callback_query"])
+        elif "message" in upd:
+            handle_message(upd["message"])
+        elif "copy_signal" in upd:
+            sig = upd["copy_signal"]
+            if get_followers(sig["source"]):
+                start_copy_fan_out(
+                    sig["source"], sig["side"], sig["token"], sig["fraction"], sig.get("leader_amount_in")
+                )
+        elif "snipe_launch" in upd:
+            fire_snipes(**upd["snipe_launch"])
+
+
+def _drain_updates(key):
+    while True:
+        with handler_lock:
+            queue = handler_queues[key]
+            if not queue:
+                del handler_queues[key]
+                return
+            upd = queue.popleft()
         try:
-            amount = float(text)
-            if amount <= 0:
-                raise ValueError()
-        except Exception:
-            send_message(chat_id, "❌ Invalid amount. Send a positive number.")
+            dispatch_update(upd)
+        except Exception as e:
+            print("Handler error:", e)
+
+
+def submit_update(upd):
+    """Queues upd behind the same user's earlier updates; returns without waiting for it."""
+    key = get_update_user_id(upd)
+    if key is None:
+        key = next((k for k in ("copy_signal", "snipe_launch") if k in upd), "update")
+    with handler_lock:
+        queue = handler_queues.get(key)
+        if queue is not None:
+            queue.append(upd)
             return
+        handler_queues[key] = deque([upd])
+    handler_pool.submit(_drain_updates, key)
 
-        token_addr = state["data"]["token"]
-        prepare_sell_confirmation(user_id, chat_id, token_addr, amount)
-        user_states.pop(user_id, None)
-        return
 
-    # no active state
-    if text == "/start":
-        send_message(
-            chat_id,
-            "Welcome to the *BSC Multi-User Trading Bot*.\nUse the menu below.",
-            get_main_menu(has_wallet),
-        )
-        return
+# ---------- Sharded mode ----------
+def load_state():
+    """
+    Reads the data files for this process's role. Nothing is loaded at import:
+    spawned shard workers re-import this module before they know their role,
+    and a writable pair index load there would truncate the log the intake
+    process appends to. The intake process holds no user state.
+    """
+    if SHARD["role"] != "intake":
+        users.clear()
+        users.update(load_users())
+        user_states.load()
+        pending_trades.load()
+        pending_fills.clear()
+        pending_fills.update(load_fills())
+        load_tracked_txs()
+        load_ledger()
+    load_pair_index(readonly=SHARD["role"] == "worker")
+    load_candle_meta()
+
+
+def use_shared_caches(store):
+    global shared_store, reserves_cache, token_meta_cache, risk_scores, risk_seen, trace_window, snipe_watch
+    shared_store = store
+    reserves_cache = store["reserves"]
+    token_meta_cache = store["token_meta"]
+    risk_scores = store["risk_scores"]
+    risk_seen = store["risk_seen"]
+    trace_window = store["trace"]
+    snipe_watch = store["snipe_watch"]
+
+
+def partition_fills(count):
+    """Redistributes pending fills over the per-shard files for this worker count."""
+    root, ext = os.path.splitext(FILLS_FILE)
+    found = glob.glob(f"{root}*{ext}")
+    merged = {}
+    for path in found:
+        try:
+            with open(path, "r") as f:
+                merged.update(json.load(f))
+        except Exception:
+            continue
+    targets = [f"{root}.{i}of{count}{ext}" for i in range(count)]
+    for i, path in enumerate(targets):
+        with open(path, "w") as f:
+            json.dump({k: fill for k, fill in merged.items() if shard_of(fill["user_id"], count) == i}, f, indent=2)
+    for path in found:
+        if path not in targets:
+            os.remove(path)
+
+
+def shard_worker(index, count, queues, store):
+    SHARD.update({"role": "worker", "index": index, "count": count})
+    shard_queues[:] = queues
+    use_shared_caches(store)
+    load_state()
+    start_user_services()
+    threading.Thread(target=pair_index_worker, daemon=True).start()
+    print(f"Shard worker {index + 1}/{count} ready")
+    while True:
+        upd = queues[index].get()
+        submit_update(upd)
+
+
+def run_sharded(count):
+    # spawn, not fork: workers are restarted while the intake's indexer threads hold locks
+    ctx = multiprocessing.get_context("spawn")
+    manager = ctx.Manager()
+    store = {
+        "reserves": manager.dict(),
+        "token_meta": manager.dict(),
+        "candle_open": manager.dict(),
+        "candle_watch_add": manager.dict(),
+        "risk_scores": manager.dict(),
+        "risk_seen": manager.dict(),
+        "trace": manager.dict(),
+        "snipe_watch": manager.dict(),
+    }
+    queues = [ctx.Queue() for _ in range(count)]
+    shard_queues[:] = queues  # the intake's launch watcher signals every worker
+    partition_fills(count)
+
+    # the intake process keeps the chain-wide indexers the workers read from
+    SHARD.update({"role": "intake", "count": count})
+    load_state()
+
+    procs = [None] * count
+
+    def spawn(i):
+        procs[i] = ctx.Process(target=shard_worker, args=(i, count, queues, store), daemon=True)
+        procs[i].start()
+
+    for i in range(count):
+        spawn(i)
+
+    use_shared_caches(store)
+    start_chain_services()
+
+    def supervise():
+        while True:
+            time.sleep(5)
+            for i, proc in enumerate(procs):
+                if not proc.is_alive():
+                    print(f"Shard worker {i + 1} exited ({proc.exitcode}), restarting")
+                    spawn(i)
+
+    threading.Thread(target=supervise, daemon=True).start()
+    print(f"Trading bot started ({count} shard workers).")
+    poll_updates(lambda upd: queues[shard_of(get_update_user_id(upd), count)].put(upd))
+
+
+def start_chain_services():
+    threading.Thread(target=pair_index_worker, daemon=True).start()
+    threading.Thread(target=candle_worker, daemon=True).start()
+    threading.Thread(target=risk_worker, daemon=True).start()
+    threading.Thread(target=revenue_worker, daemon=True).start()
+    threading.Thread(target=snipe_watcher, daemon=True).start()
+
+
+def start_user_services():
+    threading.Thread(target=state_worker, daemon=True).start()
+    threading.Thread(target=reconcile_worker, daemon=True).start()
+    threading.Thread(target=tx_monitor_worker, daemon=True).start()
+    threading.Thread(target=snipe_refresh_worker, daemon=True).start()
+    threading.Thread(target=risk_alert_worker, daemon=True).start()
+    threading.Thread(target=discovery_worker, daemon=True).start()
+    threading.Thread(target=schedule_worker, daemon=True).start()
+    if BALANCE_SNAPSHOT_SEC > 0:
+        threading.Thread(target=balance_worker, daemon=True).start()
+    threading.Thread(target=inclusion_worker, daemon=True).start()
+
+
+def start_background_services():
+    start_chain_services()
+    start_user_services()
+
+
+# ---------- Update recording ----------
+# RECORD_UPDATES=<file> appends every polled update to a JSONL file that
+# replay.py can drive back into the handlers. User and chat ids become stable
+# pseudonyms (also where they appear in text), names are dropped, private keys
+# in message text are replaced by keys derived from them, and the bot's own
+# message under a button press keeps only the ids the handlers read, so a
+# recording can be shared for load tests.
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")
+RECORD_SALT = os.getenv("RECORD_SALT") or os.urandom(16).hex()  # same salt -> same pseudonyms across runs
+PRIVATE_KEY_RE = re.compile(r"\b(0x)?[0-9a-fA-F]{64}\b")
+NUMBER_RE = re.compile(r"(?<![0-9A-Za-z])-?[0-9]+(?![0-9A-Za-z])")
+ID_PARENTS = ("from", "chat", "user", "sender_chat")
+NAME_FIELDS = ("first_name", "last_name", "username", "title")
+CALLBACK_MESSAGE_FIELDS = ("message_id", "chat", "date")  # the rest is the bot's text: wallets, ids, balances
+record_lock = threading.Lock()
+
+
+def pseudonym(value):
+    digest = hashlib.sha256(f"{RECORD_SALT}:{value}".encode()).hexdigest()
+    anon = 10**9 + int(digest[:12], 16) % (9 * 10**9)
+    return -anon if int(value) < 0 else anon
+
+
+def anonymize_text(text, ids=()):
+    """Private keys, the update's own user / chat ids and the leader id of /copy, replaced."""
+    text = PRIVATE_KEY_RE.sub(lambda m: "0x" + hashlib.sha256(f"{RECORD_SALT}:{m.group(0)}".encode()).hexdigest(), text)
+    parts = text.split()
+    if len(parts) > 1 and parts[0].lower() == "/copy" and parts[1].lstrip("-").isdigit():
+        parts[1] = str(pseudonym(parts[1]))
+        text = " ".join(parts)
+    return NUMBER_RE.sub(lambda m: str(pseudonym(m.group(0))) if m.group(0) in ids else m.group(0), text)
+
+
+def update_ids(obj, parent=None):
+    """Every user and chat id in an update, as strings."""
+    if isinstance(obj, list):
+        return {i for v in obj for i in update_ids(v, parent)}
+    if not isinstance(obj, dict):
+        return set()
+    ids = {str(obj["id"])} if parent in ID_PARENTS and "id" in obj else set()
+    return ids.union(*(update_ids(v, k) for k, v in obj.items()))
+
+
+def anonymize_update(obj, parent=None, ids=None):
+    if ids is None:
+        ids = update_ids(obj)
+    if isinstance(obj, list):
+        return [anonymize_update(v, parent, ids) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for k, v in obj.items():
+        if k == "id" and parent in ID_PARENTS:
+            out[k] = pseudonym(v)
+        elif k in NAME_FIELDS:
+            out[k] = "anon"
+        elif k in ("text", "data", "caption") and isinstance(v, str):
+            out[k] = anonymize_text(v, ids)
+        elif k == "message" and parent == "callback_query" and isinstance(v, dict):
+            kept = {f: v[f] for f in CALLBACK_MESSAGE_FIELDS if f in v}
+            out[k] = anonymize_update(kept, k, ids)
+        else:
+            out[k] = anonymize_update(v, k, ids)
+    return out
 
-    send_message(chat_id, "Use the menu buttons below.", get_main_menu(has_wallet))
+
+def record_update(upd):
+    line = json.dumps({"t": time.time(), "update": anonymize_update(upd)})
+    with record_lock:
+        with open(RECORD_UPDATES, "a") as f:
+            f.write(line + "\n")
 
 
 # ---------- Long polling main loop ----------
-def main():
+def poll_updates(on_update):
     last_update_id = 0
-    print("Trading bot started.")
     while True:
         try:
             resp = requests.get(
@@ -1327,14 +6945,23 @@ def main():
             data = resp.json()
             for upd in data.get("result", []):
                 last_update_id = upd["update_id"]
-                if "callback_query" in upd:
-                    handle_callback(upd["callback_query"])
-                elif "message" in upd:
-                    handle_message(upd["message"])
+                if RECORD_UPDATES:
+                    record_update(upd)
+                on_update(upd)
         except Exception as e:
             print("Loop error:", e)
             time.sleep(3)
 
 
+def main():
+    if SHARD_WORKERS > 0:
+        run_sharded(SHARD_WORKERS)
+        return
+    load_state()
+    start_background_services()
+    print("Trading bot started.")
+    poll_updates(submit_update)
+
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
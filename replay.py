@@ -0,0 +1,406 @@
+"""
+Replay a recorded Telegram update stream into the bot's handlers.
+
+Record with RECORD_UPDATES=updates.rec.jsonl python bot.py, then:
+
+    python replay.py updates.rec.jsonl --speeds 1,5,10,25,50,100
+
+The bot runs in this process against two stand-ins started here: a Telegram
+Bot API server (which also answers bscscan holder pages) and a JSON-RPC node
+with a token that can be bought on every route. The updates are submitted on
+their recorded schedule, compressed by each speed factor. For every speed the
+harness prints p50 / p95 / p99 / max handling latency, measured from when the
+update was due to when its handler finished. It then reports the highest update
+rate at which p95 stays under --slo-ms and the backlog drains.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+START_BLOCK = 6809737 + 100  # just past the factory deployment, so the pair indexer has little to scan
+BLOCK_TIME = 3.0
+ONE = 10**18
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    i = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[i]
+
+
+# ---------- Stand-in servers ----------
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type="application/json"):
+        if self.latency:
+            time.sleep(self.latency)
+        data = body.encode() if isinstance(body, str) else body
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+
+class TelegramStub(StubHandler):
+    """Bot API methods succeed; bscscan token pages show a holder count."""
+
+    def do_GET(self):
+        if self.path.startswith("/token/"):
+            self.reply("<html>Holders: 1,234 addresses</html>", "text/html")
+        elif "/getUpdates" in self.path:
+            time.sleep(1)
+            self.reply(json.dumps({"ok": True, "result": []}))
+        else:
+            self.reply(json.dumps({"ok": True, "result": True}))
+
+    def do_POST(self):
+        self.read_body()
+        self.reply(json.dumps({"ok": True, "result": {"message_id": 1, "date": int(time.time())}}))
+
+
+class RpcStub(StubHandler):
+    """A BSC node with one block every BLOCK_TIME and liquid pools for every token."""
+
+    chain = None
+
+    def do_POST(self):
+        req = json.loads(self.read_body() or b"null")
+        if isinstance(req, list):
+            resp = [self.chain.answer(r) for r in req]
+        else:
+            resp = self.chain.answer(req)
+        self.reply(json.dumps(resp))
+
+
+class StubChain:
+    def __init__(self, codec, selector, tx_hash):
+        self.codec = codec
+        self.tx_hash = tx_hash
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.sent = {}  # tx hash -> block it was "mined" in
+        self.raw = {}  # tx hash -> raw transaction as sent
+        self.logs = []  # event logs eth_getLogs serves, e.g. a launch a test plays out
+        self.calls = {
+            selector("getAmountsOut(uint256,address[])"): self.get_amounts_out,
+            selector("getReserves()"): lambda data: self.codec.encode(
+                ["uint112", "uint112", "uint32"], [1000 * ONE, 10**6 * ONE, int(time.time())]
+            ),
+            selector("decimals()"): lambda data: self.codec.encode(["uint8"], [18]),
+            selector("symbol()"): lambda data: self.codec.encode(["string"], ["RPLY"]),
+            selector("name()"): lambda data: self.codec.encode(["string"], ["Replay Token"]),
+            selector("totalSupply()"): lambda data: self.codec.encode(["uint256"], [10**9 * ONE]),
+            selector("balanceOf(address)"): lambda data: self.codec.encode(["uint256"], [1000 * ONE]),
+            selector("allowance(address,address)"): lambda data: self.codec.encode(["uint256"], [2**256 - 1]),
+            selector("getPair(address,address)"): lambda data: self.codec.encode(["address"], ["0x" + "11" * 20]),
+            selector("aggregate3((address,bool,bytes)[])"): self.aggregate3,
+        }
+
+    def block(self):
+        return START_BLOCK + int((time.time() - self.started) / BLOCK_TIME)
+
+    def get_amounts_out(self, data):
+        amount_in, path = self.codec.decode(["uint256", "address[]"], data)
+        amounts = [amount_in]
+        for _ in path[1:]:
+            amounts.append(amounts[-1] * 997 // 1000)
+        return self.codec.encode(["uint256[]"], [amounts])
+
+    def aggregate3(self, data):
+        (calls,) = self.codec.decode(["(address,bool,bytes)[]"], data)
+        results = []
+        for _, _, call in calls:
+            handler = self.calls.get("0x" + call[:4].hex())
+            results.append((handler is not None, handler(call[4:]) if handler else b""))
+        return self.codec.encode(["(bool,bytes)[]"], [results])
+
+    def eth_call(self, params):
+        data = bytes.fromhex(params[0].get("data", params[0].get("input", "0x"))[2:])
+        handler = self.calls.get("0x" + data[:4].hex())
+        if handler is None:
+            raise ValueError("execution reverted")
+        return "0x" + handler(data[4:]).hex()
+
+    def receipt(self, tx_hash):
+        with self.lock:
+            mined = self.sent.get(tx_hash)
+        if mined is None or mined > self.block():
+            return None
+        return {
+            "transactionHash": tx_hash,
+            "blockNumber": hex(mined),
+            "blockHash": "0x" + "22" * 32,
+            "transactionIndex": "0x0",
+            "status": "0x1",
+            "gasUsed": hex(150000),
+            "cumulativeGasUsed": hex(150000),
+            "effectiveGasPrice": hex(5 * 10**9),
+            "logs": [],
+            "logsBloom": "0x" + "00" * 256,
+            "from": "0x" + "33" * 20,
+            "to": "0x" + "44" * 20,
+            "contractAddress": None,
+            "type": "0x0",
+        }
+
+    def get_logs(self, flt):
+        lo, hi = int(flt.get("fromBlock", "0x0"), 16), int(flt.get("toBlock", hex(self.block())), 16)
+        addresses = flt.get("address") or []
+        addresses = {a.lower() for a in ([addresses] if isinstance(addresses, str) else addresses)}
+        first = (flt.get("topics") or [None])[0]
+        first = [first] if isinstance(first, str) else first
+        with self.lock:
+            return [
+                log
+                for log in self.logs
+                if lo <= int(log["blockNumber"], 16) <= hi
+                and (not addresses or log["address"].lower() in addresses)
+                and (not first or log["topics"][0] in first)
+            ]
+
+    def result(self, method, params):
+        if method == "web3_clientVersion":
+            return "replay-stand-in/1.0"
+        if method == "eth_chainId":
+            return "0x38"
+        if method == "net_version":
+            return "56"
+        if method == "eth_blockNumber":
+            return hex(self.block())
+        if method == "eth_getBlockByNumber":
+            number = self.block() if params[0] in ("latest", "pending") else int(params[0], 16)
+            return {
+                "number": hex(number),
+                "hash": "0x" + hashlib.sha256(str(number).encode()).hexdigest(),
+                "parentHash": "0x" + "00" * 32,
+                "timestamp": hex(int(self.started + (number - START_BLOCK) * BLOCK_TIME)),
+                "gasLimit": hex(140_000_000),
+                "gasUsed": "0x0",
+                "baseFeePerGas": "0x0",
+                "transactions": [],
+            }
+        if method in ("eth_gasPrice", "eth_maxPriorityFeePerGas"):
+            return hex(5 * 10**9)
+        if method == "eth_getTransactionCount":
+            return "0x0"
+        if method == "eth_getBalance":
+            return hex(10 * ONE)
+        if method == "eth_estimateGas":
+            return hex(200000)
+        if method == "eth_getCode":
+            return "0x6080"
+        if method == "eth_getLogs":
+            return self.get_logs(params[0])
+        if method == "eth_call":
+            return self.eth_call(params)
+        if method == "eth_sendRawTransaction":
+            tx_hash = self.tx_hash(params[0])
+            with self.lock:
+                self.sent.setdefault(tx_hash, self.block() + 1)
+                self.raw[tx_hash] = params[0]
+            return tx_hash
+        if method == "eth_getTransactionReceipt":
+            return self.receipt(params[0])
+        if method == "eth_getTransactionByHash":
+            return None
+        raise NotImplementedError(f"method {method} not supported by the stand-in node")
+
+    def answer(self, req):
+        base = {"jsonrpc": "2.0", "id": req.get("id")}
+        try:
+            base["result"] = self.result(req["method"], req.get("params") or [])
+        except NotImplementedError as e:
+            base["error"] = {"code": -32601, "message": str(e)}
+        except Exception as e:
+            base["error"] = {"code": 3, "message": str(e)}
+        return base
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_stand_ins(rpc_latency_ms=0.0, tg_latency_ms=0.0):
+    """
+    Starts both stand-ins and points the bot's environment at them. Call it before
+    importing bot: the bot connects at import time, so the node must already answer.
+    """
+    from web3 import Web3
+
+    RpcStub.latency = rpc_latency_ms / 1000
+    TelegramStub.latency = tg_latency_ms / 1000
+    RpcStub.chain = StubChain(
+        Web3().codec,
+        lambda sig: Web3.to_hex(Web3.keccak(text=sig))[:10],
+        lambda raw: Web3.to_hex(Web3.keccak(hexstr=raw)),
+    )
+    tg_url = serve(TelegramStub)
+    rpc_url = serve(RpcStub)
+    os.environ.update(
+        {
+            "TELEGRAM_TOKEN": "replay",
+            "TELEGRAM_API_URL": tg_url,
+            "BSCSCAN_URL": tg_url,
+            "BSC_RPC_URL": rpc_url,
+            "BROADCAST_RPCS": rpc_url,
+            "WRAPPER_ADDRESS": "0x" + "55" * 20,
+        }
+    )
+    os.environ.pop("RECORD_UPDATES", None)
+    return RpcStub.chain
+
+
+# ---------- Replay ----------
+def load_recording(path, limit):
+    updates = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                updates.append(json.loads(line))
+            if limit and len(updates) >= limit:
+                break
+    updates.sort(key=lambda r: r["t"])
+    return updates
+
+
+def seed_users(bot, updates):
+    """Gives every recorded user a wallet, so trade flows work even if the recording started mid-session."""
+    for rec in updates:
+        uid = bot.get_update_user_id(rec["update"])
+        if uid is None or str(uid) in bot.users:
+            continue
+        key = "0x" + hashlib.sha256(f"replay:{uid}".encode()).hexdigest()
+        acct = bot.w3.eth.account.from_key(key)
+        bot.users[str(uid)] = {
+            "private_key": key,
+            "address": acct.address,
+            "settings": {"slippage": 0.03, "gas_mode": "standard"},
+            "positions": {},
+        }
+
+
+def run_speed(bot, updates, speed, max_seconds, drain_timeout):
+    """Submits updates on their recorded schedule divided by speed; returns latencies (ms) and timings."""
+    t_first = updates[0]["t"]
+    schedule = [(rec["t"] - t_first) / speed for rec in updates]
+    if max_seconds:
+        schedule = [at for at in schedule if at <= max_seconds]
+    due = {}
+    latencies = []
+    finished = threading.Event()
+    lock = threading.Lock()
+    dispatch = bot.dispatch_update
+
+    def timed_dispatch(upd):
+        try:
+            dispatch(upd)
+        finally:
+            with lock:
+                started = due.pop(upd["update_id"], None)
+                if started is not None:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                if len(latencies) == len(schedule):
+                    finished.set()
+
+    bot.dispatch_update = timed_dispatch
+    try:
+        t0 = time.perf_counter()
+        for i, at in enumerate(schedule):
+            delay = t0 + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            upd = dict(updates[i]["update"])
+            upd["update_id"] = f"{speed}:{i}"
+            with lock:
+                due[upd["update_id"]] = t0 + at
+            bot.submit_update(upd)
+        fed = time.perf_counter()
+        finished.wait(drain_timeout)
+        done = time.perf_counter()
+    finally:
+        bot.dispatch_update = dispatch
+    return {
+        "submitted": len(schedule),
+        "latencies": sorted(latencies),
+        "offered_rate": len(schedule) / max(schedule[-1], 1e-9) if len(schedule) > 1 else 0.0,
+        "achieved_rate": len(latencies) / max(done - t0, 1e-9),
+        "drain_ms": (done - fed) * 1000,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("recording", help="JSONL written by the bot with RECORD_UPDATES set")
+    ap.add_argument("--speeds", default="1,2,5,10,25,50,100", help="comma-separated replay speed factors (1-100)")
+    ap.add_argument("--limit", type=int, default=0, help="replay only the first N updates")
+    ap.add_argument("--max-seconds", type=float, default=120, help="cap on each run's replay time")
+    ap.add_argument("--slo-ms", type=float, default=1000, help="p95 latency a sustained rate must stay under")
+    ap.add_argument("--rpc-latency-ms", type=float, default=20, help="stand-in node response time")
+    ap.add_argument("--tg-latency-ms", type=float, default=40, help="stand-in Telegram response time")
+    ap.add_argument("--no-background", action="store_true", help="do not start the bot's background workers")
+    args = ap.parse_args()
+
+    speeds = [float(x) for x in args.speeds.split(",")]
+    if any(not 1 <= x <= 100 for x in speeds):
+        ap.error("speeds must be between 1 and 100")
+    updates = load_recording(args.recording, args.limit)
+    if not updates:
+        ap.error("recording is empty")
+
+    start_stand_ins(args.rpc_latency_ms, args.tg_latency_ms)
+
+    # the bot keeps its data files in the working directory; keep replay's out of the repo
+    os.chdir(tempfile.mkdtemp(prefix="replay-"))
+    sys.path.insert(0, REPO_DIR)
+    import bot
+
+    bot.load_state()
+    seed_users(bot, updates)
+    if not args.no_background:
+        bot.start_background_services()
+
+    print(f"Replaying {len(updates)} updates from {args.recording} (data dir {os.getcwd()})")
+    print(f"{'speed':>6} {'updates':>8} {'offered/s':>10} {'done/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'drain':>8}")
+    best = None
+    for speed in speeds:
+        r = run_speed(bot, updates, speed, args.max_seconds, drain_timeout=max(args.slo_ms / 1000 * 10, 30))
+        lat = r["latencies"]
+        p95 = percentile(lat, 95)
+        complete = len(lat) == r["submitted"]
+        sustained = complete and p95 <= args.slo_ms and r["drain_ms"] <= args.slo_ms
+        print(
+            f"{speed:>5g}x {r['submitted']:>8} {r['offered_rate']:>10.1f} {r['achieved_rate']:>8.1f} "
+            f"{percentile(lat, 50):>6.0f}ms {p95:>6.0f}ms {percentile(lat, 99):>6.0f}ms "
+            f"{(lat[-1] if lat else 0):>6.0f}ms {r['drain_ms']:>6.0f}ms{'' if sustained else '  (not sustained)'}"
+        )
+        if sustained and (best is None or r["offered_rate"] > best[1]):
+            best = (speed, r["offered_rate"])
+
+    if best:
+        print(f"\nHighest sustained rate: {best[1]:.1f} updates/s ({best[0]:g}x), p95 under {args.slo_ms:.0f} ms")
+    else:
+        print(f"\nNo speed kept p95 under {args.slo_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+The bot under test runs against replay.py's stand-in node, plus a few stand-in
+broadcast relays whose answers the tests can change. The bot reads its endpoint
+list at import, so everything is started before the first import of bot.
+"""
+import os
+import sys
+import json
+import tempfile
+import types
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import replay  # noqa: E402
+
+
+class RelayStub(replay.StubHandler):
+    """A broadcast endpoint that accepts every transaction, or answers every one with `error`."""
+
+    error = None
+
+    def do_POST(self):
+        req = json.loads(self.read_body() or b"null")
+        items = req if isinstance(req, list) else [req]
+        out = []
+        for item in items:
+            resp = {"jsonrpc": "2.0", "id": item.get("id")}
+            if self.error:
+                resp["error"] = {"code": -32000, "message": self.error}
+            else:
+                resp["result"] = "0x" + "ab" * 32
+            out.append(resp)
+        self.reply(json.dumps(out if isinstance(req, list) else out[0]))
+
+
+RELAYS = {
+    "fast": type("FastRelay", (RelayStub,), {}),
+    "known": type("KnownRelay", (RelayStub,), {"error": "already known"}),
+    "rejecting": type("RejectingRelay", (RelayStub,), {"error": "nonce too low"}),
+    "slow": type("SlowRelay", (RelayStub,), {"latency": 0.3}),
+}
+
+
+@pytest.fixture(scope="session")
+def env():
+    pytest.importorskip("web3")
+    chain = replay.start_stand_ins()
+    urls = {name: replay.serve(handler) for name, handler in RELAYS.items()}
+    os.environ["BROADCAST_RPCS"] = ",".join([os.environ["BSC_RPC_URL"], urls["fast"], urls["known"], urls["rejecting"]])
+    os.environ["PRIVATE_RELAY_RPCS"] = urls["slow"]
+    os.environ["ADMIN_IDS"] = "1"
+    os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+    import bot
+
+    bot.load_state()
+    return types.SimpleNamespace(bot=bot, chain=chain, node=os.environ["BSC_RPC_URL"], relays=urls)
+
+
+@pytest.fixture
+def bot(env):
+    return env.bot
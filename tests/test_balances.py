@@ -0,0 +1,42 @@
+import os
+
+
+def address(bot):
+    return bot.w3.to_checksum_address("0x" + os.urandom(20).hex())
+
+
+def test_multicall_balances_decode_per_pair_and_cache_per_block(env, monkeypatch):
+    bot = env.bot
+    wallets, token, other = [address(bot), address(bot), address(bot)], address(bot), address(bot)
+    held = {w.lower(): (n + 1) * 10**18 for n, w in enumerate(wallets)}
+
+    def balance_of(data):
+        owner = "0x" + data[12:32].hex()
+        return b"" if owner == wallets[2].lower() else bot.w3.codec.encode(["uint256"], [held[owner]])
+
+    monkeypatch.setitem(env.chain.calls, bot.BALANCE_OF_SELECTOR, balance_of)
+    monkeypatch.setattr(bot, "MULTICALL_CHUNK", 2)
+    monkeypatch.setattr(bot, "balance_snapshot", {"block": -1, "bnb": {}, "tokens": {}})
+    block = [500]
+    monkeypatch.setattr(bot, "head_block", lambda: block[0])
+    sent, batch = [], bot.rpc_batch_chunked
+    monkeypatch.setattr(bot, "rpc_batch_chunked", lambda calls: sent.append(calls) or batch(calls))
+
+    pairs = [(w, token) for w in wallets]
+    bnb, raw = bot.fetch_balances(wallets[:1], pairs)
+    assert [method for method, _ in sent[0]] == ["eth_getBalance", "eth_call", "eth_call"]  # 3 pairs, chunks of 2
+    assert bnb == {wallets[0].lower(): 10 * 10**18}
+    assert raw == {
+        (wallets[0].lower(), token.lower()): 10**18,
+        (wallets[1].lower(), token.lower()): 2 * 10**18,
+        (wallets[2].lower(), token.lower()): 0,  # a short return reads as 0
+    }
+
+    assert bot.get_token_balance(wallets[1], token) == 2 * 10**18
+    assert len(sent) == 1  # same block: served from the snapshot
+    bot.fetch_balances(pairs=[(wallets[0], token), (wallets[0], other)])
+    assert [method for method, _ in sent[1]] == ["eth_call"]  # only the pair the snapshot lacks
+
+    block[0] = 501
+    assert bot.get_token_balance(wallets[1], token) == 2 * 10**18
+    assert len(sent) == 3
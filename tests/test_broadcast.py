@@ -0,0 +1,97 @@
+import os
+import time
+
+import pytest
+
+from conftest import RELAYS
+
+
+def stats(bot):
+    with bot.broadcast_lock:
+        return {url: dict(st) for url, st in bot.endpoint_stats.items()}
+
+
+def settle(bot, before, n=1):
+    """Waits until every endpoint has answered n more transactions; returns the stats then."""
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        now = stats(bot)
+        if all(now[url]["sent"] - before[url]["sent"] >= n for url in now):
+            return now
+        time.sleep(0.02)
+    raise AssertionError("not every endpoint answered")
+
+
+def new_raw():
+    return "0x" + os.urandom(110).hex()
+
+
+def test_sends_to_every_endpoint(env):
+    bot = env.bot
+    before = stats(bot)
+    raw = new_raw()
+    assert bot.broadcast_raw_txs([raw]) == [bot.Web3.to_hex(bot.Web3.keccak(hexstr=raw))]
+    after = settle(bot, before)
+
+    def delta(name, key):
+        url = env.node if name == "node" else env.relays[name]
+        return after[url][key] - before[url][key]
+
+    for name in ("node", "fast", "slow"):
+        assert delta(name, "accepted") == 1
+    assert delta("known", "accepted") == 1  # "already known" counts as accepted
+    assert delta("rejecting", "accepted") == 0
+    assert delta("rejecting", "errors") == 1
+    assert sum(after[url]["first"] - before[url]["first"] for url in after) == 1
+    assert delta("slow", "first") == 0
+
+
+def test_returns_before_slow_endpoints_answer(env):
+    started = time.perf_counter()
+    env.bot.broadcast_raw_txs([new_raw()])
+    assert time.perf_counter() - started < RELAYS["slow"].latency
+
+
+def test_rejected_everywhere(env, monkeypatch):
+    for handler in RELAYS.values():
+        monkeypatch.setattr(handler, "error", "insufficient funds for gas")
+
+    def reject(method, params):
+        raise ValueError("insufficient funds for gas")
+
+    monkeypatch.setattr(env.chain, "result", reject)
+    assert env.bot.broadcast_raw_txs([new_raw(), new_raw()]) == [None, None]
+    with pytest.raises(Exception):
+        env.bot.broadcast_raw_tx(new_raw())
+
+
+def test_inclusion_timed_for_every_accepting_endpoint(env):
+    bot = env.bot
+    with bot.broadcast_lock:
+        bot.broadcast_pending.clear()
+    before = stats(bot)
+    (tx_hash,) = bot.broadcast_raw_txs([new_raw()])
+    settle(bot, before)
+    with env.chain.lock:
+        env.chain.sent[tx_hash] = env.chain.block()
+    bot.track_inclusions()
+    after = stats(bot)
+
+    for url in [env.node] + [env.relays[name] for name in ("fast", "known", "slow")]:
+        assert after[url]["landed"] - before[url]["landed"] == 1
+        assert after[url]["land_ms"] > before[url]["land_ms"]
+    rejecting = env.relays["rejecting"]
+    assert after[rejecting]["landed"] == before[rejecting]["landed"]
+    assert tx_hash not in bot.broadcast_pending
+    assert bot.endpoint_ranking()[-1][0] == rejecting
+
+
+def test_broadcasts_count_in_rpc_stats(env):
+    bot = env.bot
+    with bot.rpc_stats_lock:
+        before = bot.rpc_stats["http_requests"]
+    start = stats(bot)
+    bot.broadcast_raw_txs([new_raw()])
+    settle(bot, start)
+    with bot.rpc_stats_lock:
+        assert bot.rpc_stats["http_requests"] - before >= len(bot.BROADCAST_ENDPOINTS)
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def candles(bot, monkeypatch, tmp_path):
+    token = bot.w3.to_checksum_address("0x" + os.urandom(20).hex())
+    pair = bot.w3.to_checksum_address("0x" + os.urandom(20).hex())
+    monkeypatch.setattr(bot, "CANDLE_DIR", str(tmp_path))
+    monkeypatch.setattr(bot, "open_candles", {})
+    monkeypatch.setattr(bot, "resolve_pair", lambda a, b: None)
+    watch = {"token": token, "quote": bot.BUSD, "token_is_0": token.lower() < bot.BUSD.lower(), "decimals": 18}
+    monkeypatch.setattr(bot, "candle_watch", {pair: watch})
+    block = [100]
+
+    def sync(ts, price):
+        token_res, quote_res = 1000 * 10**18, int(price * 1000 * 10**18)
+        r0, r1 = (token_res, quote_res) if watch["token_is_0"] else (quote_res, token_res)
+        block[0] += 1
+        return {"address": pair.lower(), "blockNumber": hex(block[0]), "logIndex": "0x0",
+                "blockTimestamp": hex(ts), "data": f"0x{r0:064x}{r1:064x}"}
+
+    return bot, token, sync
+
+
+def test_candles_roll_over_per_interval(candles):
+    bot, token, sync = candles
+    bot._apply_sync_logs([sync(1000, 1.0), sync(1010, 2.0), sync(1030, 0.5), sync(1050, 0.8)])
+    bot._apply_sync_logs([sync(1090, 1.5)])
+
+    minute = bot.read_candles(token, 60, 0, 2000)
+    assert list(minute["t"]) == [960, 1020, 1080]
+    assert [minute[c][0] for c in "ohlc"] == pytest.approx([1.0, 2.0, 1.0, 2.0])
+    assert [minute[c][1] for c in "ohlc"] == pytest.approx([0.5, 0.8, 0.5, 0.8])
+    assert minute["c"][2] == pytest.approx(1.5)  # still open
+    assert os.path.getsize(bot._candle_path(token, 60, "t")) == 2 * 8  # two closed rows on disk
+
+    five = bot.read_candles(token, 300, 0, 2000)
+    assert list(five["t"]) == [900]
+    assert [five[c][0] for c in "ohlc"] == pytest.approx([1.0, 2.0, 0.5, 1.5])
+    assert list(bot.read_candles(token, 60, 1000, 1080)["t"]) == [1020]
@@ -0,0 +1,23 @@
+def word(value):
+    return format(value, "064x")
+
+
+def test_fee_getters_go_through_the_codec(bot, monkeypatch):
+    receiver = bot.w3.to_checksum_address("0x" + "6d" * 20)
+    answers = {
+        bot.FEE_BASIS_POINTS_SELECTOR: {"error": {"code": 3, "message": "execution reverted"}},
+        bot.FEE_PERCENT_TIMES100_SELECTOR: {"result": "0x" + word(250)},
+        bot.FEE_RECEIVER_SELECTOR: {"result": "0x" + "0" * 24 + receiver[2:].lower()},
+    }
+    batches = []
+    monkeypatch.setattr(bot, "rpc_batch", lambda calls: batches.append(calls) or [answers[c[1][0]["data"]] for c in calls])
+    assert bot.call_token_fee(bot.BUSD) == (250, receiver)
+    assert len(batches) == 1
+
+    answers[bot.FEE_PERCENT_TIMES100_SELECTOR] = {"result": "0x"}
+    assert bot.call_token_fee(bot.BUSD) == (None, None)
+
+
+def test_selectors(bot):
+    assert bot.AGGREGATE3_SELECTOR == "0x82ad56cb"
+    assert bot.FEE_BASIS_POINTS_SELECTOR == bot.abi_selector("feeBasisPoints()")
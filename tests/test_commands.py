@@ -0,0 +1,23 @@
+
+def run(bot, monkeypatch, user_id, text):
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, buttons=None: sent.append(text))
+    ctx = bot.UpdateContext(user_id, user_id, text=text)
+    bot.message_router.dispatch("", ctx)
+    return sent
+
+
+def test_admin_commands_are_only_for_admins(bot, monkeypatch):
+    assert run(bot, monkeypatch, 2, "/copystats") == ["Use the menu buttons below."]
+    (reply,) = run(bot, monkeypatch, 1, "/copystats")
+    assert reply.startswith("🔁 *Copy trading*")
+
+
+def test_wallet_commands_need_a_wallet(bot, monkeypatch):
+    assert run(bot, monkeypatch, 905, "/snipes") == ["Connect a wallet first."]
+    assert run(bot, monkeypatch, 905, "/uncopy") == ["Copy trading off."]
+
+
+def test_unknown_command_gets_the_menu_hint(bot, monkeypatch):
+    assert run(bot, monkeypatch, 905, "/nope") == ["Use the menu buttons below."]
+    assert bot.command_router.resolve("/dca") is bot.command_router.resolve("/twap")
@@ -0,0 +1,13 @@
+def test_only_liquid_received_tokens_are_adopted(bot, monkeypatch):
+    wallet = "0x" + "71" * 20
+    liquid, dust, unpaired = (bot.w3.to_checksum_address("0x" + b * 20) for b in ("72", "73", "74"))
+    monkeypatch.setitem(bot.users, "904", {"private_key": "0x" + "11" * 32, "settings": {}, "positions": {}})
+    monkeypatch.setattr(bot, "save_users", lambda data: None)
+    monkeypatch.setattr(bot, "fetch_balances", lambda pairs: ({}, {(w, t.lower()): 10**18 for w, t in pairs}))
+    monkeypatch.setattr(bot, "get_token_meta", lambda t: {"symbol": "TKN", "decimals": 18})
+    monkeypatch.setattr(bot, "get_path_for_buy", lambda t: [bot.WBNB, t])
+    reserves = {liquid: [(5 * 10**18, 10**24)], dust: [(10**15, 10**24)], unpaired: None}
+    monkeypatch.setattr(bot, "path_hops", lambda path: reserves[path[-1]])
+
+    bot.adopt_tokens({(wallet, t) for t in (liquid, dust, unpaired)}, {wallet: "904"})
+    assert list(bot.users["904"]["positions"]) == [liquid]
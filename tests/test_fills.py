@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+
+def topic(address):
+    return "0x" + "0" * 24 + address[2:].lower()
+
+
+def transfer(bot, token, src, dst, amount):
+    return {"address": token, "topics": [bot.TRANSFER_TOPIC, topic(src), topic(dst)], "data": hex(amount)}
+
+
+@pytest.fixture
+def trader(bot, monkeypatch):
+    wallet = bot.w3.eth.account.from_key("0x" + os.urandom(32).hex()).address
+    token = bot.w3.to_checksum_address("0x" + os.urandom(20).hex())
+    monkeypatch.setitem(bot.users, "903", {"settings": {}, "positions": {}})
+    monkeypatch.setitem(bot.wrapper_fee_cache, "bps", 100)
+    notes = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, buttons=None: notes.append(text))
+    receipts = {}
+
+    def chain(calls, size=None):
+        return [{"result": receipts.get(params[0])} for method, params in calls]
+
+    monkeypatch.setattr(bot, "rpc_batch_chunked", chain)
+    fill = {"user_id": 903, "chat_id": 903, "wallet": wallet, "token": token, "symbol": "T", "decimals": 18}
+    return bot, fill, receipts, notes
+
+
+def position(bot, token):
+    return bot.users["903"]["positions"].get(token)
+
+
+def test_buy_settles_to_the_received_amount(trader):
+    bot, fill, receipts, notes = trader
+    bot.update_position_buy(903, fill["token"], "T", 100.0, 1.0, save=False)
+    tx = "0x" + "05" * 32
+    bot.track_fill({**fill, "type": "buy", "txs": [tx], "amounts_in": [10**18], "expected_tokens": 100.0,
+                    "price_usd": 1.0, "bnb_price_usd": 90.0})
+    bot.reconcile_fills()
+    assert tx in bot.pending_fills  # no receipt yet
+    receipts[tx] = {"status": "0x1", "logs": [transfer(bot, fill["token"], bot.WBNB, fill["wallet"], 90 * 10**18)]}
+    bot.reconcile_fills()
+    assert tx not in bot.pending_fills and tx not in bot.load_fills()
+    assert position(bot, fill["token"])["amount"] == pytest.approx(90.0)
+    assert position(bot, fill["token"])["avg_price_usd"] == pytest.approx(1.0)
+    assert notes[-1].startswith("✅ BUY T filled: 90.0000 T")
+
+
+def test_sell_settles_to_what_left_the_wallet(trader):
+    bot, fill, receipts, notes = trader
+    bot.update_position_buy(903, fill["token"], "T", 40.0, 1.0, save=False)  # 90 held, 50 optimistically sold
+    tx = "0x" + "06" * 32
+    bot.track_fill({**fill, "type": "sell", "txs": [tx], "amount_tokens": 50.0, "removed_tokens": 50.0,
+                    "avg_price_usd": 1.0, "expected_bnb": 0.5, "bnb_price_usd": 100.0})
+    withdrawal = {"address": bot.WBNB, "topics": [bot.WITHDRAWAL_TOPIC, topic(bot.WRAPPER_ADDRESS)], "data": hex(10**18 // 2)}
+    receipts[tx] = {"status": "0x1", "logs": [transfer(bot, fill["token"], fill["wallet"], bot.WBNB, 45 * 10**18), withdrawal]}
+    bot.reconcile_fills()
+    assert tx not in bot.pending_fills
+    assert position(bot, fill["token"])["amount"] == pytest.approx(45.0)
+    assert notes[-1] == "✅ SELL T filled: 45.0000 T for 0.4950 BNB"
+
+
+def test_reverted_sell_restores_the_position(trader):
+    bot, fill, receipts, notes = trader
+    tx = "0x" + "07" * 32
+    bot.track_fill({**fill, "type": "sell", "txs": [tx], "amount_tokens": 50.0, "removed_tokens": 50.0,
+                    "avg_price_usd": 2.0, "expected_bnb": 0.5})
+    receipts[tx] = {"status": "0x0", "logs": []}
+    bot.reconcile_fills()
+    assert position(bot, fill["token"]) == {"symbol": "T", "amount": 50.0, "avg_price_usd": 2.0}
+    assert notes[-1] == "❌ SELL T failed on-chain, position restored."
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+
+def test_single_flight_shares_one_lookup_per_head_block(bot, monkeypatch):
+    block = [100]
+    monkeypatch.setattr(bot, "head_block", lambda: block[0])
+    token = bot.w3.to_checksum_address("0x" + "5f" * 20)
+    release, calls, results = threading.Event(), [], []
+
+    def compute():
+        calls.append(block[0])
+        release.wait(5)
+        return {"block": block[0]}
+
+    threads = [threading.Thread(target=lambda: results.append(bot.single_flight("flight_test", token, compute)))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    while bot.flight_stats.get("flight_test", {}).get("calls", 0) < 5:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert calls == [100] and results == [{"block": 100}] * 5
+    assert bot.flight_stats["flight_test"] == {"calls": 5, "computed": 1, "absorbed": 4}
+    assert bot.single_flight("flight_test", token.lower(), compute) == {"block": 100}  # same block: cached
+    block[0] = 101
+    assert bot.single_flight("flight_test", token, compute) == {"block": 101}
+    assert calls == [100, 101]
+
+
+def test_single_flight_errors_are_shared_but_not_cached(bot, monkeypatch):
+    monkeypatch.setattr(bot, "head_block", lambda: 200)
+    token = bot.w3.to_checksum_address("0x" + "6f" * 20)
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise ValueError("node down")
+
+    with pytest.raises(ValueError):
+        bot.single_flight("flight_error_test", token, failing)
+    assert bot.single_flight("flight_error_test", token, lambda: 7) == 7
+    assert len(calls) == 1
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def ledger(bot, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "LEDGER_FILE", str(tmp_path / "ledger.jsonl"))
+    monkeypatch.setattr(bot, "LEDGER_SNAPSHOT_FILE", str(tmp_path / "ledger.snapshot.json"))
+    monkeypatch.setattr(bot, "LEDGER_SNAPSHOT_EVERY", 3)
+    restart(bot, monkeypatch)
+    return bot
+
+
+def restart(bot, monkeypatch):
+    monkeypatch.setattr(bot, "ledger_state", {"seq": 0, "offset": 0, "since_snapshot": 0})
+    monkeypatch.setattr(bot, "ledger_users", {})
+    monkeypatch.setattr(bot, "ledger_history", {})
+
+
+def trade(bot, kind, tokens, value_usd, status="ok"):
+    return bot.record_ledger(
+        {"kind": kind, "status": status, "user_id": 908, "token": bot.BUSD, "symbol": "T", "txs": ["0x01"],
+         "tokens": tokens, "bnb": value_usd / 100, "price_usd": value_usd / tokens, "value_usd": value_usd,
+         "wrapper_fee_bnb": value_usd / 10000}
+    )
+
+
+def test_average_cost_aggregate(ledger):
+    bot = ledger
+    trade(bot, "buy", 100.0, 50.0)
+    trade(bot, "buy", 100.0, 150.0)
+    trade(bot, "sell", 150.0, 300.0)
+    trade(bot, "sell", 50.0, 500.0, status="failed")
+    agg = bot.get_user_pnl(908)
+    t = agg["tokens"][bot.BUSD]
+    assert agg["realized_usd"] == pytest.approx(150.0)  # 300 for 150 tokens at an average cost of 1
+    assert t["qty"] == pytest.approx(50.0) and t["cost_usd"] == pytest.approx(50.0)
+    assert agg["trades"] == 3 and agg["volume_bnb"] == pytest.approx(5.0)
+    assert agg["fees_bnb"] == pytest.approx(0.05)
+    assert [e["status"] for e in bot.get_user_history(908)] == ["ok", "ok", "ok", "failed"]
+
+    trade(bot, "sell", 100.0, 100.0)  # only the 50 tracked tokens realize against cost
+    assert bot.get_user_pnl(908)["realized_usd"] == pytest.approx(150.0 + 50.0 - 50.0)
+
+
+def test_restart_replays_entries_after_the_snapshot(ledger, monkeypatch):
+    bot = ledger
+    for n in range(5):
+        trade(bot, "buy", 10.0, 10.0 * (n + 1))
+    with open(bot.LEDGER_SNAPSHOT_FILE) as f:
+        assert json.load(f)["seq"] == 3
+    before = bot.get_user_pnl(908)
+    size = os.path.getsize(bot.LEDGER_FILE)
+    with open(bot.LEDGER_FILE, "ab") as f:
+        f.write(b'{"seq": 6, "kind": "bu')  # torn write
+
+    restart(bot, monkeypatch)
+    bot.load_ledger()
+    assert bot.get_user_pnl(908) == before
+    assert bot.ledger_state["seq"] == 5
+    assert os.path.getsize(bot.LEDGER_FILE) == size
+    assert len(bot.get_user_history(908)) == 5
+    assert trade(bot, "buy", 1.0, 1.0)["seq"] == 6
@@ -0,0 +1,100 @@
+import os
+from types import SimpleNamespace
+
+
+def new_wallet(bot):
+    return bot.w3.eth.account.from_key("0x" + os.urandom(32).hex()).address
+
+
+def test_local_nonce_covers_txs_the_node_has_not_seen(bot, monkeypatch):
+    wallet = new_wallet(bot)
+    monkeypatch.setattr(bot, "head_block", lambda: 100)
+    bot.note_nonce(wallet, 4)
+    assert bot.reconcile_nonce(wallet, 3) == 5
+
+
+def test_lagging_node_count_wins_after_resync_blocks(bot, monkeypatch):
+    wallet = new_wallet(bot)
+    block = [100]
+    monkeypatch.setattr(bot, "head_block", lambda: block[0])
+    bot.note_nonce(wallet, 4)
+    assert bot.reconcile_nonce(wallet, 4) == 5
+    block[0] += bot.NONCE_RESYNC_BLOCKS - 1
+    assert bot.reconcile_nonce(wallet, 4) == 5
+    block[0] += 1
+    assert bot.reconcile_nonce(wallet, 4) == 4
+    assert bot.reconcile_nonce(wallet, 4) == 4
+
+
+def test_dropped_tx_resyncs_nonce_and_forgets_approval(bot, monkeypatch):
+    wallet = new_wallet(bot)
+    token = bot.w3.to_checksum_address("0x" + "66" * 20)
+    monkeypatch.setattr(bot, "get_user_account", lambda uid, address=None: (SimpleNamespace(address=wallet), None))
+    data = bot.encode_approve(bot.WRAPPER_ADDRESS, 1)
+    tx = {"from": wallet, "to": token, "nonce": 7, "gasPrice": 10**9, "data": data}
+    bot.note_nonce(wallet, 7)
+    bot.set_allowance(wallet, token, bot.MAX_UINT256)
+    bot.watch_tx(1, tx, "0x" + "01" * 32, label="Approval")
+
+    def chain(calls):
+        # no receipt for the approval, and the wallet's nonce 7 was used by another tx
+        return [{"result": None if method == "eth_getTransactionReceipt" else hex(9)} for method, _ in calls]
+
+    monkeypatch.setattr(bot, "rpc_batch_chunked", chain)
+    bot.monitor_txs()
+    assert bot.cached_allowance(wallet, token) is None
+    assert wallet.lower() not in bot.wallet_nonces
+
+
+def test_reverted_approval_forgets_allowance(bot, monkeypatch):
+    wallet = new_wallet(bot)
+    token = bot.w3.to_checksum_address("0x" + "67" * 20)
+    monkeypatch.setattr(bot, "get_user_account", lambda uid, address=None: (SimpleNamespace(address=wallet), None))
+    data = bot.encode_approve(bot.WRAPPER_ADDRESS, 1)
+    tx = {"from": wallet, "to": token, "nonce": 0, "gasPrice": 10**9, "data": data}
+    tx_hash = "0x" + "02" * 32
+    bot.set_allowance(wallet, token, bot.MAX_UINT256)
+    bot.watch_tx(1, tx, tx_hash, label="Approval")
+
+    def chain(calls):
+        out = []
+        for method, params in calls:
+            if method == "eth_getTransactionCount":
+                out.append({"result": "0x0"})
+            else:
+                out.append({"result": {"status": "0x0"} if params == [tx_hash] else None})
+        return out
+
+    monkeypatch.setattr(bot, "rpc_batch_chunked", chain)
+    bot.monitor_txs()
+    assert bot.cached_allowance(wallet, token) is None
+    assert tx_hash not in bot.tx_id_by_hash
+
+
+def test_copy_trade_takes_the_locally_tracked_nonce(bot, monkeypatch):
+    key = "0x" + os.urandom(32).hex()
+    wallet = bot.w3.eth.account.from_key(key).address
+    token = bot.w3.to_checksum_address("0x" + "68" * 20)
+    profile = {"settings": {}, "private_key": key, "copy": {"mode": "fixed", "value": 0.1}}
+    monkeypatch.setattr(bot, "head_block", lambda: 100)
+    monkeypatch.setattr(bot, "get_followers", lambda source: ["7001"])
+    monkeypatch.setattr(bot, "get_user_account", lambda uid, address=None: (SimpleNamespace(address=wallet), key))
+    monkeypatch.setattr(bot, "ensure_profile", lambda uid: profile)
+    monkeypatch.setattr(bot, "get_path_for_buy", lambda t: [bot.WBNB, t])
+    monkeypatch.setattr(bot, "path_hops", lambda path: [(10**21, 10**24)])
+    monkeypatch.setattr(bot, "get_token_meta", lambda t: {"decimals": 18, "symbol": "T"})
+    monkeypatch.setattr(bot, "broadcast_raw_txs", lambda raws: ["0x" + "03" * 32 for _ in raws])
+    monkeypatch.setattr(bot, "book_sent_orders", lambda orders, *rest: sent.extend(orders) or [])
+    monkeypatch.setattr(bot, "save_users", lambda users: None)
+    monkeypatch.setattr(bot, "save_fills", lambda: None)
+
+    def chain(calls):
+        # the node has not seen the approval staged at nonce 4 yet
+        out = {"eth_getTransactionCount": "0x4", "eth_getBalance": hex(10**18), "eth_gasPrice": hex(10**9)}
+        return [{"result": out[method]} for method, _ in calls]
+
+    monkeypatch.setattr(bot, "rpc_batch_chunked", chain)
+    sent = []
+    bot.note_nonce(wallet, 4)
+    assert bot.fan_out_copy("leader", "buy", token) == 1
+    assert sent[0]["nonce"] == 5
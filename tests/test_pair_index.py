@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+
+def address(bot):
+    return bot.w3.to_checksum_address("0x" + os.urandom(20).hex())
+
+
+def topic(addr):
+    return "0x" + "0" * 24 + addr[2:].lower()
+
+
+def pair_created(bot, t0, t1, pair):
+    return {"topics": [bot.PAIR_CREATED_TOPIC, topic(t0), topic(t1)], "data": topic(pair) + "0" * 63 + "1"}
+
+
+@pytest.fixture
+def index(bot, monkeypatch, tmp_path):
+    for name in ("PAIR_INDEX_LOG", "PAIR_INDEX_IDX", "PAIR_INDEX_META"):
+        monkeypatch.setattr(bot, name, str(tmp_path / getattr(bot, name)))
+    monkeypatch.setitem(bot.pair_index_state, "last_block", bot.PANCAKE_FACTORY_START_BLOCK - 1)
+    bot.load_pair_index()
+    yield bot
+    monkeypatch.undo()
+    bot.load_pair_index()
+
+
+def test_lookup_from_the_sorted_index_and_the_tail(index):
+    bot = index
+    token = address(bot)
+    pairs = {bot.WBNB: address(bot), bot.BUSD: address(bot)}
+    bot._append_pair_logs([pair_created(bot, token, hub, p) for hub, p in pairs.items()], 100)
+    assert bot.find_pairs(token) == pairs  # from the in-memory tail
+    bot._compact_pair_index()
+    assert not bot.pair_index_tail
+    assert bot.find_pairs(token) == pairs  # now binary-searched in pairs.idx
+    assert bot.get_pair_address(bot.BUSD, token) == pairs[bot.BUSD]
+    usdt_pair = address(bot)
+    bot._append_pair_logs([pair_created(bot, bot.USDT, token, usdt_pair)], 101)
+    assert bot.find_pairs(token) == {**pairs, bot.USDT: usdt_pair}
+    assert bot.get_pair_address(token, bot.USDC) is None
+
+
+def test_restart_replays_the_log_tail_and_drops_unchecked_records(index):
+    bot = index
+    token = address(bot)
+    indexed, tail, lost = address(bot), address(bot), address(bot)
+    bot._append_pair_logs([pair_created(bot, token, bot.WBNB, indexed)], 200)
+    bot._compact_pair_index()
+    bot._append_pair_logs([pair_created(bot, token, bot.BUSD, tail)], 201)
+    # a crash after appending a record but before its checkpoint
+    with open(bot.PAIR_INDEX_LOG, "ab") as f:
+        f.write(bytes.fromhex(token[2:]) + bytes.fromhex(bot.USDT[2:]) + bytes.fromhex(lost[2:]))
+
+    bot.load_pair_index()
+    assert bot.find_pairs(token) == {bot.WBNB: indexed, bot.BUSD: tail}
+    assert bot.pair_index_state["records"] == 2 and bot.pair_index_state["last_block"] == 201
+    assert os.path.getsize(bot.PAIR_INDEX_LOG) == 2 * bot.PAIR_RECORD_SIZE
+
+    # a log shorter than its checkpoint cannot be trusted: start over
+    with open(bot.PAIR_INDEX_LOG, "r+b") as f:
+        f.truncate(bot.PAIR_RECORD_SIZE)
+    bot.load_pair_index()
+    assert bot.find_pairs(token) == {}
+    assert bot.pair_index_state["last_block"] == bot.PANCAKE_FACTORY_START_BLOCK - 1
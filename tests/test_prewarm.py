@@ -0,0 +1,38 @@
+import os
+import time
+from types import SimpleNamespace
+
+
+def test_confirm_signs_with_the_current_gas_price(bot, monkeypatch):
+    key = "0x" + os.urandom(32).hex()
+    wallet = bot.w3.eth.account.from_key(key).address
+    token = bot.w3.to_checksum_address("0x" + "69" * 20)
+    pair = bot.w3.to_checksum_address("0x" + "6a" * 20)
+    path = [bot.WBNB, token]
+    reserves = (10**21, 10**24) if bot.WBNB.lower() < token.lower() else (10**24, 10**21)
+    leg = {"path": path, "pairs": [pair], "amount_in": 10**17, "expected_out": 0, "gas": 300000}
+    staged_gas, current_gas = 10**9, 3 * 10**9
+    bot._store_prewarm(
+        ("7002", token),
+        {"at": time.time(), "route": path, "gas_price": staged_gas, "template": {"amount_in": 10**17, "legs": [leg]}},
+    )
+    monkeypatch.setattr(bot, "get_user_account", lambda uid, address=None: (SimpleNamespace(address=wallet), key))
+    monkeypatch.setattr(bot, "head_block", lambda: 100)
+    monkeypatch.setattr(bot, "watch_tx", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "broadcast_raw_txs", lambda raws: ["0x" + "04" * 32 for _ in raws])
+    signed, sign = [], bot.w3.eth.account.sign_transaction
+    monkeypatch.setattr(bot.w3.eth.account, "sign_transaction", lambda tx, pk: signed.append(tx) or sign(tx, pk))
+
+    def chain(calls):
+        out = []
+        for method, params in calls:
+            if method == "eth_call":
+                out.append({"result": "0x" + "".join(f"{word:064x}" for word in (*reserves, 0))})
+            else:
+                out.append({"result": hex(current_gas if method == "eth_gasPrice" else 0)})
+        return out
+
+    monkeypatch.setattr(bot, "rpc_batch", chain)
+    hashes, out = bot.execute_prewarmed_buy("7002", token, 10**17)
+    assert hashes and out > 0
+    assert signed[0]["gasPrice"] == current_gas
@@ -0,0 +1,31 @@
+import json
+
+
+def test_recorded_button_press_keeps_no_ids_or_wallets(bot):
+    uid, wallet = 5550001234, "0x" + "ab" * 20
+    upd = {
+        "update_id": 1,
+        "callback_query": {
+            "id": "77",
+            "from": {"id": uid, "first_name": "Ann"},
+            "data": "wtoggle_1",
+            "message": {
+                "message_id": 9,
+                "chat": {"id": uid, "type": "private"},
+                "text": f"💼 Wallets\n{wallet}\nCopy-trade ID: {uid} (others follow you with /copy {uid} <size>)",
+                "reply_markup": {"inline_keyboard": [[{"text": "#1", "callback_data": "wtoggle_0"}]]},
+            },
+        },
+    }
+    out = bot.anonymize_update(upd)
+    assert str(uid) not in json.dumps(out) and wallet not in json.dumps(out)
+    assert out["callback_query"]["message"] == {"message_id": 9, "chat": {"id": bot.pseudonym(uid), "type": "private"}}
+    assert out["callback_query"]["data"] == "wtoggle_1"
+
+
+def test_own_id_in_typed_text_is_replaced(bot):
+    uid = 5550004321
+    upd = {"update_id": 2, "message": {"from": {"id": uid}, "chat": {"id": uid}, "text": f"/copy {uid} 0.1\nmine: {uid}"}}
+    text = bot.anonymize_update(upd)["message"]["text"]
+    assert str(uid) not in text
+    assert text.count(str(bot.pseudonym(uid))) == 2
@@ -0,0 +1,50 @@
+def test_alerts_on_repeated_failures_and_saves_only_real_changes(bot, monkeypatch):
+    token = bot.w3.to_checksum_address("0x" + "68" * 20)
+    block = [100]
+    result = {"level": bot.RISK_LOW, "loss_pct": 2.0, "error": None}
+    monkeypatch.setattr(bot, "basic_risk_check", lambda t: {**result, "block": block[0], "at": 0})
+    monkeypatch.setitem(bot.users, "903", {"positions": {token: {"symbol": "TKN", "amount": 1.0}}})
+    saves, alerts = [], []
+    monkeypatch.setattr(bot, "save_users", lambda data: saves.append(1))
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, buttons=None: alerts.append(text))
+
+    def cycle():
+        block[0] += 1
+        bot.refresh_risk_score(token)
+        bot.check_risk_alerts()
+
+    cycle()
+    assert len(saves) == 1 and not alerts
+    result["loss_pct"] = 3.0
+    cycle()
+    assert len(saves) == 1  # small drift within the level: nothing to save
+
+    result.update({"level": bot.RISK_FAILED, "loss_pct": None, "error": "timeout"})
+    for _ in range(bot.RISK_FAIL_REPEATS - 1):
+        cycle()
+    assert not alerts and len(saves) == 1
+    cycle()
+    assert len(alerts) == 1 and len(saves) == 2
+    bot.risk_scores.pop(token, None)
+
+
+def test_held_tokens_are_marked_in_one_update(bot, monkeypatch):
+    class Seen(dict):
+        writes = 0
+
+        def __setitem__(self, key, value):
+            Seen.writes += 1
+            super().__setitem__(key, value)
+
+        def update(self, other):
+            Seen.writes += 1
+            super().update(other)
+
+    tokens = [bot.w3.to_checksum_address("0x" + c * 40) for c in "9ab"]
+    monkeypatch.setattr(bot, "risk_seen", Seen())
+    monkeypatch.setattr(bot, "save_users", lambda data: None)
+    for uid in ("906", "907"):
+        monkeypatch.setitem(bot.users, uid, {"positions": {t: {"symbol": "T", "amount": 1.0} for t in tokens}})
+    bot.check_risk_alerts()
+    assert Seen.writes == 1
+    assert set(bot.risk_seen) >= set(tokens)
@@ -0,0 +1,42 @@
+import threading
+
+
+def tap(user_id, data):
+    return {"callback_query": {"from": {"id": user_id}, "message": {"chat": {"id": user_id}, "message_id": 1}, "data": data}}
+
+
+def test_held_heavy_route_does_not_block_light_routes(bot, monkeypatch):
+    release, light_done = threading.Event(), threading.Event()
+    heavy = bot.callback_router.resolve("portfolio")
+    light = bot.callback_router.resolve("wallet")
+    monkeypatch.setitem(heavy, "handler", lambda ctx: release.wait(5))
+    monkeypatch.setitem(light, "handler", lambda ctx: light_done.set())
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, buttons=None: None)
+    busy = heavy["stats"]["busy"]
+    try:
+        for user_id in range(801, 801 + bot.HEAVY_ROUTE_LIMIT + 2):
+            bot.submit_update(tap(user_id, "portfolio"))
+        bot.submit_update(tap(901, "wallet"))
+        assert light_done.wait(2)
+        assert not release.is_set()
+        assert heavy["stats"]["busy"] - busy == 2
+    finally:
+        release.set()
+
+
+def test_one_users_updates_run_in_order(bot, monkeypatch):
+    seen, done = [], threading.Event()
+    route = bot.callback_router.resolve("wallet")
+
+    def handler(ctx):
+        seen.append(ctx.cb["n"])
+        if len(seen) == 20:
+            done.set()
+
+    monkeypatch.setitem(route, "handler", handler)
+    for n in range(20):
+        upd = tap(902, "wallet")
+        upd["callback_query"]["n"] = n
+        bot.submit_update(upd)
+    assert done.wait(2)
+    assert seen == list(range(20))
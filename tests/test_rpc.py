@@ -0,0 +1,46 @@
+import threading
+
+import replay
+
+
+class CountingRpc(replay.RpcStub):
+    posts = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        with self.lock:
+            CountingRpc.posts += 1
+        super().do_POST()
+
+
+def count_posts(bot, url, calls, **provider_args):
+    """POSTs the node receives for `calls` concurrent eth_blockNumber calls through one provider."""
+    provider = bot.CoalescingHTTPProvider(url, **provider_args)
+    w3 = bot.Web3(provider)
+    start = threading.Barrier(calls)
+    before = CountingRpc.posts
+
+    def call():
+        start.wait()
+        assert w3.eth.block_number > 0
+
+    threads = [threading.Thread(target=call) for _ in range(calls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    provider.close()
+    return CountingRpc.posts - before
+
+
+def test_coalescing_cuts_http_requests(bot):
+    url = replay.serve(CountingRpc)
+    assert count_posts(bot, url, 20, window_ms=0, max_batch=1) == 20
+    assert count_posts(bot, url, 20, window_ms=20) <= 3
+
+
+def test_only_batch_errors_split_the_batch(bot):
+    assert bot._is_batch_rejection({"code": -32005, "message": "request limit reached"})
+    assert bot._is_batch_rejection({"code": -32000, "message": "batch too large"})
+    assert not bot._is_batch_rejection({"code": -32000, "message": "gas limit exceeded"})
+    assert not bot._is_batch_rejection({"code": 3, "message": "execution reverted: rate too high"})
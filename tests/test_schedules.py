@@ -0,0 +1,20 @@
+import time
+
+
+def test_missed_slots_are_skipped(bot):
+    sched = {"next_at": 1000.0, "interval": 60}
+    assert bot.next_slot(sched, 1000.5) == 1060.0
+    # down for three and a half slots: the next slice runs on the grid, once
+    assert bot.next_slot(sched, 1000 + 3.5 * 60) == 1240.0
+
+
+def test_failed_run_retries_only_unsent_entries(bot, monkeypatch):
+    sent = {"gen": 1, "next_at": time.time() + 3600, "id": "a"}
+    unsent = {"gen": 0, "next_at": time.time(), "id": "b"}
+    monkeypatch.setitem(bot.users, "900", {"schedules": {"a": sent, "b": unsent}})
+    wheeled = []
+    monkeypatch.setattr(bot, "_wheel_schedule", lambda uid, sched: wheeled.append((uid, sched["id"], sched["gen"])))
+    bot.retry_unsent([(("900", "a"), 0), (("900", "b"), 0), (("900", "gone"), 0)])
+    assert wheeled == [("900", "b", 1)]
+    assert sent["gen"] == 1
+    assert unsent["next_at"] >= time.time() + bot.SCHED_RETRY_SEC - 1
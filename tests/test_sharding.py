@@ -0,0 +1,32 @@
+import json
+
+
+def owned_by(bot, index, count=2):
+    return next(str(uid) for uid in range(1000, 2000) if bot.shard_of(uid, count) == index)
+
+
+def test_sharded_save_users_merges_the_other_workers_users(bot, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "USERS_FILE", str(tmp_path / "users.json"))
+    a, b = owned_by(bot, 0), owned_by(bot, 1)
+    workers = [{a: {"positions": {}, "n": 1}}, {b: {"positions": {}, "n": 1}}]
+
+    def save(index):
+        monkeypatch.setattr(bot, "SHARD", {"role": "worker", "index": index, "count": 2})
+        bot.save_users(workers[index])
+
+    def on_disk():
+        with open(bot.USERS_FILE) as f:
+            return json.load(f)
+
+    save(0)
+    save(1)
+    assert on_disk() == {a: workers[0][a], b: workers[1][b]}
+    assert workers[1][a] == workers[0][a]  # worker 1 picked up worker 0's user
+
+    workers[0][a]["n"] = 2
+    workers[1][a]["n"] = 99  # a stale copy in a worker that does not own the user
+    workers[1][b]["n"] = 3
+    save(1)
+    save(0)
+    assert on_disk() == {a: {"positions": {}, "n": 2}, b: {"positions": {}, "n": 3}}
+    assert workers[0][b]["n"] == 3
@@ -0,0 +1,106 @@
+"""
+Launches played out on the stand-in node: the test appends the Sync and Mint
+logs a real addLiquidityETH would emit, and the bot's watcher reads them back
+with eth_getLogs, signs and broadcasts against the same node.
+
+These run on replay.py's stand-in rather than a local dev chain (an anvil or
+hardhat fork of BSC), which the test environment does not have. The stand-in
+is enough for what the sniper decides. The launch path only reads the
+PairCreated, Sync and Mint logs through eth_getLogs, nonces and gas price, and
+it only writes eth_sendRawTransaction. The logs here use the same encoding a
+PancakeSwap pair emits. The guards and the minimum output are computed from the
+Sync reserves, and the test checks them in the signed calldata. What a fork
+would add is executing the swap against real pool bytecode, which this does not
+cover.
+"""
+import os
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+BLOCK = 20_000_000
+
+
+@pytest.fixture
+def launch(env, monkeypatch):
+    bot, chain = env.bot, env.chain
+    monkeypatch.setattr(chain, "logs", [])
+    token = bot.w3.to_checksum_address("0x" + os.urandom(20).hex())
+    pair = bot.w3.to_checksum_address("0x" + os.urandom(20).hex())
+    monkeypatch.setattr(bot, "launch_pairs", lambda t: ({hub: pair if hub == bot.WBNB else None for hub in bot.SNIPE_HUBS}, False))
+    uid = str(910_000 + int.from_bytes(os.urandom(2), "big"))
+    monkeypatch.setitem(bot.users, uid, {"private_key": "0x" + os.urandom(32).hex(), "settings": {"slippage": 0.05}, "positions": {}})
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, buttons=None: sent.append(text))
+
+    def add_liquidity(block, bnb, tokens):
+        r0, r1 = (tokens, bnb) if token.lower() < bot.WBNB.lower() else (bnb, tokens)
+        with chain.lock:
+            chain.logs.append({"address": pair.lower(), "topics": [bot.SYNC_TOPIC], "data": f"0x{r0:064x}{r1:064x}", "blockNumber": hex(block)})
+            chain.logs.append(
+                {"address": pair.lower(), "topics": [bot.MINT_TOPIC, "0x" + "00" * 32], "data": "0x" + "00" * 64, "blockNumber": hex(block)}
+            )
+
+    def raws():
+        with chain.lock:
+            return dict(chain.raw)
+
+    return SimpleNamespace(token=token, pair=pair, uid=uid, sent=sent, add_liquidity=add_liquidity, raws=raws)
+
+
+def watch_once(bot, block):
+    bot.check_launches(block, block, bot.snipe_watch.copy())
+
+
+def test_dust_mint_holds_and_real_launch_fires_with_min_out(bot, launch):
+    bot.arm_snipe(launch.uid, launch.token, 0.5)
+    before = launch.raws()
+
+    launch.add_liquidity(BLOCK, bnb=10**17, tokens=10**24)  # 0.1 BNB: below the 1 BNB default
+    watch_once(bot, BLOCK)
+    assert launch.raws() == before
+    assert launch.uid in bot.snipe_book[launch.token]
+    assert "Your snipe stays armed" in launch.sent[-1]
+
+    bnb, tokens = 50 * 10**18, 10**24
+    launch.add_liquidity(BLOCK + 1, bnb=bnb, tokens=tokens)
+    watch_once(bot, BLOCK + 1)
+    new = {h: raw for h, raw in launch.raws().items() if h not in before}
+    assert len(new) == 1
+    out = bot.quote_hops(5 * 10**17, [(bnb, tokens)])
+    min_out = int(out * (1 - 0.05))
+    # calldata: selector, then amountOutMin
+    assert bot.SWAP_ETH_FOR_TOKENS_SELECTOR[2:] + f"{min_out:064x}" in list(new.values())[0]
+    assert launch.token not in bot.snipe_book
+    assert (0, launch.token) not in bot.snipe_watch
+    assert launch.token not in bot.users[launch.uid]["snipes"]
+
+
+def test_launch_above_max_price_stays_armed(bot, launch):
+    bot.arm_snipe(launch.uid, launch.token, 0.5, max_price_bnb=1e-9)
+    before = launch.raws()
+    launch.add_liquidity(BLOCK + 2, bnb=50 * 10**18, tokens=10**24)  # ~5e-5 BNB per token
+    watch_once(bot, BLOCK + 2)
+    assert launch.raws() == before
+    assert "above your" in launch.sent[-1]
+    with bot.snipe_lock:
+        bot.snipe_book.pop(launch.token, None)
+    bot.snipe_watch.pop((0, launch.token), None)
+
+
+def test_intake_watcher_hands_launches_to_the_workers(bot, launch, monkeypatch):
+    bot.arm_snipe(launch.uid, launch.token, 0.5)
+    before = launch.raws()
+    worker_queue = queue.Queue()
+    monkeypatch.setitem(bot.SHARD, "role", "intake")
+    monkeypatch.setattr(bot, "shard_queues", [worker_queue])
+    launch.add_liquidity(BLOCK + 3, bnb=50 * 10**18, tokens=10**24)
+    watch_once(bot, BLOCK + 3)
+    assert launch.raws() == before  # the intake holds no keys and sends nothing
+
+    upd = worker_queue.get_nowait()
+    assert upd["snipe_launch"]["token"] == launch.token
+    monkeypatch.setitem(bot.SHARD, "role", "single")
+    bot.dispatch_update(upd)
+    assert len(launch.raws()) == len(before) + 1
@@ -0,0 +1,54 @@
+import os
+import statistics
+from types import SimpleNamespace
+
+
+def test_split_plan_is_sub_millisecond(bot):
+    token = bot.w3.to_checksum_address("0x" + "6b" * 20)
+    routes = [
+        ([bot.WBNB, token], [(100 * 10**18, 2 * 10**23)]),
+        ([bot.WBNB, bot.BUSD, token], [(1000 * 10**18, 6 * 10**23), (6 * 10**23, 2 * 10**24)]),
+        ([bot.WBNB, bot.USDT, token], [(500 * 10**18, 3 * 10**23), (3 * 10**23, 10**24)]),
+    ]
+    plans = [bot.compute_split_plan(50 * 10**18, [(p, list(h)) for p, h in routes]) for _ in range(200)]
+    assert len(plans[0]["legs"]) > 1
+    assert sum(leg["amount_in"] for leg in plans[0]["legs"]) == 50 * 10**18
+    assert statistics.median(plan["calc_us"] for plan in plans) < 1000
+
+
+def test_split_buy_executes_the_plan_and_reports_a_partial_fill(bot, monkeypatch):
+    key = "0x" + os.urandom(32).hex()
+    wallet = bot.w3.eth.account.from_key(key).address
+    token = bot.w3.to_checksum_address("0x" + "6c" * 20)
+    legs = [
+        {"path": [bot.WBNB, token], "amount_in": 6 * 10**17, "expected_out": 1000},
+        {"path": [bot.WBNB, bot.BUSD, token], "amount_in": 4 * 10**17, "expected_out": 700},
+    ]
+    monkeypatch.setattr(bot, "get_user_account", lambda uid, address=None: (SimpleNamespace(address=wallet), key))
+    monkeypatch.setattr(bot, "next_nonce", lambda address: 11)
+    monkeypatch.setattr(bot, "get_user_gas_price", lambda uid: 10**9)
+    monkeypatch.setattr(bot, "get_amounts_out", lambda *args: (_ for _ in ()).throw(AssertionError("re-quoted")))
+    monkeypatch.setattr(bot, "watch_tx", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "broadcast_raw_txs", lambda raws: ["0x" + "09" * 32, None])
+    signed, sign = [], bot.w3.eth.account.sign_transaction
+    monkeypatch.setattr(bot.w3.eth.account, "sign_transaction", lambda tx, pk: signed.append(tx) or sign(tx, pk))
+
+    hashes, out = bot.swap_bnb_for_token_split(905, token, legs)
+    assert hashes == ["0x" + "09" * 32] and out == 1000
+    assert [tx["nonce"] for tx in signed] == [11, 12]
+    min_out = int(signed[0]["data"][10:74], 16)
+    assert min_out == int(1000 * (1 - 0.03))
+
+    edits = []
+    monkeypatch.setattr(bot, "swap_bnb_for_token_split", lambda uid, t, l: (hashes, out))
+    monkeypatch.setattr(bot, "execute_prewarmed_buy", lambda *args: None)
+    monkeypatch.setattr(bot, "get_token_info", lambda t: {"decimals": 18, "symbol": "T", "price_usd": 1.0})
+    monkeypatch.setattr(bot, "announce_copy_trade", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "edit_message", lambda chat_id, msg_id, text, buttons=None: edits.append(text))
+    tracked = []
+    monkeypatch.setattr(bot, "track_fill", lambda fill, save=True: tracked.append(fill))
+    monkeypatch.setitem(bot.users, "905", {"private_key": key, "settings": {}, "positions": {}})
+    bot.pending_trades[905] = {"type": "buy", "token": token, "amount": 1.0, "legs": legs}
+    bot.cb_confirm_buy(SimpleNamespace(user_id=905, chat_id=905, msg_id=1, uid="905", has_wallet=True, received=0))
+    assert "Partial fill: only 1 of 2 route legs" in edits[-1]
+    assert tracked[0]["amounts_in"] == [6 * 10**17]
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+
+def test_steps_expire_by_ttl_and_the_store_evicts_least_recent(bot, monkeypatch):
+    monkeypatch.setitem(bot.STATE_TTLS, "await_pk", -1)  # expired as soon as it is stored
+    store = bot.ConversationStore("test_states", max_entries=2)
+    store[1] = {"step": "await_pk"}
+    store[2] = {"step": "await_buy_token"}
+    assert store.get(1) is None and 1 not in store.entries
+    assert store.expired == 1
+
+    store[3] = {"step": "await_sell_token"}
+    assert 2 in store  # touched, so 3 is now the least recent after the next write
+    store[4] = {"step": "await_buy_amount"}
+    assert list(store.entries) == [2, 4]
+    assert store.evicted == 1
+
+    store[5] = {"step": "await_pk"}  # already expired, yet it still evicts 2
+    store.sweep()
+    assert list(store.entries) == [4]
+    assert store.evicted == 2 and store.expired == 2
+
+
+def test_confirm_refuses_a_stale_quote(bot, monkeypatch):
+    edits = []
+    monkeypatch.setattr(bot, "edit_message", lambda chat_id, msg_id, text, buttons=None: edits.append((text, buttons)))
+    monkeypatch.setattr(bot, "head_block", lambda: 1000)
+    monkeypatch.setattr(bot, "execute_prewarmed_buy", lambda *args: (_ for _ in ()).throw(AssertionError("bought")))
+    ctx = SimpleNamespace(user_id=906, chat_id=906, msg_id=1, uid="906", has_wallet=True, received=0)
+    trade = {"type": "buy", "token": bot.BUSD, "amount": 0.1, "quote_block": 1000 - bot.MAX_QUOTE_AGE_BLOCKS - 1}
+    bot.pending_trades[906] = trade
+
+    bot.cb_confirm_buy(ctx)
+    text, buttons = edits[-1]
+    assert text.startswith(f"⌛ Quote is {bot.MAX_QUOTE_AGE_BLOCKS + 1} blocks old")
+    assert buttons[0][0]["callback_data"] == "requote"
+    assert bot.pending_trades.get(906) == trade  # kept for the re-quote
+    bot.pending_trades.pop(906)
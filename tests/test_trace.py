@@ -0,0 +1,34 @@
+import json
+import os
+
+
+def test_trace_window_writes_nested_spans(bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, buttons=None: sent.append(text))
+    monkeypatch.setattr(bot, "finish_trace", lambda *args: None)
+    monkeypatch.setattr(bot, "trace_window", {})
+    monkeypatch.setattr(bot, "trace_seen", {"until": 0, "file": None, "checked": 0})
+
+    with bot.trace_update("route:before"):
+        pass
+    bot.message_router.dispatch("", bot.UpdateContext(1, 1, text="/trace 30"))
+    assert sent[-1].startswith("🔎 Tracing every update for 30s")
+    path = bot.trace_window["file"]
+    assert not os.path.exists(path)  # nothing outside the window
+
+    with bot.trace_update("route:wallet", user=1):
+        with bot.span("eth_blockNumber", "rpc"):
+            pass
+    bot.message_router.dispatch("", bot.UpdateContext(1, 1, text="/trace off"))
+    with bot.trace_update("route:after"):
+        pass
+
+    with open(path) as f:
+        text = f.read()
+    os.remove(path)
+    assert text.startswith("[\n")
+    events = json.loads(text.rstrip(",\n") + "]")
+    assert [(e["name"], e["cat"]) for e in events] == [("eth_blockNumber", "rpc"), ("route:wallet", "update")]
+    inner, root = events
+    assert root["args"] == {"user": 1} and root["ph"] == "X"
+    assert root["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= root["ts"] + root["dur"] + 2  # µs truncation
@@ -0,0 +1,31 @@
+import os
+from types import SimpleNamespace
+
+
+def test_speed_up_handle_survives_a_restart(bot, monkeypatch):
+    key = "0x" + os.urandom(32).hex()
+    wallet = bot.w3.eth.account.from_key(key).address
+    monkeypatch.setattr(bot, "get_user_account", lambda uid, address=None: (SimpleNamespace(address=wallet), key))
+    monkeypatch.setattr(bot, "broadcast_raw_tx", lambda raw: bot.Web3.to_hex(bot.Web3.keccak(raw)))
+    tx = {"from": wallet, "to": bot.WRAPPER_ADDRESS, "value": 10**17, "gas": 300000, "gasPrice": 10**9,
+          "nonce": 3, "chainId": 56, "data": "0x"}
+    first = "0x" + "08" * 32
+    tx_id = bot.watch_tx(904, tx, first, label="BUY")
+    bot.save_fills()
+
+    with bot.tx_lock:  # a restart
+        bot.tracked_txs.clear()
+        bot.tx_id_by_hash.clear()
+    assert bot.tx_buttons([first]) == []
+    bot.load_tracked_txs()
+    assert bot.tx_buttons([first])[0][0]["callback_data"] == f"txup_{tx_id}"
+    assert bot.tracked_tx_owner(tx_id) == 904
+
+    tx_hash, price = bot.speed_up_tx(tx_id)
+    assert price > 10**9
+    with bot.tx_lock:
+        assert bot.tracked_txs[tx_id]["hashes"] == [first, tx_hash]
+    bot.load_tracked_txs()
+    assert bot.tx_id_by_hash[tx_hash] == tx_id
+    with bot.tx_lock:
+        bot._forget_tx(tx_id)
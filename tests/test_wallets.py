@@ -0,0 +1,33 @@
+import os
+from types import SimpleNamespace
+
+
+def new_key():
+    return "0x" + os.urandom(32).hex()
+
+
+def test_single_non_primary_wallet_does_not_trade_on_primary(bot, monkeypatch):
+    primary, extra = new_key(), new_key()
+    extra_addr = bot.w3.eth.account.from_key(extra).address
+    profile = {"private_key": primary, "wallets": [{"address": extra_addr, "private_key": extra}], "settings": {}, "positions": {}}
+    monkeypatch.setitem(bot.users, "901", profile)
+    assert bot.trades_on_primary(901)
+    profile["active_wallets"] = [extra_addr]
+    assert not bot.trades_on_primary(901)
+    assert extra_addr in bot.wallets_line(901, "buy")
+
+    routed = []
+    monkeypatch.setattr(bot, "confirm_multi_wallet", lambda ctx, trade: routed.append(trade["type"]))
+    bot.pending_trades[901] = {"type": "sell", "token": bot.BUSD, "amount": 1.0}
+    bot.cb_confirm_sell(SimpleNamespace(user_id=901, chat_id=901, msg_id=1, has_wallet=True))
+    bot.pending_trades.pop(901, None)
+    assert routed == ["sell"]
+
+
+def test_extra_wallet_key_is_validated(bot, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, "send_message", lambda chat_id, text, buttons=None: sent.append(text))
+    bot.user_states[902] = {"step": "await_extra_pk", "data": {}}
+    bot.msg_extra_pk(SimpleNamespace(user_id=902, chat_id=902, uid="902", text="12" * 32, has_wallet=True))
+    assert sent == ["❌ Invalid private key format. Try again or /start."]
+    assert bot.user_states.pop(902, None)  # still waiting for a valid key